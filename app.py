@@ -1,11 +1,16 @@
-import os, sqlite3, json, io
+import time
+_T_IMPORT = time.perf_counter()   # para ARRANQUE["import_ms"]
+import os, re, sqlite3, json, io, threading, hashlib, bisect, random, tempfile
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from flask import (
     Flask, render_template, request, redirect, url_for, session,
-    flash, send_file, send_from_directory, abort, g
+    flash, send_file, send_from_directory, abort, g, jsonify, Response, make_response, has_request_context
 )
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 from jinja2 import TemplateNotFound
+import click
 import secrets
 
 # ------------ Utilidades ------------
@@ -13,32 +18,253 @@ def generate_token(n=32):
     return secrets.token_urlsafe(n)[:n]
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH   = os.path.join(BASE_DIR, "pedidos.db")
+DB_PATH   = os.getenv("DB_PATH", os.path.join(BASE_DIR, "pedidos.db"))
+
+# Perfil de pragmas por conexión; se puede ajustar con DB_PRAGMAS="synchronous=FULL,cache_size=-8000"
+DB_PRAGMAS = {
+    "journal_mode": "WAL",       # lectores no bloquean al escritor (y viceversa)
+    "synchronous": "NORMAL",     # seguro con WAL; sólo fsync en checkpoint
+    "busy_timeout": 5000,        # ms esperando el lock antes de "database is locked"
+    "cache_size": -16000,        # KiB (negativo) → ~16 MB por conexión
+    "mmap_size": 134217728,      # 128 MB
+    "temp_store": "MEMORY",
+}
+for _kv in filter(None, os.getenv("DB_PRAGMAS", "").split(",")):
+    _k, _, _v = _kv.partition("=")
+    DB_PRAGMAS[_k.strip()] = _v.strip()
+
+# ------------ Métricas por request / SQL (opt-in: METRICS=1) ------------
+METRICS_ENABLED = os.getenv("METRICS", "") not in ("", "0", "false", "no")
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SQL_NORM = [(re.compile(r"'(?:[^']|'')*'"), "?"), (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"), (re.compile(r"\s+"), " ")]
+
+def normalize_sql(q):
+    for rx, rep in _SQL_NORM:
+        q = rx.sub(rep, q)
+    return q.strip()[:200]
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, v):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+    def quantile(self, q):
+        """Estimación por interpolación lineal dentro del bucket (como histogram_quantile)."""
+        if not self.count:
+            return 0.0
+        rank, acc = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if acc + c >= rank and c:
+                lo = METRIC_BUCKETS[i - 1] if i else 0.0
+                hi = METRIC_BUCKETS[i] if i < len(METRIC_BUCKETS) else METRIC_BUCKETS[-1]
+                return lo + (hi - lo) * (rank - acc) / c
+            acc += c
+        return METRIC_BUCKETS[-1]
+
+class EndpointMetrics:
+    __slots__ = ("wall", "sql", "statements", "rows", "slowest", "slowest_sql")
+    def __init__(self):
+        self.wall, self.sql = Histogram(), Histogram()
+        self.statements = self.rows = 0
+        self.slowest, self.slowest_sql = 0.0, ""
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, wall, m):
+        with self._lock:
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = EndpointMetrics()
+            e.wall.observe(wall)
+            e.sql.observe(m["time"])
+            e.statements += m["n"]
+            e.rows += m["rows"]
+            if m["slow"] > e.slowest:
+                e.slowest, e.slowest_sql = m["slow"], normalize_sql(m["slow_sql"])
+
+    def prometheus(self, extra=()):
+        """Texto en formato de exposición de Prometheus."""
+        def lbl(**kv):
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92)*2).replace(chr(34), chr(92)+chr(34))}"'
+                                  for k, v in kv.items()) + "}"
+        out = []
+        with self._lock:
+            items = sorted(self.endpoints.items())
+            for name, help_, attr in (("pedidos_request_seconds", "Tiempo total del request", "wall"),
+                                      ("pedidos_request_sql_seconds", "Tiempo en SQL por request", "sql")):
+                out += [f"# HELP {name} {help_}", f"# TYPE {name} histogram"]
+                for ep, e in items:
+                    h, acc = getattr(e, attr), 0
+                    for b, c in zip(METRIC_BUCKETS + ("+Inf",), h.counts):
+                        acc += c
+                        out.append(f"{name}_bucket{lbl(endpoint=ep, le=b)} {acc}")
+                    out.append(f"{name}_sum{lbl(endpoint=ep)} {h.sum:.6f}")
+                    out.append(f"{name}_count{lbl(endpoint=ep)} {h.count}")
+                out += [f"# HELP {name}_quantile Percentil estimado desde el histograma", f"# TYPE {name}_quantile gauge"]
+                for ep, e in items:
+                    for q in (0.5, 0.95, 0.99):
+                        out.append(f"{name}_quantile{lbl(endpoint=ep, quantile=q)} {getattr(e, attr).quantile(q):.6f}")
+            out += ["# HELP pedidos_sql_statements_total Sentencias SQL ejecutadas", "# TYPE pedidos_sql_statements_total counter"]
+            out += [f"pedidos_sql_statements_total{lbl(endpoint=ep)} {e.statements}" for ep, e in items]
+            out += ["# HELP pedidos_sql_rows_total Filas devueltas por query_one/query_all", "# TYPE pedidos_sql_rows_total counter"]
+            out += [f"pedidos_sql_rows_total{lbl(endpoint=ep)} {e.rows}" for ep, e in items]
+            out += ["# HELP pedidos_sql_slowest_seconds Sentencia más lenta vista por endpoint", "# TYPE pedidos_sql_slowest_seconds gauge"]
+            out += [f"pedidos_sql_slowest_seconds{lbl(endpoint=ep, sql=e.slowest_sql)} {e.slowest:.6f}" for ep, e in items if e.slowest_sql]
+        for name, kind, value in extra:
+            out += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+def _sql_observe(q, elapsed, rows=0):
+    m = g.get("_sqlm") if has_request_context() else None
+    if m is not None:
+        m["n"] += 1
+        m["time"] += elapsed
+        m["rows"] += rows
+        if elapsed > m["slow"]:
+            m["slow"], m["slow_sql"] = elapsed, q
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Mide execute/executemany; query_one/query_all suman además el fetch y las filas."""
+    def execute(self, q, args=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(q, args)
+        finally:
+            _sql_observe(q, time.perf_counter() - t0)
+
+    def executemany(self, q, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(q, seq)
+        finally:
+            _sql_observe(q, time.perf_counter() - t0)
+
+def connect_db(path=None):
+    db = sqlite3.connect(path or DB_PATH, timeout=30,
+                         factory=InstrumentedConnection if METRICS_ENABLED else sqlite3.Connection)
+    db.row_factory = sqlite3.Row
+    for k, v in DB_PRAGMAS.items():
+        db.execute(f"PRAGMA {k}={v}")
+    return db
+
+class ConnectionPool:
+    """Una conexión caliente por hilo (los hilos de waitress viven todo el proceso).
+
+    acquire() reutiliza la conexión del hilo (hit) o abre una nueva con el perfil de
+    pragmas (miss); release() sólo deshace una transacción que haya quedado abierta.
+    reset() invalida todas las conexiones (p. ej. tras restaurar la BD) y llama a `on_reset`.
+    Como `restaurar` suele correr en otro proceso, acquire() también revisa la marca que deja
+    (<BD>.restaurada): si cambió, el proceso hace su propio reset().
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.opened = 0
+        self.on_reset = []
+        self.marca = self._marca()
+
+    def _marca(self):
+        try:
+            return os.stat(marca_restaurada(self.path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def acquire(self):
+        marca = self._marca()   # un stat() por checkout
+        if marca != self.marca:
+            with self._lock:
+                nueva, self.marca = marca != self.marca, marca
+            if nueva:
+                self.reset()
+        loc = self._local
+        db = getattr(loc, "db", None)
+        if db is not None and loc.generation == self.generation:
+            with self._lock:
+                self.hits += 1
+            return db
+        if db is not None:
+            db.close()
+        loc.db = db = connect_db(self.path)
+        loc.generation = self.generation
+        with self._lock:
+            self.misses += 1
+            self.opened += 1
+        return db
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+
+    def reset(self):
+        with self._lock:
+            self.generation += 1
+        for fn in self.on_reset:
+            fn()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "opened": self.opened,
+                    "hit_ratio": round(self.hits / total, 4) if total else None,
+                    "generation": self.generation, "pragmas": dict(DB_PRAGMAS)}
+
+def marca_restaurada(path=None):
+    """Archivo que `restaurar` toca al terminar; su mtime avisa a los demás procesos."""
+    return (path or DB_PATH) + ".restaurada"
+
+DB_POOL = ConnectionPool()
 
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = DB_POOL.acquire()
     return g.db
 
 def close_db(e=None):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        DB_POOL.release(db)
 
-def table_has_column(table, column):
-    info = get_db().execute(f"PRAGMA table_info({table})").fetchall()
+def table_has_column(db, table, column):
+    info = db.execute(f"PRAGMA table_info({table})").fetchall()
     return any(r["name"] == column for r in info)
 
-def init_db():
-    db = get_db()
+def split_sql(text):
+    """Parte un script en sentencias completas (respeta cuerpos de TRIGGER con ';')."""
+    buf = ""
+    for line in text.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            yield buf.strip()
+            buf = ""
+    if buf.strip():
+        yield buf.strip()
+
+def schema_statements():
+    """Sentencias de schema.sql una por una (executescript haría COMMIT a media migración)."""
     with open(os.path.join(BASE_DIR, "schema.sql"), "r", encoding="utf-8") as f:
-        db.executescript(f.read())
-    db.commit()
+        return list(split_sql(f.read()))
 
-def migrate_db():
-    db = get_db()
-    # ---- escuelas fields (perfil + paquetería) ----
+def init_db(db):
+    for stmt in schema_statements():
+        db.execute(stmt)
+
+# ------------ Migraciones (PRAGMA user_version) ------------
+def _mig_columnas_legacy(db):
+    # columnas que antes agregaba migrate_db() en cada request
     esc_cols = [
         ("direccion","TEXT"),
         ("colonia","TEXT"),
@@ -54,11 +280,8 @@ def migrate_db():
         ("dest_correo","TEXT")
     ]
     for col, ctype in esc_cols:
-        if not table_has_column("escuelas", col):
+        if not table_has_column(db, "escuelas", col):
             db.execute(f"ALTER TABLE escuelas ADD COLUMN {col} {ctype}")
-            db.commit()
-
-    # ---- pedidos fields (globales del pedido) ----
     ped_cols = [
         ("color_calceta_ninas","TEXT"),
         ("color_zapato_ninas","TEXT"),
@@ -70,28 +293,1531 @@ def migrate_db():
         ("entrega","TEXT")           # 'Ocurre' | 'Domicilio'
     ]
     for col, ctype in ped_cols:
-        if not table_has_column("pedidos", col):
+        if not table_has_column(db, "pedidos", col):
             db.execute(f"ALTER TABLE pedidos ADD COLUMN {col} {ctype}")
-            db.commit()
+
+def _mig_produccion_rollup(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS produccion_rollup (
+            fecha TEXT NOT NULL,        -- primera fecha de entrega del pedido (aaaa-mm-dd)
+            estado TEXT NOT NULL,
+            concepto TEXT NOT NULL,     -- calceta_ninas | zapato_ninas | zapato_ninos | monos | pantalon | escudos
+            color TEXT NOT NULL,
+            piezas INTEGER NOT NULL DEFAULT 0,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(fecha, estado, concepto, color)
+        ) WITHOUT ROWID
+    """)
+    rebuild_produccion(db)
+
+def _fts_alumnos(p):
+    """Nombres de niñas y niños del JSON de la fila `p`, separados por espacio (JSON inválido = vacío)."""
+    return " || ' ' || ".join(
+        f"COALESCE((SELECT group_concat(json_extract(j.value, '$.nombre'), ' ') FROM json_each("
+        f"CASE WHEN json_valid({p}.{col}) THEN {p}.{col} ELSE '[]' END) j WHERE j.type = 'object'), '')"
+        for col in ("ninas_json", "ninos_json"))
+
+FTS_COLS = "rowid, escuela, ciudad, contacto, comentario, alumnos"
+
+def _mig_pedidos_fts(db):
+    # un documento por pedido: datos de su escuela + comentario + alumnos; los triggers lo mantienen
+    nuevo = f"""
+        INSERT INTO pedidos_fts({FTS_COLS})
+        SELECT NEW.id, e.nombre, e.ciudad, e.contacto, NEW.comentario, {_fts_alumnos("NEW")}
+        FROM (SELECT 1) LEFT JOIN escuelas e ON e.id = NEW.escuela_id;"""
+    for stmt in (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS pedidos_fts USING fts5(
+               escuela, ciudad, contacto, comentario, alumnos,
+               tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4 5 6')""",
+        # peso por columna para bm25: el nombre de la escuela y de los alumnos pesan más que el comentario
+        "INSERT INTO pedidos_fts(pedidos_fts, rank) VALUES ('rank', 'bm25(10.0, 2.0, 4.0, 1.0, 6.0)')",
+        f"CREATE TRIGGER IF NOT EXISTS trg_pedidos_fts_ins AFTER INSERT ON pedidos BEGIN {nuevo} END",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_pedidos_fts_upd AFTER UPDATE OF escuela_id, comentario, ninas_json, ninos_json ON pedidos
+            BEGIN DELETE FROM pedidos_fts WHERE rowid = OLD.id; {nuevo} END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_pedidos_fts_del AFTER DELETE ON pedidos BEGIN
+               DELETE FROM pedidos_fts WHERE rowid = OLD.id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_escuelas_fts_upd AFTER UPDATE OF nombre, ciudad, contacto ON escuelas
+           WHEN OLD.nombre IS NOT NEW.nombre OR OLD.ciudad IS NOT NEW.ciudad OR OLD.contacto IS NOT NEW.contacto BEGIN
+               UPDATE pedidos_fts SET escuela = NEW.nombre, ciudad = NEW.ciudad, contacto = NEW.contacto
+               WHERE rowid IN (SELECT id FROM pedidos WHERE escuela_id = NEW.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_escuelas_fts_del AFTER DELETE ON escuelas BEGIN
+               UPDATE pedidos_fts SET escuela = NULL, ciudad = NULL, contacto = NULL
+               WHERE rowid IN (SELECT id FROM pedidos WHERE escuela_id = OLD.id);
+           END""",
+        "DELETE FROM pedidos_fts",
+        f"""INSERT INTO pedidos_fts({FTS_COLS})
+            SELECT p.id, e.nombre, e.ciudad, e.contacto, p.comentario, {_fts_alumnos("p")}
+            FROM pedidos p LEFT JOIN escuelas e ON e.id = p.escuela_id""",
+    ):
+        db.execute(stmt)
+
+VERSIONED_TABLES = ("pedidos", "escuelas", "paqueterias")
+
+def _mig_row_version(db):
+    # versión por fila tomada de una secuencia global: cualquier escritura deja una versión mayor que todas
+    # las anteriores, así que (COUNT, MAX(version)) de un conjunto cambia con altas, bajas y ediciones
+    db.execute("CREATE TABLE IF NOT EXISTS row_version (id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)")
+    db.execute("INSERT OR IGNORE INTO row_version(id, seq) VALUES (1, 0)")
+    for t in VERSIONED_TABLES:
+        if not table_has_column(db, t, "version"):
+            db.execute(f"ALTER TABLE {t} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        for ev, when in (("INSERT", ""), ("UPDATE", "WHEN NEW.version IS OLD.version")):
+            db.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{t}_version_{ev[:3].lower()} AFTER {ev} ON {t} {when} BEGIN
+                               UPDATE row_version SET seq = seq + 1 WHERE id = 1;
+                               UPDATE {t} SET version = (SELECT seq FROM row_version WHERE id = 1) WHERE id = NEW.id;
+                           END""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_paqueterias_version ON paqueterias(version)")
+
+AHORA_SQL = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+
+def _mig_estado_log(db):
+    # historial sólo de inserción: cada fila dice a qué estado entró el pedido, cuándo, de cuál venía y
+    # cuántas horas pasó en él. pedidos.estado_desde guarda cuándo entró al estado actual.
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS pedido_estado_log (
+            id INTEGER PRIMARY KEY,
+            pedido_id INTEGER NOT NULL,
+            estado TEXT NOT NULL,
+            ts TEXT NOT NULL,               -- entrada a `estado` (UTC, ISO)
+            anterior TEXT,                  -- estado del que salió (NULL en el alta)
+            horas_anterior INTEGER          -- horas que pasó en `anterior`
+        )""")
+    if not table_has_column(db, "pedidos", "estado_desde"):
+        db.execute("ALTER TABLE pedidos ADD COLUMN estado_desde TEXT")
+    # lo que ya se sabe: estado inicial al crear el pedido + los cambios registrados en la auditoría
+    db.execute(f"""
+        -- plan: full (migración: recorre pedidos y auditoría una vez)
+        INSERT INTO pedido_estado_log(pedido_id, estado, ts, anterior, horas_anterior)
+        WITH h AS (
+            SELECT p.id AS pedido_id,
+                   COALESCE((SELECT a.antes FROM pedido_auditoria a WHERE a.pedido_id = p.id AND a.campo = 'estado'
+                             ORDER BY a.ts, a.id LIMIT 1), p.estado, '') AS estado,
+                   COALESCE(p.created_at, {AHORA_SQL}) AS ts, 0 AS orden
+            FROM pedidos p
+            UNION ALL
+            SELECT pedido_id, COALESCE(despues, ''), ts, id FROM pedido_auditoria WHERE campo = 'estado'
+        ), w AS (
+            SELECT *, LAG(estado) OVER win AS anterior, LAG(ts) OVER win AS ts_anterior
+            FROM h WINDOW win AS (PARTITION BY pedido_id ORDER BY ts, orden)
+        )
+        SELECT pedido_id, estado, ts, anterior,
+               CAST(round((julianday(ts) - julianday(ts_anterior)) * 24) AS INTEGER)
+        FROM w ORDER BY ts, orden""")
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_pedido_estado_log_pedido ON pedido_estado_log(pedido_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_pedido_estado_log_estado ON pedido_estado_log(estado, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_pedido_estado_log_horas ON pedido_estado_log(anterior, horas_anterior)",
+        "CREATE INDEX IF NOT EXISTS idx_pedidos_estado_desde ON pedidos(estado, estado_desde)",
+    ):
+        db.execute(stmt)
+    # después de los índices: MAX(ts) por pedido sale de idx_pedido_estado_log_pedido
+    db.execute(f"""
+        -- plan: full (migración)
+        UPDATE pedidos SET estado_desde = COALESCE(
+            (SELECT MAX(ts) FROM pedido_estado_log l WHERE l.pedido_id = pedidos.id), created_at, {AHORA_SQL})""")
+    for stmt in (
+        f"""CREATE TRIGGER IF NOT EXISTS trg_pedidos_estado_log_ins AFTER INSERT ON pedidos BEGIN
+                INSERT INTO pedido_estado_log(pedido_id, estado, ts)
+                VALUES (NEW.id, COALESCE(NEW.estado, ''), COALESCE(NEW.created_at, {AHORA_SQL}));
+                UPDATE pedidos SET estado_desde = COALESCE(NEW.created_at, {AHORA_SQL})
+                WHERE id = NEW.id AND NEW.estado_desde IS NULL;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_pedidos_estado_log_upd AFTER UPDATE OF estado ON pedidos
+            WHEN OLD.estado IS NOT NEW.estado BEGIN
+                INSERT INTO pedido_estado_log(pedido_id, estado, ts, anterior, horas_anterior)
+                VALUES (NEW.id, COALESCE(NEW.estado, ''), {AHORA_SQL}, COALESCE(OLD.estado, ''),
+                        CAST(round((julianday('now') - julianday(OLD.estado_desde)) * 24) AS INTEGER));
+                UPDATE pedidos SET estado_desde = {AHORA_SQL} WHERE id = NEW.id;
+            END""",
+    ):
+        db.execute(stmt)
+
+# (versión, descripción, SQL o función(db)); sólo se agregan al final, nunca se reordenan
+MIGRATIONS = [
+    (1, "columnas de perfil/paquetería y globales del pedido", _mig_columnas_legacy),
+    (2, "tabla password_resets", """
+        CREATE TABLE IF NOT EXISTS password_resets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token TEXT NOT NULL UNIQUE,
+            expires_at TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """),
+    (3, "índices de listados (pedidos, escuelas, users, paqueterias)", """
+        CREATE INDEX IF NOT EXISTS idx_pedidos_escuela_created ON pedidos(escuela_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_pedidos_created ON pedidos(created_at);
+        CREATE INDEX IF NOT EXISTS idx_pedidos_estado_created ON pedidos(estado, created_at);
+        CREATE INDEX IF NOT EXISTS idx_escuelas_vendedora_nombre ON escuelas(vendedora_id, nombre);
+        CREATE INDEX IF NOT EXISTS idx_users_role_active ON users(role, is_active);
+        CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);
+        CREATE INDEX IF NOT EXISTS idx_paqueterias_activa_nombre ON paqueterias(activa DESC, nombre)
+    """),
+    (4, "índices para filtros de /admin/pedidos", """
+        CREATE INDEX IF NOT EXISTS idx_pedidos_paqueteria_created ON pedidos(paqueteria_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_pedidos_ciudad_created ON pedidos(ciudad, created_at)
+    """),
+    # los pedidos existentes se pasan con `flask backfill-items` (por lotes, con la app en línea)
+    (5, "tabla pedido_items (alumnos del pedido)", """
+        CREATE TABLE IF NOT EXISTS pedido_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pedido_id INTEGER NOT NULL,
+            grupo TEXT NOT NULL CHECK(grupo IN ('ninas','ninos')),
+            pos INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            color_pelo TEXT,
+            calceta TEXT,
+            FOREIGN KEY(pedido_id) REFERENCES pedidos(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_pedido_items_pedido ON pedido_items(pedido_id, grupo, pos)
+    """),
+    (6, "rollup de producción por fecha de entrega/estado", _mig_produccion_rollup),
+    # contadores por escuela/estado; los triggers cubren toda escritura a pedidos/escuelas
+    (7, "contadores escuela_pedidos + triggers", """
+        CREATE TABLE IF NOT EXISTS escuela_pedidos (
+            escuela_id INTEGER NOT NULL,
+            estado TEXT NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(escuela_id, estado)
+        ) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS trg_pedidos_count_ins AFTER INSERT ON pedidos BEGIN
+            INSERT INTO escuela_pedidos(escuela_id, estado, n) VALUES (NEW.escuela_id, COALESCE(NEW.estado, ''), 1)
+            ON CONFLICT(escuela_id, estado) DO UPDATE SET n = n + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_pedidos_count_del AFTER DELETE ON pedidos BEGIN
+            UPDATE escuela_pedidos SET n = n - 1 WHERE escuela_id = OLD.escuela_id AND estado = COALESCE(OLD.estado, '');
+            DELETE FROM escuela_pedidos WHERE escuela_id = OLD.escuela_id AND estado = COALESCE(OLD.estado, '') AND n <= 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_pedidos_count_upd AFTER UPDATE OF escuela_id, estado ON pedidos
+        WHEN OLD.escuela_id IS NOT NEW.escuela_id OR OLD.estado IS NOT NEW.estado BEGIN
+            UPDATE escuela_pedidos SET n = n - 1 WHERE escuela_id = OLD.escuela_id AND estado = COALESCE(OLD.estado, '');
+            DELETE FROM escuela_pedidos WHERE escuela_id = OLD.escuela_id AND estado = COALESCE(OLD.estado, '') AND n <= 0;
+            INSERT INTO escuela_pedidos(escuela_id, estado, n) VALUES (NEW.escuela_id, COALESCE(NEW.estado, ''), 1)
+            ON CONFLICT(escuela_id, estado) DO UPDATE SET n = n + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_escuelas_count_del AFTER DELETE ON escuelas BEGIN
+            DELETE FROM escuela_pedidos WHERE escuela_id = OLD.id;
+        END;
+        INSERT OR REPLACE INTO escuela_pedidos(escuela_id, estado, n)
+            SELECT escuela_id, COALESCE(estado, ''), COUNT(*) FROM pedidos GROUP BY escuela_id, COALESCE(estado, '')
+    """),
+    (8, "búsqueda de texto completo pedidos_fts (FTS5) + triggers", _mig_pedidos_fts),
+    (9, "columna version en pedidos/escuelas/paqueterias (ETag)", _mig_row_version),
+    (10, "auditoría de cambios de pedidos", """
+        CREATE TABLE IF NOT EXISTS pedido_auditoria (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pedido_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            user_id INTEGER,
+            campo TEXT NOT NULL,        -- estado | paqueteria
+            antes TEXT,
+            despues TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_pedido_auditoria_pedido ON pedido_auditoria(pedido_id, ts);
+    """),
+    (11, "historial de estados pedido_estado_log + triggers", _mig_estado_log),
+    # cola de trabajos: `disponible_en` es cuándo puede correr (pendiente) o cuándo vence la visibilidad
+    # del worker que lo tomó (corriendo); la llave evita duplicados mientras hay uno pendiente
+    (12, "cola de trabajos jobs + índice de password_resets", """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            estado TEXT NOT NULL DEFAULT 'pendiente' CHECK(estado IN ('pendiente','corriendo','hecho','muerto')),
+            intentos INTEGER NOT NULL DEFAULT 0,
+            max_intentos INTEGER NOT NULL,
+            disponible_en TEXT NOT NULL,
+            llave TEXT,
+            worker TEXT,
+            error TEXT,
+            resultado TEXT,
+            creado TEXT NOT NULL,
+            terminado TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_cola ON jobs(disponible_en) WHERE estado IN ('pendiente','corriendo');
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_llave ON jobs(llave) WHERE estado = 'pendiente';
+        CREATE INDEX IF NOT EXISTS idx_jobs_estado ON jobs(estado, id);
+        CREATE INDEX IF NOT EXISTS idx_password_resets_user ON password_resets(user_id)
+    """),
+    # importación de pedidos: la llave del cliente hace idempotente el reintento; importacion_pedidos
+    # se escribe en la misma transacción que cada lote, así un reintento salta lo que ya entró
+    (13, "importaciones de pedidos (CSV/XLSX) con llave de idempotencia", """
+        CREATE TABLE IF NOT EXISTS importaciones (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            llave TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            archivo TEXT,
+            estado TEXT NOT NULL DEFAULT 'procesando' CHECK(estado IN ('procesando','hecho')),
+            filas INTEGER,
+            pedidos INTEGER,
+            reporte TEXT,
+            creado TEXT NOT NULL,
+            terminado TEXT,
+            UNIQUE(user_id, llave)
+        );
+        CREATE TABLE IF NOT EXISTS importacion_pedidos (
+            importacion_id INTEGER NOT NULL,
+            ref TEXT NOT NULL,          -- escuela_id:pedido del archivo
+            pedido_id INTEGER NOT NULL,
+            PRIMARY KEY (importacion_id, ref)
+        ) WITHOUT ROWID
+    """),
+    # consultas de request que ordenaban/agrupaban con un sort temporal (bench.py plans las revisa todas)
+    (14, "índices de escuelas por nombre y de jobs por tipo/estado", """
+        CREATE INDEX IF NOT EXISTS idx_escuelas_nombre ON escuelas(nombre);
+        CREATE INDEX IF NOT EXISTS idx_jobs_tipo_estado ON jobs(tipo, estado, creado)
+    """),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def seed_demo(db):
+    # --- datos demo (sólo en BD nueva) ---
+    def ins(q, args):
+        return db.execute(q, args).lastrowid
+    admin_id = ins(
+        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
+        ("Admin", "admin@demo.local", generate_password_hash("admin123"), "admin")
+    )
+    vend_id = ins(
+        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
+        ("Vendedora Demo", "vendedora@demo.local", generate_password_hash("demo123"), "vendedora")
+    )
+    esc_user_id = ins(
+        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
+        ("Escuela Demo", "escuela@demo.local", generate_password_hash("demo123"), "escuela")
+    )
+    paq_id = ins("INSERT INTO paqueterias(nombre,activa) VALUES(?,1)", ("Estafeta",))
+    ins("INSERT INTO paqueterias(nombre,activa) VALUES(?,1)", ("DHL",))
+
+    esc_id = ins("""
+        INSERT INTO escuelas(nombre,ciudad,grado,contacto,telefono,user_id,vendedora_id, estado)
+        VALUES(?,?,?,?,?,?,?,?)
+    """, ("Colegio Benito Juárez", "Guadalajara", "Primaria", "Mtra. López", "3312345678", esc_user_id, vend_id, "Jalisco"))
+
+    ninas = [{"nombre":"Ana","color_pelo":"Castaño","calceta":"Blanca"}]
+    ninos = [{"nombre":"Leo","color_pelo":"Castaño","calceta":"Negra"}]
+
+    pedido_id = ins("""
+        INSERT INTO pedidos(escuela_id,ciudad,grado,ninas_json,ninos_json,comentario,estado,paqueteria_id,created_at,
+                            color_calceta_ninas,color_zapato_ninas,color_zapato_ninos,color_monos,color_pantalon,
+                            escudos_bordar,fechas_entrega,entrega)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    """, (esc_id, "Guadalajara", "Primaria", json.dumps(ninas, ensure_ascii=False), json.dumps(ninos, ensure_ascii=False), "Pedido de muestra", "Nuevo", paq_id, datetime.utcnow().isoformat(),
+          "Blanca", "Negro", "Negro", "Azul marino", "Azul marino", 5, json.dumps(["25/05/2026","15/06/2026"]), "Ocurre"))
+    db.executemany(ITEM_INSERT, item_rows(pedido_id, "ninas", ninas) + item_rows(pedido_id, "ninos", ninos))
+    # el rollup se mantiene en Python (no por trigger): la migración 6 ya corrió con la BD vacía
+    rollup_pedido(db, pedido_id, +1)
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(path=None, log=None):
+    """Aplica migraciones pendientes. Devuelve (versión_anterior, versión_actual).
+
+    Seguro ante varios workers arrancando a la vez: BEGIN IMMEDIATE toma el lock de
+    escritura y la versión se vuelve a leer ya dentro de él, así que sólo un proceso
+    aplica cada migración; los demás esperan (timeout) y encuentran la BD al día.
+    """
+    db = connect_db(path)
+    db.isolation_level = None   # transacción manual: el DDL de SQLite es transaccional
+    try:
+        before = schema_version(db)
+        if before >= SCHEMA_VERSION:
+            return before, before
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            before = schema_version(db)
+            fresh = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is None
+            if fresh:
+                init_db(db)
+            for version, desc, step in MIGRATIONS:
+                if version <= before:
+                    continue
+                if log: log(f"  -> {version:03d} {desc}")
+                if callable(step):
+                    step(db)
+                else:
+                    for stmt in split_sql(step):
+                        db.execute(stmt)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            if fresh:
+                seed_demo(db)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return before, SCHEMA_VERSION
+    finally:
+        db.close()
 
 # ------------ App Flask ------------
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.secret_key = os.getenv("SECRET_KEY", "dev_secret_change_me")
 app.teardown_appcontext(close_db)
 
+# Plantillas compiladas en disco: un worker nuevo las carga en vez de compilarlas ("" = sin caché)
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", os.path.join(BASE_DIR, "cache", "jinja"))
+if JINJA_CACHE_DIR:
+    try:
+        os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+        from jinja2 import FileSystemBytecodeCache
+        app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(JINJA_CACHE_DIR)}
+    except OSError:
+        pass
+
+# ------------ Caché TTL con invalidación por tabla ------------
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_DB  = os.getenv("CACHE_DB", "")   # ruta a un .db local → caché compartida entre workers
+CACHE_MAX = int(os.getenv("CACHE_MAX", "1000"))   # entradas en memoria; al llenarse se purgan las vencidas y las más viejas
+
+class TTLCache:
+    """Caché con TTL; cada entrada lleva etiquetas (tablas) para invalidarla al escribir.
+
+    Sin `path` vive en memoria del proceso (otros workers la ven vieja hasta el TTL), con a lo más
+    `max_entries` entradas; con `path` los valores (JSON) se guardan en un SQLite local que comparten
+    todos, y las filas vencidas se borran cada PURGA_CADA escrituras.
+    """
+    PURGA_CADA = 100
+
+    def __init__(self, ttl=CACHE_TTL, path=None, max_entries=CACHE_MAX):
+        self.ttl = ttl
+        self.path = path or None
+        self.max_entries = max_entries
+        self._data = {}                 # key -> (expira, tags, valor), en orden de escritura
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sets = 0
+        self.hits = self.misses = self.invalidations = self.evictions = 0
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, tags TEXT, value TEXT, expires REAL)")
+            self._local.db = db
+        return db
+
+    def _get(self, key, now):
+        if self.path:
+            row = self._db().execute("SELECT value FROM cache WHERE key=? AND expires>?", (key, now)).fetchone()
+            return (True, json.loads(row[0])) if row else (False, None)
+        with self._lock:
+            hit = self._data.get(key)
+        return (True, hit[2]) if hit and hit[0] > now else (False, None)
+
+    def _set(self, key, value, tags, expires):
+        if self.path:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO cache(key,tags,value,expires) VALUES(?,?,?,?)",
+                       (key, " " + " ".join(tags) + " ", json.dumps(value, default=str), expires))
+            with self._lock:
+                self._sets += 1
+                purgar = self._sets % self.PURGA_CADA == 0
+            if purgar:
+                db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        else:
+            with self._lock:
+                self._data.pop(key, None)
+                if len(self._data) >= self.max_entries:
+                    self._purge(time.time())
+                self._data[key] = (expires, frozenset(tags), value)
+
+    def _purge(self, now):
+        """Con el lock tomado: fuera las vencidas y, si no alcanza, las escritas hace más tiempo."""
+        vencidas = [k for k, v in self._data.items() if v[0] <= now]
+        for k in vencidas:
+            del self._data[k]
+        viejas = list(self._data)[:max(len(self._data) - self.max_entries + 1, 0)]
+        for k in viejas:
+            del self._data[k]
+        self.evictions += len(vencidas) + len(viejas)
+
+    def cached(self, key, loader, tags=(), ttl=None):
+        now = time.time()
+        found, value = self._get(key, now)
+        with self._lock:
+            if found: self.hits += 1
+            else: self.misses += 1
+        if not found:
+            value = loader()
+            self._set(key, value, tags, now + (self.ttl if ttl is None else ttl))
+        return value
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        with self._lock:
+            self.invalidations += 1
+            if not self.path:
+                for k in [k for k, v in self._data.items() if v[1] & set(tags)]:
+                    del self._data[k]
+        if self.path:
+            for t in tags:
+                self._db().execute("DELETE FROM cache WHERE tags LIKE ?", (f"% {t} %",))
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += 1
+            self._data.clear()
+        if self.path:
+            self._db().execute("DELETE FROM cache")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                    "evictions": self.evictions, "hit_ratio": round(self.hits / total, 4) if total else None,
+                    "entries": None if self.path else len(self._data), "max_entries": self.max_entries,
+                    "shared": bool(self.path), "ttl": self.ttl}
+
+CACHE = TTLCache(path=CACHE_DB)
+DB_POOL.on_reset.append(CACHE.clear)   # tras restaurar nada de la caché sirve
+
+_WRITE_RE = re.compile(r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(\w+)", re.I)
+
+def written_table(q):
+    m = _WRITE_RE.match(q)
+    return m.group(1).lower() if m else None
+
 # ------------ Helpers SQL ------------
 def query_one(q, args=()):
+    if METRICS_ENABLED:
+        return _timed_fetch(q, args, one=True)
     return get_db().execute(q, args).fetchone()
 
 def query_all(q, args=()):
+    if METRICS_ENABLED:
+        return _timed_fetch(q, args)
     return get_db().execute(q, args).fetchall()
 
-def execute(q, args=()):
+def _timed_fetch(q, args, one=False):
+    # execute() ya se contó en InstrumentedConnection; aquí se agrega el fetch y las filas
+    cur = get_db().execute(q, args)
+    t0 = time.perf_counter()
+    rows = cur.fetchone() if one else cur.fetchall()
+    m = g.get("_sqlm") if has_request_context() else None
+    if m is not None:
+        m["time"] += time.perf_counter() - t0
+        m["rows"] += (1 if rows is not None else 0) if one else len(rows)
+    return rows
+
+TX_RETRIES = int(os.getenv("TX_RETRIES", "5"))
+TX_BACKOFF = float(os.getenv("TX_BACKOFF", "0.05"))  # segundos; se duplica en cada reintento
+
+def _is_busy(e):
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+@contextmanager
+def transaction():
+    """Unidad de trabajo: todo el bloque va en un solo BEGIN IMMEDIATE … COMMIT.
+
+    El candado de escritura se toma al inicio; si otro proceso lo tiene (SQLITE_BUSY aun
+    después de busy_timeout) se reintenta con backoff exponencial. Al confirmar se invalidan
+    las etiquetas de caché de las tablas escritas con execute()/execute_many(). Las
+    transacciones anidadas se unen a la exterior.
+    """
     db = get_db()
-    cur = db.execute(q, args)
-    db.commit()
+    if g.get("_tx_tables") is not None:
+        yield db
+        return
+    for attempt in range(TX_RETRIES + 1):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == TX_RETRIES:
+                raise
+            time.sleep(TX_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+    g._tx_tables = tables = set()
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        g.pop("_tx_tables", None)
+    if tables:
+        CACHE.invalidate(*tables)
+
+def _tx_written(q):
+    table = written_table(q)
+    if table:
+        g._tx_tables.add(table)
+
+def execute(q, args=()):
+    with transaction() as db:
+        cur = db.execute(q, args)
+        _tx_written(q)
     return cur.lastrowid
 
+def execute_many(q, seq):
+    with transaction() as db:
+        db.executemany(q, seq)
+        _tx_written(q)
+
+# ------------ Alumnos del pedido (pedido_items) ------------
+GRUPOS = ("ninas", "ninos")
+ITEM_INSERT = "INSERT INTO pedido_items(pedido_id,grupo,pos,nombre,color_pelo,calceta) VALUES(?,?,?,?,?,?)"
+
+def parse_json_list(js):
+    try: return json.loads(js) if js else []
+    except Exception: return []
+
+def item_rows(pedido_id, grupo, items):
+    return [(pedido_id, grupo, i, it.get("nombre",""), it.get("color_pelo",""), it.get("calceta"))
+            for i, it in enumerate(items)]
+
+def pedido_items(p, rows=None):
+    """(ninas, ninos) del pedido en una sola consulta indexada (o de `rows` ya leídas, p. ej. del archivo).
+
+    Si el pedido aún no pasó por el backfill, cae al JSON de la fila.
+    """
+    if rows is None:
+        rows = query_all(
+            "SELECT grupo, nombre, color_pelo, calceta FROM pedido_items WHERE pedido_id=? ORDER BY grupo, pos",
+            (p["id"],))
+    if not rows:
+        return parse_json_list(p["ninas_json"]), parse_json_list(p["ninos_json"])
+    out = {g: [] for g in GRUPOS}
+    for r in rows:
+        out[r["grupo"]].append({"nombre": r["nombre"], "color_pelo": r["color_pelo"], "calceta": r["calceta"]})
+    return out["ninas"], out["ninos"]
+
+def pedidos_items_map(rows):
+    """{pedido_id: (ninas, ninos)} para muchos pedidos con una sola consulta."""
+    out = {r["id"]: ([], []) for r in rows}
+    for it in query_all(
+            "SELECT pedido_id, grupo, nombre, color_pelo, calceta FROM pedido_items "
+            "WHERE pedido_id IN (SELECT value FROM json_each(?)) ORDER BY pedido_id, grupo, pos",
+            (json.dumps(list(out)),)):
+        out[it["pedido_id"]][GRUPOS.index(it["grupo"])].append(
+            {"nombre": it["nombre"], "color_pelo": it["color_pelo"], "calceta": it["calceta"]})
+    for r in rows:
+        if not any(out[r["id"]]):
+            out[r["id"]] = (parse_json_list(r["ninas_json"]), parse_json_list(r["ninos_json"]))
+    return out
+
+def backfill_items(batch=500, pause=0.05, log=None):
+    """Copia ninas_json/ninos_json a pedido_items por lotes cortos (idempotente)."""
+    db = connect_db()
+    db.isolation_level = None
+    last_id, total = 0, 0
+    try:
+        while True:
+            rows = db.execute(
+                "SELECT id, ninas_json, ninos_json FROM pedidos WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch)).fetchall()
+            if not rows:
+                break
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                done = {r[0] for r in db.execute(
+                    "SELECT DISTINCT pedido_id FROM pedido_items WHERE pedido_id BETWEEN ? AND ?",
+                    (rows[0]["id"], rows[-1]["id"]))}
+                items = []
+                for r in rows:
+                    if r["id"] not in done:
+                        for grupo in GRUPOS:
+                            items += item_rows(r["id"], grupo, parse_json_list(r[f"{grupo}_json"]))
+                db.executemany(ITEM_INSERT, items)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            total += len(items)
+            last_id = rows[-1]["id"]
+            if log: log(f"  pedidos hasta #{last_id}: {total} alumnos")
+            time.sleep(pause)   # cede el lock de escritura a los requests
+    finally:
+        db.close()
+    return total
+
+# ------------ Rollup de producción ------------
+# Piezas que aporta cada pedido, por concepto y color. Los alumnos se cuentan de
+# pedido_items (o del JSON si el pedido aún no pasó por el backfill).
+PRODUCCION_PIEZAS_SQL = """
+    WITH c AS (
+        SELECT p.estado,
+               CASE WHEN json_valid(p.fechas_entrega) THEN COALESCE(json_extract(p.fechas_entrega, '$[0]'), '') ELSE '' END AS f,
+               p.color_calceta_ninas, p.color_zapato_ninas, p.color_zapato_ninos, p.color_monos, p.color_pantalon,
+               COALESCE(p.escudos_bordar, 0) AS escudos,
+               CASE WHEN EXISTS(SELECT 1 FROM pedido_items i WHERE i.pedido_id = p.id)
+                    THEN (SELECT COUNT(*) FROM pedido_items i WHERE i.pedido_id = p.id AND i.grupo = 'ninas')
+                    WHEN json_valid(p.ninas_json) THEN json_array_length(p.ninas_json) ELSE 0 END AS ninas,
+               CASE WHEN EXISTS(SELECT 1 FROM pedido_items i WHERE i.pedido_id = p.id)
+                    THEN (SELECT COUNT(*) FROM pedido_items i WHERE i.pedido_id = p.id AND i.grupo = 'ninos')
+                    WHEN json_valid(p.ninos_json) THEN json_array_length(p.ninos_json) ELSE 0 END AS ninos
+        FROM pedidos p {where}
+    ), c2 AS (
+        -- dd/mm/aaaa → aaaa-mm-dd para que la PK del rollup quede en orden cronológico
+        SELECT *, CASE WHEN f GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+                       THEN substr(f, 7, 4) || '-' || substr(f, 4, 2) || '-' || substr(f, 1, 2) ELSE f END AS fecha
+        FROM c
+    ), piezas AS (
+        SELECT fecha, COALESCE(estado,'') AS estado, 'calceta_ninas' AS concepto, COALESCE(color_calceta_ninas,'') AS color, ninas AS n FROM c2
+        UNION ALL SELECT fecha, COALESCE(estado,''), 'zapato_ninas', COALESCE(color_zapato_ninas,''), ninas FROM c2
+        UNION ALL SELECT fecha, COALESCE(estado,''), 'zapato_ninos', COALESCE(color_zapato_ninos,''), ninos FROM c2
+        UNION ALL SELECT fecha, COALESCE(estado,''), 'monos', COALESCE(color_monos,''), ninas FROM c2
+        UNION ALL SELECT fecha, COALESCE(estado,''), 'pantalon', COALESCE(color_pantalon,''), ninos FROM c2
+        UNION ALL SELECT fecha, COALESCE(estado,''), 'escudos', '', escudos FROM c2
+    )
+    SELECT fecha, estado, concepto, color, SUM(n) * ? AS piezas, COUNT(*) * ? AS pedidos
+    FROM piezas WHERE n > 0
+    GROUP BY fecha, estado, concepto, color
+"""
+PRODUCCION_CONCEPTOS = ["calceta_ninas","zapato_ninas","zapato_ninos","monos","pantalon","escudos"]
+
+def rollup_pedido(db, pedido_id, sign):
+    """Suma (+1) o resta (-1) la aportación de un pedido al rollup, dentro de la transacción actual.
+
+    Para mover un pedido de grupo (p. ej. cambio de estado): restar, escribir, sumar.
+    """
+    rollup_pedidos(db, [pedido_id], sign)
+
+def rollup_pedidos(db, ids, sign):
+    """rollup_pedido para varios pedidos en una sola sentencia (cambios por lote)."""
+    db.execute(f"""
+        INSERT INTO produccion_rollup(fecha, estado, concepto, color, piezas, pedidos)
+        SELECT * FROM ({PRODUCCION_PIEZAS_SQL.format(where="WHERE p.id IN (SELECT value FROM json_each(?))")}) WHERE 1
+        ON CONFLICT(fecha, estado, concepto, color) DO UPDATE SET
+            piezas = piezas + excluded.piezas, pedidos = pedidos + excluded.pedidos
+    """, (json.dumps(list(ids)), sign, sign))
+    if sign < 0:
+        db.execute("DELETE FROM produccion_rollup WHERE pedidos <= 0")
+
+def rebuild_produccion(db):
+    """Recalcula el rollup completo (migración / reparación)."""
+    db.execute("DELETE FROM produccion_rollup")
+    db.execute(f"""
+        INSERT INTO produccion_rollup(fecha, estado, concepto, color, piezas, pedidos)
+        {PRODUCCION_PIEZAS_SQL.format(where="")}
+    """, (1, 1))
+
+ESCUELA_PEDIDOS_REAL = """
+    -- plan: full (reparación: recorre todos los pedidos a propósito)
+    SELECT p.escuela_id, COALESCE(p.estado, '') AS estado, COUNT(*) AS n
+    FROM pedidos p JOIN escuelas e ON e.id = p.escuela_id
+    GROUP BY p.escuela_id, COALESCE(p.estado, '')
+"""
+
+def repair_escuela_counts(db):
+    """Compara escuela_pedidos contra un conteo real y lo corrige; devuelve cuántos grupos diferían."""
+    diff = db.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT * FROM ({ESCUELA_PEDIDOS_REAL}) EXCEPT SELECT escuela_id, estado, n FROM escuela_pedidos
+            UNION ALL
+            SELECT escuela_id, estado, n FROM escuela_pedidos EXCEPT SELECT * FROM ({ESCUELA_PEDIDOS_REAL})
+        )
+    """).fetchone()[0]
+    if diff:
+        db.execute("DELETE FROM escuela_pedidos")
+        db.execute(f"INSERT INTO escuela_pedidos(escuela_id, estado, n) {ESCUELA_PEDIDOS_REAL}")
+    return diff
+
+# ------------ PDFs: pool en segundo plano + caché en disco ------------
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(BASE_DIR, "cache", "pdf"))
+PDF_POOL      = os.getenv("PDF_POOL", "thread")      # thread | process
+PDF_WORKERS   = int(os.getenv("PDF_WORKERS", "2"))
+PDF_WAIT      = float(os.getenv("PDF_WAIT", "15"))   # s que el request espera antes de responder 202
+
+PDF_FIELDS = ["escuela","escuela_ciudad","escuela_grado","contacto","telefono","direccion","colonia","codigo_postal",
+              "escuela_estado","paqueteria","entrega","color_calceta_ninas","color_zapato_ninas","color_zapato_ninos",
+              "color_monos","color_pantalon","escudos_bordar","comentario"]
+
+_pdf_executor = None
+_pdf_pending = {}            # (pedido_id, key) -> Future en curso
+_pdf_lock = threading.Lock()
+
+def pdf_data(p, items=None):
+    """Todo lo que se dibuja en el PDF, como dict simple (serializable para el pool)."""
+    ninas, ninos = items if items is not None else pedido_items(p)
+    data = {f: p[f] for f in PDF_FIELDS}
+    data.update(id=p["id"], ninas=ninas, ninos=ninos, fechas=parse_json_list(p["fechas_entrega"]))
+    return data
+
+def pdf_key(data):
+    """Hash del contenido: si el pedido (o su escuela/paquetería) cambia, cambia la llave."""
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+def pdf_path(pedido_id, key):
+    return os.path.join(PDF_CACHE_DIR, f"pedido_{pedido_id}_{key}.pdf")
+
+def draw_pedido(c, p):
+    """Dibuja un pedido desde una página nueva del canvas."""
+    from reportlab.lib.pagesizes import letter
+    ninas, ninos, fechas = p["ninas"], p["ninos"], p["fechas"]
+    width, height = letter
+    y = height - 40
+    c.setFont("Helvetica-Bold", 14); c.drawString(40, y, "Pedido - Pedidos GS"); y -= 20
+    c.setFont("Helvetica", 10)
+    c.drawString(40, y, f"Escuela: {p['escuela']}  |  Ciudad: {p['escuela_ciudad']}  |  Grado: {p['escuela_grado']}"); y -= 14
+    c.drawString(40, y, f"Contacto: {p['contacto']}  Tel: {p['telefono']}"); y -= 14
+    c.drawString(40, y, f"Dirección: {p['direccion'] or ''} {p['colonia'] or ''} CP {p['codigo_postal'] or ''} {p['escuela_estado'] or ''}"); y -= 14
+    c.drawString(40, y, f"Paquetería asignada: {p['paqueteria'] or '—'}  |  Entrega: {p['entrega'] or '—'}"); y -= 14
+    c.drawString(40, y, f"Calceta niñas: {p['color_calceta_ninas'] or '—'}  Zapato niñas: {p['color_zapato_ninas'] or '—'}  Zapato niños: {p['color_zapato_ninos'] or '—'}"); y -= 14
+    c.drawString(40, y, f"Moños: {p['color_monos'] or '—'}  Pantalón: {p['color_pantalon'] or '—'}  Escudos por bordar: {p['escudos_bordar'] or '—'}"); y -= 14
+    c.drawString(40, y, f"Fechas de entrega: {', '.join(fechas) if fechas else '—'}"); y -= 20
+    def draw_group(title, arr):
+        nonlocal y
+        c.setFont("Helvetica-Bold", 12); c.drawString(40, y, title); y -= 16; c.setFont("Helvetica", 10)
+        for it in arr:
+            c.drawString(50, y, f"- {it.get('nombre','')} (Pelo: {it.get('color_pelo','')})")
+            y -= 14
+            if y < 60: c.showPage(); y = height - 40
+    draw_group("Niñas", ninas); y -= 8; draw_group("Niños", ninos)
+    y -= 8; c.setFont("Helvetica-Bold", 12); c.drawString(40, y, "Comentarios"); y -= 16; c.setFont("Helvetica", 10)
+    for line in (p["comentario"] or "").splitlines():
+        c.drawString(50, y, line[:100]); y -= 14
+        if y < 60: c.showPage(); y = height - 40
+    c.showPage()
+
+def render_pedido_pdf(p):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    draw_pedido(c, p)
+    c.save()
+    return buffer.getvalue()
+
+def render_pedidos_pdf(datas, path):
+    """Varios pedidos en un solo documento, escrito directo a `path` (corre en el pool)."""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    c = canvas.Canvas(path, pagesize=letter)
+    for p in datas:
+        draw_pedido(c, p)
+    c.save()
+    return path
+
+def _pdf_build(pedido_id, key, data):
+    """Genera y guarda el PDF (corre en el pool); borra sólo versiones viejas de este pedido."""
+    pdf = render_pedido_pdf(data)
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    path = pdf_path(pedido_id, key)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(pdf)
+    os.replace(tmp, path)
+    prefix = f"pedido_{pedido_id}_"
+    for name in os.listdir(PDF_CACHE_DIR):
+        if name.startswith(prefix) and name.endswith(".pdf") and name != os.path.basename(path):
+            try: os.remove(os.path.join(PDF_CACHE_DIR, name))
+            except OSError: pass
+    return path
+
+def pdf_executor():
+    global _pdf_executor
+    with _pdf_lock:
+        if _pdf_executor is None:
+            from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+            cls = ProcessPoolExecutor if PDF_POOL == "process" else ThreadPoolExecutor
+            _pdf_executor = cls(max_workers=PDF_WORKERS)
+        return _pdf_executor
+
+def pdf_submit(pedido_id, key, data):
+    """Encola la generación (una sola por llave aunque lleguen varios clics)."""
+    ex = pdf_executor()
+    with _pdf_lock:
+        fut = _pdf_pending.get((pedido_id, key))
+        if fut is None:
+            fut = ex.submit(_pdf_build, pedido_id, key, data)
+            _pdf_pending[(pedido_id, key)] = fut
+            fut.add_done_callback(lambda _f: _pdf_pending.pop((pedido_id, key), None))
+        return fut
+
+def pdf_prerender(*ids):
+    """Encola el PDF de los pedidos tras una escritura (en la misma transacción, si hay una); el worker
+    lo deja en el disco. Una llave por pedido: diez cambios seguidos dejan un solo trabajo pendiente."""
+    encolar_lote("pdf", [({"pedido_id": i}, f"pdf:{i}") for i in ids])
+
+# ------------ Hash de contraseñas: pool acotado ------------
+# scrypt/pbkdf2 sueltan el GIL, así que unos pocos hilos bastan. Como mucho HASH_WORKERS + HASH_QUEUE
+# requests esperan un hash a la vez (mantenerlo debajo de los hilos de waitress); el resto recibe 503.
+HASH_METHOD  = os.getenv("HASH_METHOD", "scrypt:32768:8:1")   # método completo, tal como queda en el hash
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_QUEUE   = int(os.getenv("HASH_QUEUE", "2"))
+HASH_WAIT    = float(os.getenv("HASH_WAIT", "10"))   # s máximos esperando turno + cálculo
+
+class HashOverloaded(Exception):
+    pass
+
+class HashPool:
+    def __init__(self, workers=HASH_WORKERS, queue=HASH_QUEUE, wait=HASH_WAIT):
+        self.workers, self.queue, self.wait = workers, queue, wait
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+        self._ex = None
+        self.done = self.rejected = self.timeouts = 0
+
+    def _executor(self):
+        with self._lock:
+            if self._ex is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._ex = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+            return self._ex
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashOverloaded()
+        try:
+            fut = self._executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # el cupo se libera cuando el hash termina, no cuando el request deja de esperar
+        fut.add_done_callback(lambda _f: self._slots.release())
+        from concurrent.futures import TimeoutError as FutTimeout
+        try:
+            out = fut.result(timeout=self.wait)
+        except FutTimeout:
+            with self._lock:
+                self.timeouts += 1
+            raise HashOverloaded()
+        with self._lock:
+            self.done += 1
+        return out
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, HASH_METHOD)
+
+    def shutdown(self):
+        with self._lock:
+            ex, self._ex = self._ex, None
+        if ex:
+            ex.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "queue": self.queue, "done": self.done,
+                    "rejected": self.rejected, "timeouts": self.timeouts, "method": HASH_METHOD}
+
+HASH_POOL = HashPool()
+
+def needs_rehash(pwhash):
+    return (pwhash or "").split("$", 1)[0] != HASH_METHOD
+
+_DUMMY_HASH = None
+
+def dummy_hash():
+    """Hash fijo (con HASH_METHOD) contra el que se verifica un correo que no existe: el login tarda lo
+    mismo y no revela qué correos están registrados. Se calcula en el primer uso."""
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = HASH_POOL.hash(secrets.token_hex(16))
+    return _DUMMY_HASH
+
+def _hash_overloaded(template):
+    flash("Hay muchos inicios de sesión en este momento. Intenta de nuevo en unos segundos.", "error")
+    return render_template(template), 503, {"Retry-After": "2"}
+
+# ------------ Cola de trabajos en SQLite (tabla jobs) ------------
+# Los requests sólo encolan (dentro de su propia transacción); `flask worker` los corre con reintentos,
+# tiempo de visibilidad y "muertos" (dead letters) que se revisan en /admin/jobs.
+JOB_WORKERS     = int(os.getenv("JOB_WORKERS", "2"))        # hilos por proceso de worker
+JOB_INTENTOS    = int(os.getenv("JOB_INTENTOS", "5"))
+JOB_VISIBILIDAD = float(os.getenv("JOB_VISIBILIDAD", "300"))  # s que un trabajo tomado es invisible a otros
+JOB_BACKOFF     = float(os.getenv("JOB_BACKOFF", "30"))     # s antes del 1er reintento; se duplica en cada uno
+JOB_POLL        = float(os.getenv("JOB_POLL", "1"))         # s entre consultas con la cola vacía
+JOB_RETENCION_DIAS = float(os.getenv("JOB_RETENCION_DIAS", "7"))
+JOB_ACTIVOS = "estado IN ('pendiente','corriendo')"          # igual que el WHERE de idx_jobs_cola
+
+JOB_HANDLERS = {}   # tipo -> (función, intentos, visibilidad)
+JOB_INSERT = ("INSERT OR IGNORE INTO jobs(tipo, payload, llave, max_intentos, disponible_en, creado) "
+              "VALUES (?,?,?,?,?,?)")
+
+def job_handler(tipo, intentos=None, visibilidad=None):
+    """Registra la función que corre los trabajos `tipo`; recibe el payload como kwargs y lo que
+    regrese (serializable a JSON) queda en jobs.resultado."""
+    def deco(fn):
+        JOB_HANDLERS[tipo] = (fn, intentos or JOB_INTENTOS, visibilidad or JOB_VISIBILIDAD)
+        return fn
+    return deco
+
+def _job_row(tipo, payload, llave, now):
+    return (tipo, json.dumps(payload or {}, ensure_ascii=False), llave, JOB_HANDLERS[tipo][1], now, now)
+
+def encolar(tipo, payload=None, llave=None):
+    """Agrega un trabajo y regresa su id (None si ya había uno pendiente con la misma llave).
+    Dentro de un `with transaction()` se confirma junto con la escritura que lo origina."""
+    with transaction() as db:
+        cur = db.execute(JOB_INSERT, _job_row(tipo, payload, llave, datetime.utcnow().isoformat()))
+        _tx_written(JOB_INSERT)
+    return cur.lastrowid if cur.rowcount else None
+
+def encolar_lote(tipo, items):
+    """Varios trabajos del mismo tipo en una sentencia: items = [(payload, llave), …]."""
+    now = datetime.utcnow().isoformat()
+    execute_many(JOB_INSERT, [_job_row(tipo, payload, llave, now) for payload, llave in items])
+
+def tomar_job(worker):
+    """Toma el trabajo disponible más antiguo y lo hace invisible por su tiempo de visibilidad.
+
+    Un trabajo 'corriendo' cuya visibilidad venció (el worker murió o se pasó de tiempo) vuelve a
+    tomarse; si ya agotó sus intentos, o nadie sabe correr su tipo, pasa a 'muerto'.
+    """
+    now = datetime.utcnow()
+    with transaction() as db:
+        while True:
+            # INDEXED BY: el índice parcial ya viene en orden; por (estado, id) haría falta un sort
+            r = db.execute(f"""SELECT * FROM jobs INDEXED BY idx_jobs_cola WHERE {JOB_ACTIVOS} AND disponible_en <= ?
+                               ORDER BY disponible_en LIMIT 1""", (now.isoformat(),)).fetchone()
+            if r is None:
+                return None
+            handler = JOB_HANDLERS.get(r["tipo"])
+            if handler is None or (r["estado"] == "corriendo" and r["intentos"] >= r["max_intentos"]):
+                error = "tipo desconocido" if handler is None else f"visibilidad vencida ({r['worker']})"
+                execute("UPDATE jobs SET estado = 'muerto', error = ?, terminado = ? WHERE id = ?",
+                        (error, now.isoformat(), r["id"]))
+                continue
+            hasta = (now + timedelta(seconds=handler[2])).isoformat()
+            execute("""UPDATE jobs SET estado = 'corriendo', intentos = intentos + 1, disponible_en = ?, worker = ?
+                       WHERE id = ?""", (hasta, worker, r["id"]))
+            return dict(r, estado="corriendo", intentos=r["intentos"] + 1, worker=worker)
+
+def terminar_job(job, resultado=None, error=None):
+    """Cierra el intento: 'hecho', reintento con backoff exponencial o 'muerto'.
+
+    Sólo escribe si el trabajo sigue siendo de este worker y este intento: si la visibilidad venció
+    y otro lo tomó, el resultado tardío se descarta. Un reintento que choca con un duplicado
+    pendiente (misma llave) lo reemplaza.
+    """
+    now = datetime.utcnow()
+    mio = (job["id"], job["worker"], job["intentos"])
+    if error is None:
+        execute("""UPDATE jobs SET estado = 'hecho', resultado = ?, error = NULL, terminado = ?
+                   WHERE id = ? AND worker = ? AND intentos = ? AND estado = 'corriendo'""",
+                (json.dumps(resultado, ensure_ascii=False, default=str), now.isoformat(), *mio))
+    elif job["intentos"] >= job["max_intentos"]:
+        execute("""UPDATE jobs SET estado = 'muerto', error = ?, terminado = ?
+                   WHERE id = ? AND worker = ? AND intentos = ? AND estado = 'corriendo'""",
+                (error, now.isoformat(), *mio))
+    else:
+        espera = JOB_BACKOFF * 2 ** (job["intentos"] - 1) * random.uniform(0.8, 1.2)
+        execute("""UPDATE OR REPLACE jobs SET estado = 'pendiente', error = ?, disponible_en = ?
+                   WHERE id = ? AND worker = ? AND intentos = ? AND estado = 'corriendo'""",
+                (error, (now + timedelta(seconds=espera)).isoformat(), *mio))
+
+def correr_job(job):
+    import traceback
+    fn = JOB_HANDLERS[job["tipo"]][0]
+    try:
+        resultado = fn(**json.loads(job["payload"] or "{}"))
+    except Exception as e:
+        app.logger.warning("job %s (%s) intento %s falló: %s", job["id"], job["tipo"], job["intentos"], e)
+        terminar_job(job, error=traceback.format_exc(limit=5)[-2000:])
+        return False
+    terminar_job(job, resultado)
+    return True
+
+def purgar_jobs(dias=JOB_RETENCION_DIAS):
+    """Borra los trabajos terminados hace más de `dias` y los archivos de exportación igual de viejos.
+    Los muertos se quedan hasta que un admin los reintente."""
+    corte = datetime.utcnow() - timedelta(days=dias)
+    with transaction() as db:
+        n = db.execute("DELETE FROM jobs WHERE estado = 'hecho' AND terminado < ?", (corte.isoformat(),)).rowcount
+    if os.path.isdir(EXPORT_DIR):
+        for name in os.listdir(EXPORT_DIR):
+            path = os.path.join(EXPORT_DIR, name)
+            try:
+                if os.path.getmtime(path) < corte.timestamp():
+                    os.remove(path)
+            except OSError:
+                pass
+    return n
+
+def _worker_loop(nombre, stop, once):
+    while not stop.is_set():
+        with app.app_context():
+            job = tomar_job(nombre)
+            if job is not None:
+                correr_job(job)
+                continue
+        if once:
+            return
+        stop.wait(JOB_POLL)
+
+def run_worker(hilos=JOB_WORKERS, once=False, stop=None, log=None):
+    """Corre `hilos` workers en este proceso hasta SIGTERM/SIGINT (o, con once, hasta vaciar la cola).
+    Cada trabajo en curso termina antes de salir; si el proceso muere, la visibilidad lo libera."""
+    import signal, socket
+    stop = stop or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_a: stop.set())
+    ensure_db()
+    with app.app_context():
+        purgados = purgar_jobs()
+        programar_archivo()
+        programar_respaldo()
+    base = f"{socket.gethostname()}:{os.getpid()}"
+    if log: log(f"worker {base}: {hilos} hilo(s), {purgados} trabajo(s) viejo(s) purgado(s)")
+    threads = [threading.Thread(target=_worker_loop, args=(f"{base}:{i}", stop, once), name=f"job-{i}", daemon=True)
+               for i in range(hilos)]
+    for t in threads:
+        t.start()
+    ultima_purga = time.monotonic()
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(0.5)
+        if time.monotonic() - ultima_purga > 3600:
+            with app.app_context():
+                purgar_jobs()
+                programar_archivo()
+                programar_respaldo()
+            ultima_purga = time.monotonic()
+
+def jobs_resumen():
+    counts = query_all("""
+        SELECT tipo, estado, COUNT(*) AS n, MIN(creado) AS mas_viejo FROM jobs GROUP BY tipo, estado
+    """)
+    muertos = query_all("""SELECT id, tipo, payload, intentos, error, creado, terminado FROM jobs
+                           WHERE estado = 'muerto' ORDER BY id DESC LIMIT 100""")
+    return {"conteos": [dict(r) for r in counts], "muertos": [dict(r) for r in muertos]}
+
+@job_handler("pdf")
+def _job_pdf(pedido_id):
+    p = query_one(PEDIDO_DETALLE_SQL, (pedido_id,))
+    if not p:
+        return None
+    data = pdf_data(p)
+    key = pdf_key(data)
+    if not os.path.exists(pdf_path(pedido_id, key)):
+        _pdf_build(pedido_id, key, data)
+    return {"key": key}
+
+# ------------ Correo: backend enchufable (archivo local por defecto) ------------
+MAIL_BACKEND = os.getenv("MAIL_BACKEND", "file")   # file | smtp | modulo:funcion(msg)
+MAIL_DIR     = os.getenv("MAIL_DIR", os.path.join(BASE_DIR, "cache", "mail"))
+MAIL_FROM    = os.getenv("MAIL_FROM", "Pedidos GS <no-responder@localhost>")
+
+def _mail_file(msg):
+    """Guarda el mensaje como .eml en MAIL_DIR (desarrollo, o para que otro proceso lo despache)."""
+    os.makedirs(MAIL_DIR, exist_ok=True)
+    path = os.path.join(MAIL_DIR, f"{datetime.utcnow():%Y%m%d_%H%M%S}_{generate_token(8)}.eml")
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(msg.as_bytes())
+    os.replace(f"{path}.tmp", path)
+    return path
+
+def _mail_smtp(msg):
+    import smtplib
+    host, port = os.getenv("SMTP_HOST", "localhost"), int(os.getenv("SMTP_PORT", "587"))
+    with smtplib.SMTP(host, port, timeout=30) as s:
+        if os.getenv("SMTP_TLS", "1") not in ("0", "false", "no"):
+            s.starttls()
+        if os.getenv("SMTP_USER"):
+            s.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASSWORD", ""))
+        s.send_message(msg)
+
+MAIL_BACKENDS = {"file": _mail_file, "smtp": _mail_smtp}
+
+def enviar_correo(to, asunto, texto):
+    from email.message import EmailMessage
+    msg = EmailMessage()
+    msg["From"], msg["To"], msg["Subject"] = MAIL_FROM, to, asunto
+    msg.set_content(texto)
+    backend = MAIL_BACKENDS.get(MAIL_BACKEND)
+    if backend is None:
+        import importlib
+        mod, _, fn = MAIL_BACKEND.partition(":")
+        backend = getattr(importlib.import_module(mod), fn)
+    return backend(msg)
+
+@job_handler("correo")
+def _job_correo(user_id, asunto, texto):
+    u = query_one("SELECT name, email FROM users WHERE id = ?", (user_id,))
+    if not u:
+        return None   # el usuario se borró mientras esperaba
+    enviar_correo(u["email"], asunto, texto)
+    return {"to": u["email"]}
+
+# ------------ Archivo por temporada: pedidos cerrados en una BD aparte ------------
+# Los pedidos Entregado/Cancelado desde hace más de ARCHIVO_DIAS pasan, con sus alumnos e historial, a
+# archivo/pedidos_<temporada>.db. La app sólo hace ATTACH de ese archivo en las consultas históricas,
+# en una conexión propia: las del pool nunca lo llevan.
+ARCHIVO_DIR   = os.getenv("ARCHIVO_DIR", os.path.join(BASE_DIR, "archivo"))
+ARCHIVO_DIAS  = float(os.getenv("ARCHIVO_DIAS", "180"))   # días en estado final antes de archivar
+ARCHIVO_LOTE  = int(os.getenv("ARCHIVO_LOTE", "500"))
+ARCHIVO_CADA_HORAS = float(os.getenv("ARCHIVO_CADA_HORAS", "0"))   # el worker lo encola; 0 = sólo a mano
+TEMPORADA_MES = int(os.getenv("TEMPORADA_MES", "8"))   # la temporada N va de este mes del año N-1 al anterior de N
+
+# (tabla, columna que la liga al pedido), padres primero
+ARCHIVO_TABLAS = (("pedidos", "id"), ("pedido_items", "pedido_id"),
+                  ("pedido_estado_log", "pedido_id"), ("pedido_auditoria", "pedido_id"))
+ARCHIVO_INDICES = """
+    CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_pedidos_id ON pedidos(id);
+    CREATE INDEX IF NOT EXISTS arch.idx_pedidos_created ON pedidos(created_at, id);
+    CREATE INDEX IF NOT EXISTS arch.idx_pedidos_escuela_created ON pedidos(escuela_id, created_at);
+    CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_pedido_items_id ON pedido_items(id);
+    CREATE INDEX IF NOT EXISTS arch.idx_pedido_items_pedido ON pedido_items(pedido_id, grupo, pos);
+    CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_pedido_estado_log_id ON pedido_estado_log(id);
+    CREATE INDEX IF NOT EXISTS arch.idx_pedido_estado_log_pedido ON pedido_estado_log(pedido_id, ts);
+    CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_pedido_auditoria_id ON pedido_auditoria(id);
+    CREATE INDEX IF NOT EXISTS arch.idx_pedido_auditoria_pedido ON pedido_auditoria(pedido_id, ts)
+"""
+
+def temporada(created_at):
+    try:
+        y, m = int(created_at[:4]), int(created_at[5:7])
+    except (TypeError, ValueError):
+        y, m = datetime.utcnow().year, datetime.utcnow().month
+    return y + 1 if m >= TEMPORADA_MES else y
+
+def archivo_path(temp):
+    return os.path.join(ARCHIVO_DIR, f"pedidos_{int(temp)}.db")
+
+def temporadas_archivadas():
+    if not os.path.isdir(ARCHIVO_DIR):
+        return []
+    return sorted((int(m.group(1)) for m in map(re.compile(r"^pedidos_(\d{4})\.db$").match, os.listdir(ARCHIVO_DIR)) if m),
+                  reverse=True)
+
+def _archivo_esquema(db):
+    """Tablas del archivo adjunto (`arch`) con las columnas del vivo; las que el vivo ganó después se agregan."""
+    for t, _ in ARCHIVO_TABLAS:
+        db.execute(f"CREATE TABLE IF NOT EXISTS arch.{t} AS SELECT * FROM main.{t} WHERE 0")
+        tiene = {r[1] for r in db.execute(f"PRAGMA arch.table_info({t})")}
+        for r in db.execute(f"PRAGMA main.table_info({t})").fetchall():
+            if r[1] not in tiene:
+                db.execute(f"ALTER TABLE arch.{t} ADD COLUMN {r[1]}")
+    for stmt in split_sql(ARCHIVO_INDICES):
+        db.execute(stmt)
+
+def _archivar_lote(db, temp, ids, corte, finales):
+    """Un lote de una temporada; regresa los ids que salieron del vivo.
+
+    Dos transacciones: la copia sólo escribe en el archivo y el borrado sólo en el vivo. Con WAL, SQLite
+    no garantiza que un COMMIT sobre dos BDs sea atómico; así, si algo falla a la mitad, el pedido queda
+    en ambas y la siguiente corrida lo termina (la copia es INSERT OR REPLACE). Sólo se borra lo que no
+    cambió desde la copia (misma versión y todavía cerrado).
+    """
+    ids_js = json.dumps(ids)
+    db.execute("ATTACH DATABASE ? AS arch", (archivo_path(temp),))
+    try:
+        _archivo_esquema(db)
+        db.execute("BEGIN")
+        try:
+            for t, col in ARCHIVO_TABLAS:
+                cols = ", ".join(r[1] for r in db.execute(f"PRAGMA main.table_info({t})"))
+                db.execute(f"INSERT OR REPLACE INTO arch.{t}({cols}) SELECT {cols} FROM main.{t} "
+                           f"WHERE {col} IN (SELECT value FROM json_each(?))", (ids_js,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            ok = [r[0] for r in db.execute("""
+                SELECT p.id FROM main.pedidos p JOIN arch.pedidos a ON a.id = p.id AND a.version = p.version
+                WHERE p.id IN (SELECT value FROM json_each(?))
+                  AND p.estado IN (SELECT value FROM json_each(?)) AND p.estado_desde < ?
+            """, (ids_js, finales, corte))]
+            if ok:
+                ok_js = json.dumps(ok)
+                rollup_pedidos(db, ok, -1)
+                for t, col in reversed(ARCHIVO_TABLAS):
+                    db.execute(f"DELETE FROM main.{t} WHERE {col} IN (SELECT value FROM json_each(?))", (ok_js,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        # lo que cambió (o se borró) entre la copia y el borrado no se queda duplicado en el archivo
+        viejos = json.dumps(sorted(set(ids) - set(ok)))
+        if viejos != "[]":
+            for t, col in ARCHIVO_TABLAS:
+                db.execute(f"DELETE FROM arch.{t} WHERE {col} IN (SELECT value FROM json_each(?))", (viejos,))
+    finally:
+        db.execute("DETACH DATABASE arch")
+    return ok
+
+def archivar(dias=ARCHIVO_DIAS, antes=None, lote=ARCHIVO_LOTE, pause=0.05, dry_run=False, log=None):
+    """Mueve al archivo de su temporada los pedidos cerrados antes de `antes` (o hace `dias` días).
+    Regresa {temporada: pedidos}; con dry_run sólo cuenta."""
+    corte = (antes or datetime.utcnow() - timedelta(days=dias)).isoformat()
+    finales = json.dumps(ESTADOS_FINALES)
+    candidatos = "SELECT id, created_at FROM pedidos WHERE estado IN (SELECT value FROM json_each(?)) AND estado_desde < ?"
+    db = connect_db()
+    db.isolation_level = None
+    total, movidos = {}, set()
+    try:
+        if dry_run:
+            for r in db.execute(candidatos, (finales, corte)):
+                t = temporada(r["created_at"])
+                total[t] = total.get(t, 0) + 1
+            return total
+        os.makedirs(ARCHIVO_DIR, exist_ok=True)
+        while True:
+            rows = db.execute(candidatos + " LIMIT ?", (finales, corte, lote)).fetchall()
+            por_temp = {}
+            for r in rows:
+                por_temp.setdefault(temporada(r["created_at"]), []).append(r["id"])
+            n = 0
+            for temp, ids in sorted(por_temp.items()):
+                ok = _archivar_lote(db, temp, ids, corte, finales)
+                total[temp] = total.get(temp, 0) + len(ok)
+                movidos.update(ok)
+                n += len(ok)
+                if log: log(f"  temporada {temp}: {total[temp]} pedidos archivados")
+            if not n:
+                break   # sin candidatos, o todos cambiaron mientras tanto: la siguiente corrida los toma
+            CACHE.invalidate(*(t for t, _ in ARCHIVO_TABLAS), "produccion_rollup", "escuela_pedidos")
+            time.sleep(pause)   # cede el lock de escritura a los requests
+    finally:
+        db.close()
+    _pdf_olvidar(movidos)
+    return total
+
+def _pdf_olvidar(ids):
+    """Borra del disco los PDFs en caché de pedidos que ya no están en el vivo."""
+    if not ids or not os.path.isdir(PDF_CACHE_DIR):
+        return
+    for name in os.listdir(PDF_CACHE_DIR):
+        m = re.match(r"^pedido_(\d+)_", name)
+        if m and int(m.group(1)) in ids:
+            try: os.remove(os.path.join(PDF_CACHE_DIR, name))
+            except OSError: pass
+
+@contextmanager
+def archivo(temp):
+    """Conexión propia con la temporada adjunta como `arch`, para consultas históricas."""
+    path = archivo_path(temp)
+    if not os.path.exists(path):
+        abort(404)
+    db = connect_db()
+    try:
+        db.execute("ATTACH DATABASE ? AS arch", (path,))
+        yield db
+    finally:
+        db.close()
+
+@job_handler("archivar", intentos=3, visibilidad=3600)
+def _job_archivar():
+    return archivar()
+
+def programar_archivo():
+    """Encola el archivado si la última corrida terminó hace más de ARCHIVO_CADA_HORAS (se guía por la
+    tabla jobs, así sobrevive a reinicios y a varios procesos de worker)."""
+    if ARCHIVO_CADA_HORAS <= 0:
+        return
+    r = query_one("SELECT MAX(terminado) AS t FROM jobs WHERE estado = 'hecho' AND tipo = 'archivar'")
+    if not r["t"] or r["t"] < (datetime.utcnow() - timedelta(hours=ARCHIVO_CADA_HORAS)).isoformat():
+        encolar("archivar", llave="archivar")
+
+# ------------ Respaldos en línea (API backup de SQLite) ------------
+# Copiar pedidos.db a mano con la app escribiendo da una copia corrupta. backup() copia por páginas desde
+# una transacción de lectura (con WAL no detiene a los escritores) y entre pasos suelta el lock y duerme.
+RESPALDO_DIR       = os.getenv("RESPALDO_DIR", os.path.join(BASE_DIR, "respaldos"))
+RESPALDO_PAGINAS   = int(os.getenv("RESPALDO_PAGINAS", "1000"))     # páginas por paso
+RESPALDO_PAUSA     = float(os.getenv("RESPALDO_PAUSA", "0.02"))     # s entre pasos
+RESPALDO_REINICIOS = int(os.getenv("RESPALDO_REINICIOS", "3"))      # tras N reinicios, el resto en un paso
+RESPALDO_CONSERVAR = int(os.getenv("RESPALDO_CONSERVAR", "7"))      # los N más recientes...
+RESPALDO_SEMANAS   = int(os.getenv("RESPALDO_SEMANAS", "4"))        # ...y el último de cada una de N semanas
+RESPALDO_CADA_HORAS = float(os.getenv("RESPALDO_CADA_HORAS", "0"))  # el worker lo encola; 0 = sólo a mano
+RESPALDO_VENTANA   = os.getenv("RESPALDO_VENTANA", "0-24")           # horas locales en que puede correr
+RESPALDO_SONDA     = float(os.getenv("RESPALDO_SONDA", "1"))         # s de línea base de la sonda; 0 = sin sonda
+RESPALDO_LOG       = "respaldos.jsonl"
+
+_RESPALDO_RE = re.compile(r"^pedidos_(\d{8}T\d{6})\.db$")
+SONDA_SQL = "SELECT id FROM pedidos ORDER BY created_at DESC, id DESC LIMIT 50"   # la consulta del listado
+
+class _Reinicio(Exception):
+    pass
+
+def respaldos():
+    """Respaldos en RESPALDO_DIR, el más nuevo primero: [(nombre, fecha, bytes)]."""
+    if not os.path.isdir(RESPALDO_DIR):
+        return []
+    out = []
+    for name in os.listdir(RESPALDO_DIR):
+        m = _RESPALDO_RE.match(name)
+        if m:
+            out.append((name, datetime.strptime(m.group(1), "%Y%m%dT%H%M%S"),
+                        os.path.getsize(os.path.join(RESPALDO_DIR, name))))
+    return sorted(out, reverse=True)
+
+def verificar_respaldo(path, rapido=False):
+    """integrity_check (o quick_check) sobre el archivo, abierto sólo lectura. Regresa (ok, versión, detalle)."""
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        res = [r[0] for r in db.execute("PRAGMA quick_check" if rapido else "PRAGMA integrity_check")]
+        return res == ["ok"], schema_version(db), "; ".join(res[:5])
+    except sqlite3.DatabaseError as e:
+        return False, None, str(e)
+    finally:
+        db.close()
+
+def _pcts(xs):
+    xs = sorted(xs)
+    if not xs:
+        return None
+    q = lambda p: round(xs[min(len(xs) - 1, int(p * len(xs)))] * 1000, 2)
+    return {"n": len(xs), "p50": q(0.5), "p95": q(0.95), "max": round(xs[-1] * 1000, 2)}
+
+def _sonda(stop, muestras):
+    """Mide lo que vería un request mientras corre el respaldo: la consulta del listado y tomar el lock de
+    escritura (BEGIN IMMEDIATE / ROLLBACK). Cada muestra en s."""
+    db = connect_db()
+    db.isolation_level = None
+    try:
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            db.execute(SONDA_SQL).fetchall()
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("ROLLBACK")
+            muestras.append(time.perf_counter() - t0)
+            stop.wait(0.05)
+    finally:
+        db.close()
+
+def _copiar(src, dst, paginas, pausa, st):
+    """backup() por pasos; si otra conexión escribe entre pasos SQLite reinicia la copia. Tras
+    RESPALDO_REINICIOS reinicios el resto va en un paso: con WAL es una sola lectura y no frena escrituras."""
+    antes = [None]
+    def progreso(status, restantes, total):
+        st["pasos"] += 1
+        st["paginas"] = total
+        if antes[0] is not None and restantes >= antes[0]:   # no avanzó: volvió a empezar
+            st["reinicios"] += 1
+            if st["reinicios"] >= RESPALDO_REINICIOS:
+                raise _Reinicio
+        antes[0] = restantes
+        if restantes and pausa:
+            time.sleep(pausa)   # suelta el GIL y el lock de lectura: los requests avanzan
+    try:
+        src.backup(dst, pages=paginas, progress=progreso)
+    except _Reinicio:
+        st["un_paso"] = True
+        src.backup(dst, pages=-1)
+
+def respaldar(destino=None, paginas=RESPALDO_PAGINAS, pausa=RESPALDO_PAUSA, rotar=True, log=None):
+    """Respaldo en línea de la BD viva a RESPALDO_DIR (o `destino`), verificado con integrity_check.
+    Regresa las estadísticas de la corrida (también quedan en respaldos.jsonl)."""
+    inicio = datetime.now()
+    path = destino or os.path.join(RESPALDO_DIR, f"pedidos_{inicio:%Y%m%dT%H%M%S}.db")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    st = {"archivo": os.path.basename(path), "inicio": inicio.isoformat(timespec="seconds"),
+          "pasos": 0, "paginas": 0, "reinicios": 0, "un_paso": False}
+    muestras, stop = [], threading.Event()
+    sonda = None
+    if RESPALDO_SONDA > 0:
+        sonda = threading.Thread(target=_sonda, args=(stop, muestras), name="respaldo-sonda", daemon=True)
+        sonda.start()
+        time.sleep(RESPALDO_SONDA)   # línea base sin respaldo
+    base = len(muestras)
+    src, dst = connect_db(), sqlite3.connect(tmp)
+    t0 = time.perf_counter()
+    try:
+        _copiar(src, dst, paginas, pausa, st)
+        st["segundos"] = round(time.perf_counter() - t0, 3)
+        dst.execute("PRAGMA journal_mode=DELETE")   # archivo autocontenido (sin -wal)
+    except BaseException:
+        dst.close()
+        os.remove(tmp)
+        raise
+    finally:
+        src.close()
+        stop.set()
+        if sonda: sonda.join()
+    dst.close()
+    st["latencia_ms"] = {"antes": _pcts(muestras[:base]), "durante": _pcts(muestras[base:])}
+    t1 = time.perf_counter()
+    ok, version, detalle = verificar_respaldo(tmp)
+    st.update(integridad=detalle, version=version, verificacion_s=round(time.perf_counter() - t1, 3))
+    if not ok:
+        os.replace(tmp, path + ".corrupto")
+        raise RuntimeError(f"respaldo {path}: integrity_check falló: {detalle}")
+    os.replace(tmp, path)
+    st["bytes"] = os.path.getsize(path)
+    if rotar and not destino:
+        st["borrados"] = rotar_respaldos()
+    if log: log(f"  {st['paginas']} páginas en {st['pasos']} pasos, {st['segundos']} s, {st['reinicios']} reinicio(s)")
+    if not destino:
+        with open(os.path.join(RESPALDO_DIR, RESPALDO_LOG), "a", encoding="utf-8") as f:
+            f.write(json.dumps(st) + "\n")
+    return st
+
+def rotar_respaldos(conservar=RESPALDO_CONSERVAR, semanas=RESPALDO_SEMANAS):
+    """Deja los `conservar` más recientes y el último de cada una de las últimas `semanas` semanas."""
+    todos = respaldos()
+    quedan = {r[0] for r in todos[:conservar]}
+    vistas = set()
+    for name, fecha, _ in todos:
+        sem = fecha.isocalendar()[:2]
+        if sem not in vistas and len(vistas) < semanas:
+            vistas.add(sem)
+            quedan.add(name)
+    borrados = [r[0] for r in todos if r[0] not in quedan]
+    for name in borrados:
+        try: os.remove(os.path.join(RESPALDO_DIR, name))
+        except OSError: pass
+    return borrados
+
+def respaldos_corridas(n=30):
+    path = os.path.join(RESPALDO_DIR, RESPALDO_LOG)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        lineas = f.readlines()[-n:]
+    return [json.loads(l) for l in reversed(lineas) if l.strip()]
+
+def restaurar(origen, log=None):
+    """Reemplaza la BD viva con `origen`, en línea: verifica el respaldo, respalda antes la BD actual
+    (pre_restaurar) y copia con backup() hacia la conexión viva; las demás conexiones ven la BD nueva
+    en su siguiente transacción. Después migra (un respaldo viejo puede tener una versión menor) y toca
+    la marca de restauración: los demás procesos (web, worker) descartan su pool y su caché al verla."""
+    ok, version, detalle = verificar_respaldo(origen)
+    if not ok:
+        raise RuntimeError(f"{origen}: integrity_check falló: {detalle}")
+    previo = os.path.join(RESPALDO_DIR, f"pre_restaurar_{datetime.now():%Y%m%dT%H%M%S}.db")
+    respaldar(destino=previo, rotar=False)
+    if log: log(f"  BD actual respaldada en {previo}")
+    src = sqlite3.connect(f"file:{origen}?mode=ro", uri=True)
+    dst = connect_db()
+    try:
+        src.backup(dst)   # un paso: toma el lock de escritura de la BD viva mientras copia
+    finally:
+        src.close()
+        dst.close()
+    DB_POOL.reset()
+    migrate_db(log=log)
+    with open(marca_restaurada(), "w", encoding="utf-8") as f:
+        f.write(datetime.utcnow().isoformat())
+    return {"origen": origen, "version": version, "previo": previo}
+
+@job_handler("respaldo", intentos=2, visibilidad=3600)
+def _job_respaldo():
+    return respaldar()
+
+def _en_ventana(ventana, hora):
+    ini, _, fin = ventana.partition("-")
+    ini, fin = int(ini or 0), int(fin or 24)
+    return ini <= hora < fin if ini <= fin else (hora >= ini or hora < fin)
+
+def programar_respaldo():
+    """Encola el respaldo si el último terminó hace más de RESPALDO_CADA_HORAS y es hora de la ventana."""
+    if RESPALDO_CADA_HORAS <= 0 or not _en_ventana(RESPALDO_VENTANA, datetime.now().hour):
+        return
+    r = query_one("SELECT MAX(terminado) AS t FROM jobs WHERE estado = 'hecho' AND tipo = 'respaldo'")
+    if not r["t"] or r["t"] < (datetime.utcnow() - timedelta(hours=RESPALDO_CADA_HORAS)).isoformat():
+        encolar("respaldo", llave="respaldo")
+
 # ------------ Auth decorators ------------
 def login_required(fn):
     from functools import wraps
@@ -116,68 +1842,283 @@ def role_required(*roles):
         return wrapper
     return deco
 
+# ------------ Alcance por rol: consultas ya filtradas por lo que ve cada usuario ------------
+# admin ve todo, vendedora sus escuelas (e.vendedora_id) y escuela la suya. El escuela_id queda en la
+# sesión desde el login, así cada página autoriza y trae sus datos en la misma consulta indexada.
+def escuela_id_sesion():
+    """escuela_id del usuario escuela (sesiones anteriores a este cambio: se busca una vez y se guarda)."""
+    if session.get("escuela_id") is None and session.get("role") == "escuela":
+        r = query_one("SELECT id FROM escuelas WHERE user_id = ?", (session["user_id"],))
+        session["escuela_id"] = r and r["id"]
+    return session.get("escuela_id")
+
+def alcance():
+    """(cláusula AND…, parámetros) que restringe `pedidos p JOIN escuelas e` al usuario de la sesión."""
+    role = session.get("role")
+    if role == "admin":
+        return "", ()
+    if role == "vendedora":
+        return "AND e.vendedora_id = ?", (session["user_id"],)
+    if role == "escuela":
+        return "AND p.escuela_id = ?", (escuela_id_sesion(),)
+    abort(403)
+
+def pedido_visible(pedido_id):
+    """Detalle del pedido con las versiones para el ETag; None si no existe o el usuario no lo ve."""
+    cond, params = alcance()
+    return query_one(f"""
+        SELECT {PEDIDO_DETALLE_COLS}, e.version AS esc_version, pa.version AS paq_version
+        {PEDIDO_DETALLE_JOINS}
+        WHERE p.id = ? {cond}
+    """, (pedido_id, *params))
+
+def mi_escuela():
+    return query_one("SELECT * FROM escuelas WHERE id = ?", (escuela_id_sesion(),))
+
 # ------------ Bootstrap BD / tablas ------------
+_db_ready = False
+_db_ready_lock = threading.Lock()
+
 def ensure_db():
-    first_time = not os.path.exists(DB_PATH)
+    """Crea/migra la BD una sola vez por proceso (passenger_wsgi lo llama al importar)."""
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_ready_lock:
+        if not _db_ready:
+            migrate_db()
+            _db_ready = True
 
-    if first_time:
-        init_db()
+@app.before_request
+def _before():
+    ensure_db()
 
-        # --- datos demo (opcional) ---
-        admin_id = execute(
-            "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
-            ("Admin", "admin@demo.local", generate_password_hash("admin123"), "admin")
-        )
-        vend_id = execute(
-            "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
-            ("Vendedora Demo", "vendedora@demo.local", generate_password_hash("demo123"), "vendedora")
-        )
-        esc_user_id = execute(
-            "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
-            ("Escuela Demo", "escuela@demo.local", generate_password_hash("demo123"), "escuela")
-        )
-        paq_id = execute("INSERT INTO paqueterias(nombre,activa) VALUES(?,1)", ("Estafeta",))
-        execute("INSERT INTO paqueterias(nombre,activa) VALUES(?,1)", ("DHL",))
-
-        esc_id = execute("""
-            INSERT INTO escuelas(nombre,ciudad,grado,contacto,telefono,user_id,vendedora_id, estado)
-            VALUES(?,?,?,?,?,?,?,?)
-        """, ("Colegio Benito Juárez", "Guadalajara", "Primaria", "Mtra. López", "3312345678", esc_user_id, vend_id, "Jalisco"))
-
-        ninas = json.dumps([{"nombre":"Ana","color_pelo":"Castaño","calceta":"Blanca"}], ensure_ascii=False)
-        ninos = json.dumps([{"nombre":"Leo","color_pelo":"Castaño","calceta":"Negra"}], ensure_ascii=False)
-
-        execute("""
-            INSERT INTO pedidos(escuela_id,ciudad,grado,ninas_json,ninos_json,comentario,estado,paqueteria_id,created_at,
-                                color_calceta_ninas,color_zapato_ninas,color_zapato_ninos,color_monos,color_pantalon,
-                                escudos_bordar,fechas_entrega,entrega)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (esc_id, "Guadalajara", "Primaria", ninas, ninos, "Pedido de muestra", "Nuevo", paq_id, datetime.utcnow().isoformat(),
-              "Blanca", "Negro", "Negro", "Azul marino", "Azul marino", 5, json.dumps(["25/05/2026","15/06/2026"]), "Ocurre"))
+# ------------ Arranque en frío: warm-up antes de aceptar tráfico ------------
+ARRANQUE = {}   # ms del import y de cada etapa del warm-up de este proceso; se ven en /admin/db
+
+def warmup():
+    """Lo que pagaría el primer request, hecho al arrancar (passenger_wsgi lo llama al importar).
+
+    Passenger atiende en el hilo que importó la app, así que la conexión del pool que se abre aquí
+    es la misma que usan los requests. Regresa ARRANQUE.
+    """
+    t = time.perf_counter()
+    def etapa(nombre):
+        nonlocal t
+        ARRANQUE[f"{nombre}_ms"] = round((time.perf_counter() - t) * 1000, 1)
+        t = time.perf_counter()
+    ensure_db()
+    etapa("ensure_db")
+    with app.app_context():
+        get_db().execute("SELECT 1").fetchone()   # conexión del hilo con sus pragmas (y el mmap)
+        etapa("conexion")
+        try:
+            nombres = app.jinja_env.list_templates()
+        except TypeError:   # loader sin listado
+            nombres = []
+        for name in nombres:
+            app.jinja_env.get_template(name)
+        ARRANQUE["plantillas"] = len(nombres)
+        etapa("plantillas")
+        try:
+            app.url_map.bind("localhost").match("/")   # el matcher de rutas se arma en el primer match
+        except Exception:
+            pass
+        etapa("rutas")
+        admin_tablero()   # caché del tablero y páginas calientes de pedidos/escuelas en memoria
+        etapa("caches")
+    return ARRANQUE
+
+# ------------ HTTP: ETag y Cache-Control ------------
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", str(7 * 86400)))
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = STATIC_MAX_AGE
+
+def _etag_salt():
+    # cambia con cada deploy (código o plantillas) para no servir 304 de un HTML viejo
+    salt = os.getenv("ETAG_SALT", "")
+    if salt:
+        return salt
+    mtimes = [os.path.getmtime(__file__)]
+    tdir = os.path.join(BASE_DIR, "templates")
+    if os.path.isdir(tdir):
+        mtimes += [os.path.getmtime(os.path.join(d, f)) for d, _, fs in os.walk(tdir) for f in fs]
+    return str(int(max(mtimes)))
+
+ETAG_SALT = _etag_salt()
+
+def page_etag(*versions):
+    """ETag de una página por usuario a partir de versiones de filas (sin renderizar nada)."""
+    raw = repr((ETAG_SALT, session.get("user_id"), session.get("role"), versions))
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+def not_modified(etag):
+    """Respuesta 304 si el navegador ya tiene esta versión; None si hay que renderizar.
+
+    Con mensajes flash pendientes siempre se renderiza: el 304 los dejaría sin mostrar.
+    """
+    if session.get("_flashes") or etag not in request.if_none_match:
+        return None
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    return resp
+
+def pide_json():
+    """El cliente prefiere JSON (Accept: application/json): las vistas nuevas responden sin plantilla."""
+    return request.accept_mimetypes.best == "application/json"
+
+def with_etag(body, etag):
+    resp = make_response(body)
+    resp.set_etag(etag)
+    return resp
+
+@app.after_request
+def _cache_headers(resp):
+    if request.endpoint == "static" or "Cache-Control" in resp.headers:
+        return resp   # estáticos: max-age de SEND_FILE_MAX_AGE_DEFAULT; el PDF trae su propia política
+    if session.get("user_id"):
+        # páginas por rol/usuario: sólo el navegador guarda copia y la revalida siempre (ETag → 304)
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        resp.vary.add("Cookie")
     else:
-        migrate_db()
+        resp.cache_control.no_store = True
+    return resp
+
+if METRICS_ENABLED:
+    @app.before_request
+    def _metrics_start():
+        g._t0 = time.perf_counter()
+        g._sqlm = {"n": 0, "time": 0.0, "rows": 0, "slow": 0.0, "slow_sql": ""}
+
+    @app.after_request
+    def _metrics_stop(resp):
+        if "_t0" in g:
+            METRICS.record(request.endpoint or "sin_ruta", time.perf_counter() - g._t0, g._sqlm)
+        return resp
+
+@app.get("/admin/metrics")
+@login_required
+@role_required("admin")
+def admin_metrics():
+    pool, cache = DB_POOL.stats(), CACHE.stats()
+    extra = [("pedidos_db_pool_hits_total", "counter", pool["hits"]),
+             ("pedidos_db_pool_misses_total", "counter", pool["misses"]),
+             ("pedidos_cache_hits_total", "counter", cache["hits"]),
+             ("pedidos_cache_misses_total", "counter", cache["misses"]),
+             ("pedidos_metrics_enabled", "gauge", int(METRICS_ENABLED))]
+    return Response(METRICS.prometheus(extra), mimetype="text/plain; version=0.0.4")
 
-    # --- ensure password_resets table ---
+@app.cli.command("migrate")
+def migrate_command():
+    """Aplica las migraciones pendientes (correr antes de cada deploy)."""
+    before, after = migrate_db(log=click.echo)
+    if before == after:
+        click.echo(f"BD al día (versión {after}).")
+    else:
+        click.echo(f"BD migrada de la versión {before} a la {after}.")
+
+@app.cli.command("worker")
+@click.option("--hilos", default=JOB_WORKERS, show_default=True, help="Hilos por proceso.")
+@click.option("--procesos", default=1, show_default=True, help="Procesos (para PDFs: el render usa CPU).")
+@click.option("--once", is_flag=True, help="Vaciar la cola y salir (p. ej. desde cron).")
+def worker_command(hilos, procesos, once):
+    """Corre los trabajos de la cola (PDFs, correos, exportaciones) hasta SIGTERM/Ctrl-C."""
+    if procesos <= 1:
+        run_worker(hilos, once, log=click.echo)
+        return
+    import multiprocessing, signal
+    ctx = multiprocessing.get_context("spawn")   # cada proceso abre sus propias conexiones
+    procs = [ctx.Process(target=run_worker, args=(hilos, once)) for _ in range(procesos)]
+    for pr in procs:
+        pr.start()
+    # SIGTERM/Ctrl-C se pasan a los hijos, que terminan su trabajo en curso
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_a: [pr.terminate() for pr in procs if pr.is_alive()])
+    for pr in procs:
+        pr.join()
+
+@app.cli.command("archivar")
+@click.option("--dias", default=ARCHIVO_DIAS, show_default=True, help="Días en Entregado/Cancelado antes de archivar.")
+@click.option("--antes", default=None, help="Corte explícito AAAA-MM-DD (en vez de --dias).")
+@click.option("--lote", default=ARCHIVO_LOTE, show_default=True, help="Pedidos por transacción.")
+@click.option("--dry-run", is_flag=True, help="Sólo contar cuántos se archivarían por temporada.")
+@click.option("--vacuum", is_flag=True, help="VACUUM al final para devolver el espacio al disco (bloquea la BD).")
+def archivar_command(dias, antes, lote, dry_run, vacuum):
+    """Mueve los pedidos cerrados viejos al archivo de su temporada (archivo/pedidos_<año>.db)."""
     try:
-        db = get_db()
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS password_resets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                token TEXT NOT NULL UNIQUE,
-                expires_at TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-        """)
-        db.commit()
-    except Exception:
-        # ignorar si la BD está bloqueada u otra condición no crítica
-        pass
+        corte = datetime.strptime(antes, "%Y-%m-%d") if antes else None
+    except ValueError:
+        raise click.BadParameter("usa AAAA-MM-DD", param_hint="--antes")
+    total = archivar(dias, corte, lote, dry_run=dry_run, log=click.echo)
+    verbo = "se archivarían" if dry_run else "archivados"
+    for temp, n in sorted(total.items()):
+        click.echo(f"Temporada {temp}: {n} pedidos {verbo}.")
+    if not total:
+        click.echo("Nada que archivar.")
+    if vacuum and not dry_run:
+        db = connect_db()
+        db.execute("VACUUM")
+        db.close()
 
-@app.before_request
-def _before():
-    ensure_db()
+@app.cli.command("respaldar")
+@click.option("--destino", default=None, help="Archivo de salida (sin rotar); por defecto RESPALDO_DIR.")
+@click.option("--paginas", default=RESPALDO_PAGINAS, show_default=True, help="Páginas por paso.")
+@click.option("--pausa", default=RESPALDO_PAUSA, show_default=True, help="Segundos entre pasos.")
+def respaldar_command(destino, paginas, pausa):
+    """Respaldo en línea de la BD (API backup de SQLite), verificado y con rotación."""
+    st = respaldar(destino, paginas, pausa, log=click.echo)
+    lat = st["latencia_ms"]
+    click.echo(f"Respaldo {st['archivo']}: {st['bytes']} bytes, {st['segundos']} s + {st['verificacion_s']} s "
+               f"de integrity_check (versión {st['version']}).")
+    if lat["durante"]:
+        click.echo(f"Sonda p95: {lat['antes'] and lat['antes']['p95']} ms antes, {lat['durante']['p95']} ms durante.")
+    for name in st.get("borrados", []):
+        click.echo(f"  rotado: {name}")
+
+@app.cli.command("respaldos")
+@click.option("--verificar", is_flag=True, help="Correr integrity_check sobre cada respaldo.")
+def respaldos_command(verificar):
+    """Lista los respaldos (y opcionalmente los verifica)."""
+    for name, fecha, size in respaldos():
+        linea = f"{name}  {fecha:%Y-%m-%d %H:%M}  {size / 1048576:.1f} MB"
+        if verificar:
+            ok, version, detalle = verificar_respaldo(os.path.join(RESPALDO_DIR, name))
+            linea += f"  versión {version}  {'ok' if ok else detalle}"
+        click.echo(linea)
+
+@app.cli.command("restaurar")
+@click.argument("archivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--yes", is_flag=True, help="No pedir confirmación.")
+def restaurar_command(archivo, yes):
+    """Reemplaza la BD viva con un respaldo (antes respalda la actual como pre_restaurar_*)."""
+    if not yes:
+        click.confirm(f"¿Reemplazar {DB_PATH} con {archivo}?", abort=True)
+    r = restaurar(archivo, log=click.echo)
+    click.echo(f"BD restaurada desde {r['origen']} (versión {r['version']}).")
+
+@app.cli.command("backfill-items")
+def backfill_items_command():
+    """Pasa los alumnos de ninas_json/ninos_json a pedido_items sin detener la app."""
+    total = backfill_items(log=click.echo)
+    click.echo(f"{total} alumnos copiados a pedido_items.")
+
+@app.cli.command("repair-counters")
+def repair_counters_command():
+    """Verifica/corrige los contadores de pedidos por escuela (escuela_pedidos)."""
+    db = connect_db()
+    with db:
+        diff = repair_escuela_counts(db)
+    db.close()
+    click.echo(f"Corregidos {diff} grupos de escuela_pedidos." if diff else "escuela_pedidos está consistente.")
+
+@app.cli.command("rebuild-produccion")
+def rebuild_produccion_command():
+    """Recalcula produccion_rollup desde pedidos (reparación)."""
+    db = connect_db()
+    with db:
+        rebuild_produccion(db)
+    click.echo(f"{db.execute('SELECT COUNT(*) FROM produccion_rollup').fetchone()[0]} grupos en produccion_rollup.")
+    db.close()
 
 @app.context_processor
 def inject_now():
@@ -209,16 +2150,28 @@ def login():
     if request.method == "POST":
         email = request.form.get("email","").strip().lower()
         password = request.form.get("password","")
-        user = query_one("SELECT * FROM users WHERE email = ?", (email,))
-        if not user or not check_password_hash(user["password_hash"], password):
+        user = query_one("""SELECT u.*, e.id AS escuela_id FROM users u LEFT JOIN escuelas e ON e.user_id = u.id
+                             WHERE u.email = ?""", (email,))
+        try:
+            ok = HASH_POOL.check(user["password_hash"] if user else dummy_hash(), password) and bool(user)
+        except HashOverloaded:
+            return _hash_overloaded("login.html")
+        if not ok:
             flash("Credenciales inválidas", "error")
             return render_template("login.html")
         if not user["is_active"]:
             flash("Usuario inactivo. Contacta al administrador.", "error")
             return render_template("login.html")
+        if needs_rehash(user["password_hash"]):
+            # se sube al costo configurado aprovechando que aquí tenemos la contraseña en claro
+            try:
+                execute("UPDATE users SET password_hash=? WHERE id=?", (HASH_POOL.hash(password), user["id"]))
+            except HashOverloaded:
+                pass   # se intentará en el siguiente login
         session["user_id"] = user["id"]
         session["name"] = user["name"]
         session["role"] = user["role"]
+        session["escuela_id"] = user["escuela_id"]
         return redirect(url_for("home"))
     return render_template("login.html")
 
@@ -240,14 +2193,19 @@ def signup_submit():
     if exists:
         flash("Ese correo ya está registrado.", "error")
         return render_template("signup.html")
-    user_id = execute(
-        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,0)",
-        (name, email, generate_password_hash(password), "escuela")
-    )
-    execute(
-        "INSERT INTO escuelas(nombre, user_id) VALUES (?,?)",
-        (name, user_id)
-    )
+    try:
+        pwhash = HASH_POOL.hash(password)
+    except HashOverloaded:
+        return _hash_overloaded("signup.html")
+    with transaction():
+        user_id = execute(
+            "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,0)",
+            (name, email, pwhash, "escuela")
+        )
+        execute(
+            "INSERT INTO escuelas(nombre, user_id) VALUES (?,?)",
+            (name, user_id)
+        )
     flash("Registro enviado. Un administrador revisará y activará tu cuenta.", "ok")
     return redirect(url_for("login"))
 
@@ -256,49 +2214,334 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
+# ---------- Recuperar contraseña (password_resets + correo por la cola) ----------
+RESET_TTL = int(os.getenv("RESET_TTL", "3600"))   # s que vale el enlace
+RESET_ESPERA = int(os.getenv("RESET_ESPERA", "300"))   # s antes de aceptar otra solicitud del mismo usuario
+
+def reset_vigente(token):
+    return query_one("SELECT user_id FROM password_resets WHERE token = ? AND expires_at > ?",
+                     (token, datetime.utcnow().isoformat()))
+
+@app.route("/recuperar", methods=["GET","POST"])
+def recuperar():
+    if request.method == "GET":
+        if pide_json():
+            return jsonify(metodo="POST", campos=["email"])
+        return render_template("recuperar.html")
+    email = request.form.get("email","").strip().lower()
+    user = query_one("SELECT id, name, is_active FROM users WHERE email = ?", (email,))
+    if user and user["is_active"]:
+        token, now = generate_token(48), datetime.utcnow()
+        link = url_for("recuperar_token", token=token, _external=True)
+        with transaction():
+            # un enlace por usuario cada RESET_ESPERA: repetir el POST no llena el buzón ni la cola
+            reciente = query_one("SELECT 1 FROM password_resets WHERE user_id = ? AND created_at > ?",
+                                 (user["id"], (now - timedelta(seconds=RESET_ESPERA)).isoformat()))
+            if not reciente:
+                execute("DELETE FROM password_resets WHERE user_id = ?", (user["id"],))
+                execute("INSERT INTO password_resets(user_id, token, expires_at, created_at) VALUES (?,?,?,?)",
+                        (user["id"], token, (now + timedelta(seconds=RESET_TTL)).isoformat(), now.isoformat()))
+                encolar("correo", {"user_id": user["id"], "asunto": "Recupera tu contraseña de Pedidos GS",
+                                   "texto": f"Hola {user['name']}:\n\nPara elegir una contraseña nueva entra en "
+                                            f"{link}\n\nEl enlace vale {RESET_TTL // 60} minutos. Si no lo pediste, "
+                                            "ignora este correo.\n"})
+    # misma respuesta exista o no el correo
+    msg = "Si el correo está registrado, te enviamos un enlace para elegir una contraseña nueva."
+    if pide_json():
+        return jsonify(ok=True, mensaje=msg), 202
+    flash(msg, "ok")
+    return redirect(url_for("login"))
+
+@app.route("/recuperar/<token>", methods=["GET","POST"])
+def recuperar_token(token):
+    def falla(msg, code, template=None):
+        if pide_json():
+            return jsonify(error=msg), code
+        flash(msg, "error")
+        return render_template(template, token=token) if template else redirect(url_for("recuperar"))
+    if not reset_vigente(token):
+        return falla("El enlace no es válido o ya expiró.", 404)
+    if request.method == "GET":
+        if pide_json():
+            return jsonify(metodo="POST", campos=["password"], vigente=True)
+        return render_template("recuperar_token.html", token=token)
+    password = request.form.get("password","")
+    if not password:
+        return falla("Escribe la contraseña nueva.", 400, "recuperar_token.html")
+    try:
+        pwhash = HASH_POOL.hash(password)
+    except HashOverloaded:
+        if pide_json():
+            return jsonify(error="Servidor ocupado, intenta de nuevo."), 503, {"Retry-After": "2"}
+        return _hash_overloaded("recuperar_token.html")
+    with transaction():
+        r = reset_vigente(token)   # otra vez ya con el candado: el enlace se usa una sola vez
+        if r:
+            execute("UPDATE users SET password_hash=? WHERE id=?", (pwhash, r["user_id"]))
+            execute("DELETE FROM password_resets WHERE user_id = ?", (r["user_id"],))
+    if pide_json():
+        return jsonify(ok=True) if r else (jsonify(error="El enlace ya se usó."), 409)
+    flash("Contraseña actualizada. Ya puedes iniciar sesión." if r else "El enlace ya se usó.", "ok" if r else "error")
+    return redirect(url_for("login"))
+
 # ---------- Admin ----------
 @app.get("/admin")
 @login_required
 @role_required("admin")
 def admin_dashboard():
-    total_pedidos = query_one("SELECT COUNT(*) c FROM pedidos")["c"]
-    total_escuelas = query_one("SELECT COUNT(*) c FROM escuelas")["c"]
-    total_vendedoras = query_one("SELECT COUNT(*) c FROM users WHERE role='vendedora'")["c"]
-    pedidos = query_all("""
-        SELECT p.*, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria
+    totales, pedidos = admin_tablero(session.get("role"))
+    return render_template("admin_dashboard.html", pedidos=pedidos, **totales)
+
+def admin_tablero(role="admin"):
+    totales = CACHE.cached(f"{role}:admin_dashboard:totales", lambda: dict(query_one("""
+        SELECT (SELECT COUNT(*) FROM pedidos) AS total_pedidos,
+               (SELECT COUNT(*) FROM escuelas) AS total_escuelas,
+               (SELECT COUNT(*) FROM users WHERE role='vendedora') AS total_vendedoras
+    """)), tags=("pedidos", "escuelas", "users"))
+    pedidos = CACHE.cached(f"{role}:admin_dashboard:recientes", lambda: [dict(r) for r in query_all(f"""
+        SELECT {PEDIDO_LIST_COLS}, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria
         FROM pedidos p
         JOIN escuelas e ON e.id = p.escuela_id
         LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
         ORDER BY p.created_at DESC
         LIMIT 10
-    """)
-    return render_template("admin_dashboard.html",
-                           total_pedidos=total_pedidos,
-                           total_escuelas=total_escuelas,
-                           total_vendedoras=total_vendedoras,
-                           pedidos=pedidos)
+    """)], tags=("pedidos", "escuelas", "paqueterias"))
+    return totales, pedidos
 
-@app.get("/admin/pedidos")
+@app.get("/admin/db")
 @login_required
 @role_required("admin")
-def admin_pedidos():
-    pedidos = query_all("""
-        SELECT p.*, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria
+def admin_db_stats():
+    return jsonify(pool=DB_POOL.stats(), cache=CACHE.stats(), hash=HASH_POOL.stats(), arranque=ARRANQUE)
+
+@app.get("/admin/jobs")
+@login_required
+@role_required("admin")
+def admin_jobs():
+    r = jobs_resumen()
+    if pide_json():
+        return jsonify(r)
+    return render_template("admin_jobs.html", **r)
+
+@app.post("/admin/jobs/<int:job_id>/reintentar")
+@login_required
+@role_required("admin")
+def admin_job_reintentar(job_id):
+    # vuelve a la cola con intentos desde cero; si ya hay uno igual pendiente, lo reemplaza
+    execute("""UPDATE OR REPLACE jobs SET estado = 'pendiente', intentos = 0, disponible_en = ?, terminado = NULL
+               WHERE id = ? AND estado = 'muerto'""", (datetime.utcnow().isoformat(), job_id))
+    flash("Trabajo enviado de nuevo a la cola.", "ok")
+    return redirect(url_for("admin_jobs"))
+
+@app.get("/admin/respaldos")
+@login_required
+@role_required("admin")
+def admin_respaldos():
+    r = {"respaldos": [{"archivo": n, "fecha": f.isoformat(), "bytes": b} for n, f, b in respaldos()],
+         "corridas": respaldos_corridas()}
+    if pide_json():
+        return jsonify(r)
+    return render_template("admin_respaldos.html", **r)
+
+@app.post("/admin/respaldos")
+@login_required
+@role_required("admin")
+def admin_respaldar():
+    job_id = encolar("respaldo", llave="respaldo")   # None: ya había uno pendiente
+    if pide_json():
+        return jsonify(job_id=job_id, encolado=job_id is not None), 202
+    flash("Respaldo en cola; el worker lo corre en cuanto se desocupe.", "ok")
+    return redirect(url_for("admin_respaldos"))
+
+ESTADOS = ["Nuevo","En revisión","Aprobado","En producción","Listo para envío","Enviado","Entregado","Cancelado"]
+PEDIDOS_PAGE_SIZE = int(os.getenv("PEDIDOS_PAGE_SIZE", "50"))
+PEDIDOS_PAGE_MAX = 500
+
+# Proyección del listado: sin ninas_json/ninos_json (el detalle los carga)
+PEDIDO_LIST_COLS = """
+    p.id, p.escuela_id, p.ciudad, p.grado, p.comentario, p.estado, p.paqueteria_id, p.created_at,
+    p.escudos_bordar, p.fechas_entrega, p.entrega
+"""
+
+PEDIDO_DETALLE_COLS = """
+    p.*, e.nombre AS escuela, e.ciudad AS escuela_ciudad, e.grado AS escuela_grado, e.contacto, e.telefono,
+    e.direccion, e.colonia, e.codigo_postal, e.estado AS escuela_estado, e.referencias,
+    e.dest_nombre, e.dest_tel, e.dest_cp, e.dest_colonia, e.dest_direccion, e.dest_correo,
+    pa.nombre AS paqueteria
+"""
+PEDIDO_DETALLE_JOINS = """
+    FROM pedidos p
+    JOIN escuelas e ON e.id = p.escuela_id
+    LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
+"""
+PEDIDO_DETALLE_SQL = f"SELECT {PEDIDO_DETALLE_COLS} {PEDIDO_DETALLE_JOINS} WHERE p.id = ?"
+
+def encode_cursor(row):
+    return f"{row['created_at']}|{row['id']}"
+
+def decode_cursor(raw):
+    created_at, _, pid = (raw or "").rpartition("|")
+    try:
+        return created_at, int(pid)
+    except ValueError:
+        return None
+
+def pedidos_filtros(args):
+    """Filtros del listado → (cláusulas WHERE, parámetros, valores normalizados)."""
+    f = {k: (args.get(k) or "").strip() for k in ("estado","paqueteria_id","ciudad","desde","hasta")}
+    where, params = [], []
+    if f["estado"]:
+        where.append("p.estado = ?"); params.append(f["estado"])
+    if f["paqueteria_id"]:
+        if f["paqueteria_id"] == "0":
+            where.append("p.paqueteria_id IS NULL")
+        else:
+            where.append("p.paqueteria_id = ?"); params.append(f["paqueteria_id"])
+    if f["ciudad"]:
+        where.append("p.ciudad = ?"); params.append(f["ciudad"])
+    try:
+        if f["desde"]:
+            where.append("p.created_at >= ?")
+            params.append(datetime.strptime(f["desde"], "%Y-%m-%d").isoformat())
+        if f["hasta"]:
+            where.append("p.created_at < ?")
+            params.append((datetime.strptime(f["hasta"], "%Y-%m-%d") + timedelta(days=1)).isoformat())
+    except ValueError:
+        abort(400)
+    return where, params, f
+
+def keyset_args(args):
+    """Filtros del listado + ?limit= + ?cursor= → (cláusulas WHERE, parámetros, filtros, limit).
+
+    La consulta que los use ordena por `p.created_at DESC, p.id DESC` y pide limit + 1 filas (keyset_pagina).
+    """
+    where, params, filtros = pedidos_filtros(args)
+    try:
+        limit = max(1, min(int(args.get("limit") or PEDIDOS_PAGE_SIZE), PEDIDOS_PAGE_MAX))
+    except ValueError:
+        limit = PEDIDOS_PAGE_SIZE
+    cursor = decode_cursor(args.get("cursor"))
+    if cursor:
+        # keyset sobre (created_at, id): el "<=" da un rango de índice, costo constante por página
+        where.append("p.created_at <= ? AND (p.created_at < ? OR p.id < ?)")
+        params += [cursor[0], cursor[0], cursor[1]]
+    return where, params, filtros, limit
+
+def keyset_pagina(rows, limit, endpoint, filtros, **url_args):
+    """(filas de la página, next_cursor, next_url) de las limit + 1 filas; la URL lleva los mismos filtros."""
+    pedidos = rows[:limit]
+    next_cursor = encode_cursor(pedidos[-1]) if len(rows) > limit else None
+    next_url = next_cursor and url_for(endpoint, **{k: v for k, v in filtros.items() if v}, **url_args,
+                                       limit=limit, cursor=next_cursor)
+    return pedidos, next_cursor, next_url
+
+def pedidos_pagina(args, endpoint):
+    """Una página del listado (keyset por cursor) y la URL de la siguiente en `endpoint`, con los mismos filtros."""
+    where, params, filtros, limit = keyset_args(args)
+    rows = query_all(f"""
+        SELECT {PEDIDO_LIST_COLS}, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria
         FROM pedidos p
         JOIN escuelas e ON e.id = p.escuela_id
         LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
-        ORDER BY p.created_at DESC
-    """)
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    """, (*params, limit + 1))
+    pedidos, next_cursor, next_url = keyset_pagina(rows, limit, endpoint, filtros)
+    return {"pedidos": pedidos, "filtros": filtros, "limit": limit, "next_cursor": next_cursor, "next_url": next_url}
+
+def link_next(resp, url):
+    """Encabezado `Link: <…>; rel="next"` para clientes que paginan sin leer el cuerpo."""
+    if url:
+        resp.headers["Link"] = f'<{url}>; rel="next"'
+    return resp
+
+@app.get("/admin/pedidos")
+@login_required
+@role_required("admin")
+def admin_pedidos():
+    pag = pedidos_pagina(request.args, "admin_pedidos")
     paqs = query_all("SELECT * FROM paqueterias WHERE activa=1 ORDER BY nombre")
-    estados = ["Nuevo","En revisión","Aprobado","En producción","Listo para envío","Enviado","Entregado","Cancelado"]
-    return render_template("admin_pedidos.html", pedidos=pedidos, paqs=paqs, estados=estados)
+    return link_next(make_response(render_template("admin_pedidos.html", paqs=paqs, estados=ESTADOS, **pag)),
+                     pag["next_url"])
+
+@app.get("/admin/pedidos.json")
+@login_required
+@role_required("admin")
+def admin_pedidos_json():
+    pag = pedidos_pagina(request.args, "admin_pedidos_json")
+    pag["pedidos"] = [dict(r) for r in pag["pedidos"]]
+    return link_next(jsonify(pag), pag["next_url"])
+
+BUSCAR_PAGE_SIZE = 20
+BUSCAR_MAX_PAGE = 50
+
+FTS_PREFIX_MAX = 6   # el prefijo más largo con índice propio en pedidos_fts (prefix = '2 3 4 5 6')
+
+def fts_query(texto):
+    """Texto libre → expresión MATCH: todas las palabras requeridas, la última como prefijo (se va tecleando).
+
+    Un prefijo más largo que FTS_PREFIX_MAX se recorta: sin índice propio cuesta ~20x más y el recorte
+    sólo agrega coincidencias muy parecidas ("ramire*" para "ramirez").
+    """
+    words = re.findall(r"\w+", texto or "")[:8]
+    if not words:
+        return ""
+    return " ".join([f'"{w}"' for w in words[:-1]] + [f'"{words[-1][:FTS_PREFIX_MAX]}"*'])
+
+def buscar_pedidos(texto, page=1):
+    """(pedidos de la página con su fragmento coincidente, hay_más) ordenados por relevancia."""
+    match = fts_query(texto)
+    if not match:
+        return [], False
+    # bm25 sobre todas las coincidencias, dentro de FTS5; sólo sale la página (+1 para saber si hay más)
+    cands = query_all("""SELECT rowid AS id, rank FROM pedidos_fts WHERE pedidos_fts MATCH ?
+                         ORDER BY rank, rowid DESC LIMIT ? OFFSET ?""",
+                      (match, BUSCAR_PAGE_SIZE + 1, (page - 1) * BUSCAR_PAGE_SIZE))
+    rank = {r["id"]: r["rank"] for r in cands[:BUSCAR_PAGE_SIZE]}
+    ids = list(rank)
+    if not ids:
+        return [], False
+    # fragmento y datos sólo de las filas de la página
+    rows = query_all(f"""
+        SELECT {PEDIDO_LIST_COLS}, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria,
+               snippet(pedidos_fts, -1, '[', ']', '…', 10) AS coincidencia
+        FROM pedidos_fts f
+        JOIN pedidos p ON p.id = f.rowid
+        LEFT JOIN escuelas e ON e.id = p.escuela_id
+        LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
+        WHERE pedidos_fts MATCH ? AND f.rowid IN (SELECT value FROM json_each(?))
+    """, (match, json.dumps(ids)))
+    pos = {pid: i for i, pid in enumerate(ids)}
+    hits = [dict(r, rank=rank[r["id"]]) for r in sorted(rows, key=lambda r: pos[r["id"]])]
+    return hits, len(cands) > BUSCAR_PAGE_SIZE
+
+def reporte_busqueda(args):
+    q = args.get("q", "").strip()
+    try:
+        page = max(1, min(int(args.get("page") or 1), BUSCAR_MAX_PAGE))
+    except ValueError:
+        page = 1
+    pedidos, has_next = buscar_pedidos(q, page)
+    return {"q": q, "pedidos": pedidos, "page": page, "has_next": has_next and page < BUSCAR_MAX_PAGE}
+
+@app.get("/admin/buscar")
+@login_required
+@role_required("admin")
+def admin_buscar():
+    return render_template("admin_buscar.html", **reporte_busqueda(request.args))
+
+@app.get("/admin/buscar.json")
+@login_required
+@role_required("admin")
+def admin_buscar_json():
+    return jsonify(reporte_busqueda(request.args))
 
 @app.post("/admin/pedido/<int:pedido_id>/paqueteria")
 @login_required
 @role_required("admin")
 def admin_set_paqueteria(pedido_id):
-    paq_id = request.form.get("paqueteria_id")
-    execute("UPDATE pedidos SET paqueteria_id=? WHERE id=?", (paq_id, pedido_id))
+    cambiar_pedidos(["p.id = ?"], [pedido_id], "paqueteria", valor_paqueteria(request.form.get("paqueteria_id")))
     flash("Paquetería actualizada.", "ok")
     return redirect(url_for("admin_pedidos"))
 
@@ -307,130 +2550,924 @@ def admin_set_paqueteria(pedido_id):
 @role_required("admin")
 def admin_set_estado(pedido_id):
     estado = request.form.get("estado","Nuevo")
-    execute("UPDATE pedidos SET estado=? WHERE id=?", (estado, pedido_id))
+    if estado not in ESTADOS:
+        abort(400)
+    cambiar_pedidos(["p.id = ?"], [pedido_id], "estado", estado)
     flash("Estado del pedido actualizado.", "ok")
     return redirect(url_for("admin_pedidos"))
 
+# ------------ Cambios por lote (estado / paquetería) + auditoría ------------
+BULK_MAX = int(os.getenv("BULK_MAX", "2000"))
+CAMPOS_LOTE = {"estado": ("estado", "UPDATE pedidos SET estado = ? WHERE id = ?"),
+               "paqueteria": ("paqueteria_id", "UPDATE pedidos SET paqueteria_id = ? WHERE id = ?")}
+AUDIT_INSERT = "INSERT INTO pedido_auditoria(pedido_id, ts, user_id, campo, antes, despues) VALUES (?,?,?,?,?,?)"
+
+def valor_paqueteria(raw):
+    """paqueteria_id del formulario: vacío o "0" = sin paquetería; si no, debe existir."""
+    raw = (raw or "").strip()
+    if raw in ("", "0"):
+        return None
+    if not raw.isdigit() or not query_one("SELECT 1 FROM paqueterias WHERE id = ?", (int(raw),)):
+        abort(400)
+    return int(raw)
+
+def cambiar_pedidos(where, params, campo, valor):
+    """Pone `campo` = valor en los pedidos del WHERE, en una sola transacción; regresa el resumen.
+
+    Sólo se escriben (y auditan) los pedidos cuyo valor cambia. Los cambios de estado mueven sus
+    piezas en el rollup de producción con una sentencia por signo, no una por pedido.
+    """
+    col, update = CAMPOS_LOTE[campo]
+    with transaction() as db:
+        rows = db.execute(f"SELECT p.id, p.{col} AS antes FROM pedidos p WHERE {' AND '.join(where)} LIMIT ?",
+                          (*params, BULK_MAX + 1)).fetchall()
+        if len(rows) > BULK_MAX:
+            abort(400, description=f"Más de {BULK_MAX} pedidos; acota el filtro.")
+        changed = [r for r in rows if r["antes"] != valor]
+        ids = [r["id"] for r in changed]
+        if changed:
+            if col == "estado":
+                rollup_pedidos(db, ids, -1)
+            execute_many(update, [(valor, i) for i in ids])
+            if col == "estado":
+                rollup_pedidos(db, ids, +1)
+            ts, uid = datetime.utcnow().isoformat(), session.get("user_id")
+            execute_many(AUDIT_INSERT, [(r["id"], ts, uid, campo, r["antes"], valor) for r in changed])
+            if col == "paqueteria_id":
+                pdf_prerender(*ids)   # la paquetería sale en el PDF; el estado no
+    return {"campo": campo, "valor": valor, "seleccionados": len(rows), "cambiados": len(ids),
+            "sin_cambio": len(rows) - len(ids), "ids": ids}
+
+@app.post("/admin/pedidos/cambio")
+@login_required
+@role_required("admin")
+def admin_pedidos_cambio():
+    """campo=estado|paqueteria, valor=…, y ids=1,2,3 o los filtros de /admin/pedidos (estado, paqueteria_id,
+    ciudad, desde, hasta). Responde JSON si se pide; si no, flash + regreso al listado filtrado."""
+    campo, raw = request.values.get("campo", ""), request.values.get("valor", "")
+    if campo == "estado":
+        if raw not in ESTADOS:
+            abort(400)
+        valor = raw
+    elif campo == "paqueteria":
+        valor = valor_paqueteria(raw)
+    else:
+        abort(400)
+    where, params, filtros = pedidos_filtros(request.values)
+    ids = [int(x) for v in request.values.getlist("ids") for x in v.split(",") if x.strip().isdigit()]
+    if ids:
+        where.append("p.id IN (SELECT value FROM json_each(?))"); params.append(json.dumps(ids))
+    if not where:
+        abort(400)   # sin ids ni filtros sería "todos los pedidos": no se permite
+    r = cambiar_pedidos(where, params, campo, valor)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(r)
+    flash(f"{r['cambiados']} de {r['seleccionados']} pedidos actualizados.", "ok")
+    return redirect(url_for("admin_pedidos", **{k: v for k, v in filtros.items() if v}))
+
+def produccion_resumen(estado=None):
+    """Totales del rollup: [{fecha, estados: {estado: {concepto: {color: piezas}}}}] por fecha."""
+    rows = query_all(f"""
+        SELECT fecha, estado, concepto, color, piezas, pedidos FROM produccion_rollup
+        {"WHERE estado = ?" if estado else ""}
+        ORDER BY fecha, estado, concepto, color
+    """, (estado,) if estado else ())
+    fechas = {}
+    for r in rows:
+        f = fechas.setdefault(r["fecha"], {"fecha": r["fecha"], "estados": {}})
+        f["estados"].setdefault(r["estado"], {}).setdefault(r["concepto"], {})[r["color"]] = r["piezas"]
+    return list(fechas.values())
+
+@app.get("/admin/produccion")
+@login_required
+@role_required("admin")
+def admin_produccion():
+    estado = request.args.get("estado") or None
+    return render_template("admin_produccion.html", fechas=produccion_resumen(estado),
+                           conceptos=PRODUCCION_CONCEPTOS, estados=ESTADOS, estado=estado)
+
+@app.get("/admin/produccion.json")
+@login_required
+@role_required("admin")
+def admin_produccion_json():
+    return jsonify(produccion_resumen(request.args.get("estado") or None))
+
+# ------------ Historial de estados: tiempos por estado y pedidos atascados ------------
+ESTADOS_FINALES = ("Entregado", "Cancelado")
+ESTADO_ATASCADO_DIAS = float(os.getenv("ESTADO_ATASCADO_DIAS", "7"))
+
+def estados_resumen():
+    """Por estado: tramos terminados con promedio/p50/p90/máximo en horas, y pedidos que están ahí ahora.
+
+    Los percentiles salen de un histograma por hora (índice (anterior, horas_anterior), sin sort) y una
+    suma acumulada por ventana; el p50/p90 es la hora en que el acumulado cruza el 50/90 %.
+    """
+    dist = {r["estado"]: dict(r) for r in query_all("""
+        WITH h AS (
+            SELECT anterior AS estado, horas_anterior AS horas, COUNT(*) AS n
+            FROM pedido_estado_log
+            WHERE anterior IS NOT NULL AND horas_anterior IS NOT NULL
+            GROUP BY anterior, horas_anterior
+        ), c AS (
+            SELECT estado, horas, n,
+                   SUM(n) OVER (PARTITION BY estado ORDER BY horas) AS acum,
+                   SUM(n) OVER (PARTITION BY estado) AS total
+            FROM h
+        )
+        SELECT estado, MAX(total) AS tramos, ROUND(1.0 * SUM(horas * n) / MAX(total), 1) AS promedio_h,
+               MIN(CASE WHEN acum >= 0.5 * total THEN horas END) AS p50_h,
+               MIN(CASE WHEN acum >= 0.9 * total THEN horas END) AS p90_h,
+               MAX(horas) AS max_h
+        FROM c GROUP BY estado
+    """)}
+    actual = {r["estado"]: dict(r) for r in query_all("""
+        SELECT estado, COUNT(*) AS ahora, ROUND(AVG(julianday('now') - julianday(estado_desde)), 1) AS edad_dias
+        FROM pedidos GROUP BY estado
+    """)}
+    vacio = {"tramos": 0, "promedio_h": None, "p50_h": None, "p90_h": None, "max_h": None, "ahora": 0, "edad_dias": None}
+    orden = {e: i for i, e in enumerate(ESTADOS)}
+    return [{**vacio, **dist.get(e, {}), **actual.get(e, {}), "estado": e}
+            for e in sorted(set(dist) | set(actual), key=lambda e: (orden.get(e, len(orden)), e or ""))]
+
+def pedidos_atascados(dias=ESTADO_ATASCADO_DIAS, limit=50):
+    """Pedidos en un estado no final desde hace más de `dias` días: los `limit` más viejos de cada estado,
+    con cuántos hay en total por estado. Cada estado es un rango del índice (estado, estado_desde)."""
+    corte = (datetime.utcnow() - timedelta(days=dias)).isoformat()
+    abiertos = json.dumps([e for e in ESTADOS if e not in ESTADOS_FINALES])
+    return [dict(r) for r in query_all("""
+        WITH s AS MATERIALIZED (
+            SELECT key, value AS estado,
+                   (SELECT COUNT(*) FROM pedidos c WHERE c.estado = j.value AND c.estado_desde < ?) AS en_estado
+            FROM json_each(?) j
+        )
+        SELECT p.id AS pedido_id, p.estado, p.estado_desde AS desde,
+               ROUND(julianday('now') - julianday(p.estado_desde), 1) AS dias, s.en_estado,
+               e.nombre AS escuela, e.ciudad AS escuela_ciudad
+        FROM s
+        JOIN pedidos p ON p.id IN (SELECT x.id FROM pedidos x WHERE x.estado = s.estado AND x.estado_desde < ?
+                                   ORDER BY x.estado_desde LIMIT ?)
+        LEFT JOIN escuelas e ON e.id = p.escuela_id
+        ORDER BY s.key, p.estado_desde
+    """, (corte, abiertos, corte, limit))]
+
+def reporte_estados(dias):
+    # cualquier cambio de estado pasa por UPDATE pedidos → la etiqueta "pedidos" invalida el reporte
+    return CACHE.cached(f"admin:estados:{dias}", lambda: {
+        "estados": estados_resumen(), "atascados": pedidos_atascados(dias), "dias": dias}, tags=("pedidos",))
+
+def _dias_arg():
+    # entero de 1 a 365: cada valor es una entrada de la caché, así que no se aceptan fracciones
+    try:
+        return max(1, min(int(request.args.get("dias") or ESTADO_ATASCADO_DIAS), 365))
+    except ValueError:
+        abort(400)
+
+@app.get("/admin/estados")
+@login_required
+@role_required("admin")
+def admin_estados():
+    return render_template("admin_estados.html", **reporte_estados(_dias_arg()))
+
+@app.get("/admin/estados.json")
+@login_required
+@role_required("admin")
+def admin_estados_json():
+    return jsonify(reporte_estados(_dias_arg()))
+
+# ------------ Histórico: temporadas archivadas (ATTACH sólo aquí) ------------
+@app.get("/admin/historico")
+@login_required
+@role_required("admin")
+def admin_historico():
+    """Pedidos de una temporada archivada; mismos filtros y cursor que /admin/pedidos."""
+    temporadas = temporadas_archivadas()
+    try:
+        temp = int(request.args.get("temporada") or (temporadas[0] if temporadas else 0))
+    except ValueError:
+        abort(400)
+    where, params, filtros, limit = keyset_args(request.args)
+    pedidos, next_cursor, next_url = [], None, None
+    if temp in temporadas:
+        with archivo(temp) as db:
+            rows = db.execute(f"""
+                SELECT {PEDIDO_LIST_COLS}, e.nombre AS escuela, e.ciudad AS escuela_ciudad, pa.nombre AS paqueteria
+                FROM arch.pedidos p
+                LEFT JOIN main.escuelas e ON e.id = p.escuela_id
+                LEFT JOIN main.paqueterias pa ON pa.id = p.paqueteria_id
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT ?
+            """, (*params, limit + 1)).fetchall()
+        pedidos, next_cursor, next_url = keyset_pagina(rows, limit, "admin_historico", filtros, temporada=temp)
+    if pide_json():
+        return link_next(jsonify(temporadas=temporadas, temporada=temp, pedidos=[dict(r) for r in pedidos],
+                                 filtros=filtros, next_cursor=next_cursor, next_url=next_url), next_url)
+    return link_next(make_response(render_template(
+        "admin_historico.html", temporadas=temporadas, temporada=temp, pedidos=pedidos, estados=ESTADOS,
+        filtros=filtros, next_cursor=next_cursor, next_url=next_url)), next_url)
+
+@app.get("/admin/historico/<int:temp>/pedido/<int:pedido_id>")
+@login_required
+@role_required("admin")
+def admin_historico_pedido(temp, pedido_id):
+    with archivo(temp) as db:
+        p = db.execute(f"""
+            SELECT {PEDIDO_DETALLE_COLS}
+            FROM arch.pedidos p
+            LEFT JOIN main.escuelas e ON e.id = p.escuela_id
+            LEFT JOIN main.paqueterias pa ON pa.id = p.paqueteria_id
+            WHERE p.id = ?
+        """, (pedido_id,)).fetchone()
+        if not p: abort(404)
+        items = db.execute("SELECT grupo, nombre, color_pelo, calceta FROM arch.pedido_items WHERE pedido_id = ? "
+                           "ORDER BY grupo, pos", (pedido_id,)).fetchall()
+        historial = db.execute("SELECT estado, ts FROM arch.pedido_estado_log WHERE pedido_id = ? ORDER BY ts, id",
+                               (pedido_id,)).fetchall()
+    ninas, ninos = pedido_items(p, items)
+    if pide_json():
+        return jsonify(pedido=dict(p), ninas=ninas, ninos=ninos, historial=[dict(r) for r in historial],
+                       fechas=parse_json_list(p["fechas_entrega"]), archivado=temp)
+    return render_template("pedido_detail.html", p=p, ninas=ninas, ninos=ninos, historial=historial,
+                           fechas=parse_json_list(p["fechas_entrega"]), archivado=temp)
+
+def pedido_historial(pedido_id):
+    return query_all("SELECT estado, ts FROM pedido_estado_log WHERE pedido_id = ? ORDER BY ts, id", (pedido_id,))
+
 @app.get("/admin/pedido/<int:pedido_id>")
 @login_required
 @role_required("admin","vendedora","escuela")
 def pedido_detalle(pedido_id):
-    p = query_one("""
-        SELECT p.*, e.nombre AS escuela, e.ciudad AS escuela_ciudad, e.grado AS escuela_grado, e.contacto, e.telefono,
-               e.direccion, e.colonia, e.codigo_postal, e.estado AS escuela_estado, e.referencias,
-               e.dest_nombre, e.dest_tel, e.dest_cp, e.dest_colonia, e.dest_direccion, e.dest_correo,
-               pa.nombre AS paqueteria
-        FROM pedidos p
-        JOIN escuelas e ON e.id = p.escuela_id
-        LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
-        WHERE p.id = ?
-    """, (pedido_id,))
+    # una consulta por llave primaria, ya filtrada por rol: autoriza, trae el detalle y da las versiones del ETag
+    p = pedido_visible(pedido_id)
     if not p: abort(404)
-    role = session.get("role")
-    if role == "escuela":
-        esc_user = query_one("SELECT user_id FROM escuelas WHERE id=?", (p["escuela_id"],))
-        if not esc_user or esc_user["user_id"] != session["user_id"]:
-            abort(403)
-    if role == "vendedora":
-        esc = query_one("SELECT vendedora_id FROM escuelas WHERE id=?", (p["escuela_id"],))
-        if not esc or esc["vendedora_id"] != session["user_id"]:
-            abort(403)
-    def parse(js):
-        try: return json.loads(js) if js else []
-        except Exception: return []
-    ninas = parse(p["ninas_json"]); ninos = parse(p["ninos_json"])
-    fechas = parse(p["fechas_entrega"] or "[]")
-    return render_template("pedido_detail.html", p=p, ninas=ninas, ninos=ninos, fechas=fechas)
+    etag = page_etag("pedido", pedido_id, p["version"], p["esc_version"], p["paq_version"])
+    resp = not_modified(etag)
+    if resp:
+        return resp
+    ninas, ninos = pedido_items(p)
+    fechas = parse_json_list(p["fechas_entrega"])
+    return with_etag(render_template("pedido_detail.html", p=p, ninas=ninas, ninos=ninos, fechas=fechas,
+                                     historial=pedido_historial(pedido_id)), etag)
 
 @app.get("/admin/pedido/<int:pedido_id>/pdf")
 @login_required
 @role_required("admin")
 def pedido_pdf(pedido_id):
-    try:
-        from reportlab.lib.pagesizes import letter
-        from reportlab.pdfgen import canvas
-    except Exception as e:
-        flash("No se pudo generar PDF (falta dependencia reportlab). Usa el botón Imprimir.", "error")
-        return redirect(url_for("pedido_detalle", pedido_id=pedido_id))
-
-    p = query_one("""
-        SELECT p.*, e.nombre AS escuela, e.ciudad AS escuela_ciudad, e.grado AS escuela_grado, e.contacto, e.telefono,
-               e.direccion, e.colonia, e.codigo_postal, e.estado AS escuela_estado, e.referencias,
-               e.dest_nombre, e.dest_tel, e.dest_cp, e.dest_colonia, e.dest_direccion, e.dest_correo,
-               pa.nombre AS paqueteria
-        FROM pedidos p
-        JOIN escuelas e ON e.id = p.escuela_id
-        LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
-        WHERE p.id = ?
-    """, (pedido_id,))
+    p = query_one(PEDIDO_DETALLE_SQL, (pedido_id,))
     if not p: abort(404)
-    def parse(js):
-        try: return json.loads(js) if js else []
-        except Exception: return []
-    ninas = parse(p["ninas_json"]); ninos = parse(p["ninos_json"]); fechas = parse(p["fechas_entrega"] or "[]")
-    buffer = io.BytesIO()
-    # PDF
-    from reportlab.lib.pagesizes import letter
-    from reportlab.pdfgen import canvas
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 40
-    c.setFont("Helvetica-Bold", 14); c.drawString(40, y, "Pedido - Pedidos GS"); y -= 20
-    c.setFont("Helvetica", 10)
-    c.drawString(40, y, f"Escuela: {p['escuela']}  |  Ciudad: {p['escuela_ciudad']}  |  Grado: {p['escuela_grado']}"); y -= 14
-    c.drawString(40, y, f"Contacto: {p['contacto']}  Tel: {p['telefono']}"); y -= 14
-    c.drawString(40, y, f"Dirección: {p['direccion'] or ''} {p['colonia'] or ''} CP {p['codigo_postal'] or ''} {p['escuela_estado'] or ''}"); y -= 14
-    c.drawString(40, y, f"Paquetería asignada: {p['paqueteria'] or '—'}  |  Entrega: {p['entrega'] or '—'}"); y -= 14
-    c.drawString(40, y, f"Calceta niñas: {p['color_calceta_ninas'] or '—'}  Zapato niñas: {p['color_zapato_ninas'] or '—'}  Zapato niños: {p['color_zapato_ninos'] or '—'}"); y -= 14
-    c.drawString(40, y, f"Moños: {p['color_monos'] or '—'}  Pantalón: {p['color_pantalon'] or '—'}  Escudos por bordar: {p['escudos_bordar'] or '—'}"); y -= 14
-    c.drawString(40, y, f"Fechas de entrega: {', '.join(fechas) if fechas else '—'}"); y -= 20
-    def draw_group(title, arr):
-        nonlocal y
-        c.setFont("Helvetica-Bold", 12); c.drawString(40, y, title); y -= 16; c.setFont("Helvetica", 10)
-        for it in arr:
-            c.drawString(50, y, f"- {it.get('nombre','')} (Pelo: {it.get('color_pelo','')})")
-            y -= 14
-            if y < 60: c.showPage(); y = height - 40
-    draw_group("Niñas", ninas); y -= 8; draw_group("Niños", ninos)
-    y -= 8; c.setFont("Helvetica-Bold", 12); c.drawString(40, y, "Comentarios"); y -= 16; c.setFont("Helvetica", 10)
-    for line in (p["comentario"] or "").splitlines():
-        c.drawString(50, y, line[:100]); y -= 14
-        if y < 60: c.showPage(); y = height - 40
-    c.showPage(); c.save(); buffer.seek(0)
-    return send_file(buffer, mimetype="application/pdf", as_attachment=True, download_name=f"pedido_{pedido_id}.pdf")
+    data = pdf_data(p)
+    key = pdf_key(data)
+    path = pdf_path(pedido_id, key)
+    if not os.path.exists(path):
+        from concurrent.futures import TimeoutError as FutTimeout   # antes de 3.11 no es el TimeoutError builtin
+        try:
+            pdf_submit(pedido_id, key, data).result(timeout=PDF_WAIT)
+        except FutTimeout:
+            return ("Generando PDF…", 202, {"Retry-After": "2", "Refresh": "2"})
+        except ImportError:
+            flash("No se pudo generar PDF (falta dependencia reportlab). Usa el botón Imprimir.", "error")
+            return redirect(url_for("pedido_detalle", pedido_id=pedido_id))
+    resp = send_file(path, mimetype="application/pdf", as_attachment=True, download_name=f"pedido_{pedido_id}.pdf",
+                     etag=key, conditional=True, max_age=0)
+    resp.cache_control.private = True
+    return resp
+
+PDF_BATCH_MAX = int(os.getenv("PDF_BATCH_MAX", "500"))
+# un solo documento con más pedidos que esto lo arma el worker (job export): reportlab no escribe nada hasta save()
+PDF_LOTE_DIRECTO = int(os.getenv("PDF_LOTE_DIRECTO", "50"))
+
+class _ZipStream(io.RawIOBase):
+    """Destino no-seekable para zipfile: lo escrito se entrega por pedazos al response."""
+    def __init__(self):
+        self.buf = bytearray()
+    def writable(self):
+        return True
+    def write(self, b):
+        self.buf += b
+        return len(b)
+    def take(self):
+        out = bytes(self.buf); self.buf.clear()
+        return out
+
+def pedidos_lote(values):
+    """Pedidos del lote (ids= o filtros estado/fecha/paqueteria_id) en una sola consulta."""
+    where, params = [], []
+    ids = [int(x) for raw in values.getlist("ids") for x in raw.split(",") if x.strip().isdigit()]
+    if ids:
+        where.append("p.id IN (SELECT value FROM json_each(?))"); params.append(json.dumps(ids))
+    if values.get("estado"):
+        where.append("p.estado = ?"); params.append(values["estado"])
+    if values.get("paqueteria_id"):
+        where.append("p.paqueteria_id = ?"); params.append(values["paqueteria_id"])
+    fecha = (values.get("fecha") or "").strip()
+    if fecha:
+        if "-" in fecha:   # aaaa-mm-dd (input date) → dd/mm/aaaa como se guarda
+            try: fecha = datetime.strptime(fecha, "%Y-%m-%d").strftime("%d/%m/%Y")
+            except ValueError: abort(400)
+        where.append("p.fechas_entrega LIKE ?"); params.append(f'%"{fecha}"%')
+    if not where:
+        abort(400)
+    rows = query_all(f"""
+        SELECT {PEDIDO_DETALLE_COLS} {PEDIDO_DETALLE_JOINS}
+        WHERE {" AND ".join(where)}
+        ORDER BY p.created_at, p.id
+        LIMIT ?
+    """, (*params, PDF_BATCH_MAX + 1))
+    if len(rows) > PDF_BATCH_MAX:
+        abort(400, description=f"Más de {PDF_BATCH_MAX} pedidos; acota el filtro.")
+    return rows
+
+@app.route("/admin/pedidos/pdf", methods=["GET","POST"])
+@login_required
+@role_required("admin")
+def admin_pedidos_pdf_lote():
+    rows = pedidos_lote(request.values)
+    if not rows:
+        flash("Ningún pedido coincide con el filtro.", "error")
+        return redirect(url_for("admin_pedidos"))
+    if request.values.get("formato") == "pdf" and len(rows) > PDF_LOTE_DIRECTO:
+        # se arma en el worker con los mismos pedidos; /admin/export/<id> lo entrega cuando está listo
+        job_id = encolar("export", {"formato": "pdf", "filtros": {}, "user_id": session.get("user_id"),
+                                    "ids": ",".join(str(r["id"]) for r in rows)})
+        if pide_json():
+            return jsonify(job_id=job_id, url=url_for("admin_export_job", job_id=job_id)), 202
+        return redirect(url_for("admin_export_job", job_id=job_id))
+    items = pedidos_items_map(rows)
+    datas = [pdf_data(r, items[r["id"]]) for r in rows]
+    stamp = datetime.utcnow().strftime("%Y%m%d_%H%M")
+
+    if request.values.get("formato") == "pdf":
+        # un solo documento: el pool lo escribe a un temporal y aquí se transmite por pedazos
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(PDF_CACHE_DIR, f"lote_{stamp}_{secrets.token_hex(4)}.pdf")
+        fut = pdf_executor().submit(render_pedidos_pdf, datas, tmp)
+        def gen_pdf():
+            try:
+                with open(fut.result(), "rb") as f:
+                    while chunk := f.read(64 * 1024):
+                        yield chunk
+            finally:
+                try: os.remove(tmp)
+                except OSError: pass
+        return Response(gen_pdf(), mimetype="application/pdf", headers={
+            "Content-Disposition": f"attachment; filename=pedidos_{stamp}.pdf"})
+
+    # ZIP: cada PDF sale de la caché o del pool; en memoria sólo hay uno a la vez
+    jobs = []
+    for d in datas:
+        key = pdf_key(d)
+        path = pdf_path(d["id"], key)
+        jobs.append((d["id"], path if os.path.exists(path) else pdf_submit(d["id"], key, d)))
+    import zipfile
+    def gen_zip():
+        out = _ZipStream()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as zf:
+            for pedido_id, job in jobs:
+                path = job if isinstance(job, str) else job.result()
+                with open(path, "rb") as f:
+                    zf.writestr(f"pedido_{pedido_id}.pdf", f.read())
+                yield out.take()
+        yield out.take()
+    return Response(gen_zip(), mimetype="application/zip", headers={
+        "Content-Disposition": f"attachment; filename=pedidos_{stamp}.zip"})
+
+# ---------- Exportación CSV / XLSX ----------
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "2000"))
+EXPORT_COLS = ["pedido_id","fecha_pedido","estado","escuela","ciudad","grado","paqueteria","entrega","fechas_entrega",
+               "color_calceta_ninas","color_zapato_ninas","color_zapato_ninos","color_monos","color_pantalon",
+               "escudos_bordar","comentario","grupo","alumno","color_pelo"]
+GRUPO_LABEL = {"ninas": "Niña", "ninos": "Niño"}
+
+def export_rows(where, params, chunk=EXPORT_CHUNK):
+    """Filas planas (una por alumno) por ventanas de `chunk` ids de pedido.
+
+    Cada ventana es una consulta corta sobre un rango de rowid en su propia conexión:
+    no queda abierta una transacción de lectura durante toda la descarga. NOT INDEXED
+    evita que un filtro (p. ej. estado) cambie el recorrido por rowid por un sort.
+    """
+    db = connect_db()
+    try:
+        lo = 0
+        hi_max = db.execute("SELECT COALESCE(MAX(id), 0) FROM pedidos").fetchone()[0]
+        while lo < hi_max:
+            hi = lo + chunk
+            rows = db.execute(f"""
+                SELECT p.id, p.created_at, p.estado, e.nombre AS escuela, p.ciudad, p.grado, pa.nombre AS paqueteria,
+                       p.entrega, p.fechas_entrega, p.color_calceta_ninas, p.color_zapato_ninas, p.color_zapato_ninos,
+                       p.color_monos, p.color_pantalon, p.escudos_bordar, p.comentario,
+                       i.grupo, i.nombre AS alumno, i.color_pelo,
+                       CASE WHEN i.id IS NULL THEN p.ninas_json END AS ninas_json,
+                       CASE WHEN i.id IS NULL THEN p.ninos_json END AS ninos_json
+                FROM pedidos p NOT INDEXED
+                JOIN escuelas e ON e.id = p.escuela_id
+                LEFT JOIN paqueterias pa ON pa.id = p.paqueteria_id
+                LEFT JOIN pedido_items i ON i.pedido_id = p.id
+                WHERE p.id > ? AND p.id <= ? {"AND " + " AND ".join(where) if where else ""}
+                ORDER BY p.id, i.grupo, i.pos
+            """, (lo, hi, *params)).fetchall()
+            lo = hi
+            if not rows:
+                continue
+            out = []
+            for r in rows:
+                base = [r["id"], r["created_at"], r["estado"], r["escuela"], r["ciudad"], r["grado"], r["paqueteria"],
+                        r["entrega"], ", ".join(parse_json_list(r["fechas_entrega"])),
+                        r["color_calceta_ninas"], r["color_zapato_ninas"], r["color_zapato_ninos"],
+                        r["color_monos"], r["color_pantalon"], r["escudos_bordar"], r["comentario"]]
+                if r["grupo"]:
+                    out.append(base + [GRUPO_LABEL[r["grupo"]], r["alumno"], r["color_pelo"]])
+                    continue
+                # pedido sin backfill (o sin alumnos): se expande el JSON
+                kids = [(g, it) for g in GRUPOS for it in parse_json_list(r[f"{g}_json"])]
+                for g, it in kids:
+                    out.append(base + [GRUPO_LABEL[g], it.get("nombre",""), it.get("color_pelo","")])
+                if not kids:
+                    out.append(base + ["", "", ""])
+            yield out
+    finally:
+        db.close()
+
+def export_csv_chunks(where, params):
+    """El CSV por pedazos de texto (un lote de export_rows cada uno)."""
+    import csv
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    buf.write("\ufeff")   # BOM: Excel abre bien los acentos
+    w.writerow(EXPORT_COLS)
+    for rows in export_rows(where, params):
+        w.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def write_export_xlsx(path, where, params):
+    import xlsxwriter
+    # constant_memory: cada fila se escribe a disco al pasar a la siguiente; en memoria sólo hay un lote
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        ws = wb.add_worksheet("Pedidos")
+        ws.write_row(0, 0, EXPORT_COLS)
+        n = 1
+        for rows in export_rows(where, params):
+            for row in rows:
+                ws.write_row(n, 0, row)
+                n += 1
+    finally:
+        wb.close()
+
+def export_total(where, params):
+    """Pedidos que abarca una exportación (decide si se arma en el request o en el worker)."""
+    return query_one(f"SELECT COUNT(*) AS n FROM pedidos p {'WHERE ' + ' AND '.join(where) if where else ''}",
+                     params)["n"]
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# el XLSX se termina antes de mandar el primer byte: más pedidos que esto van al worker (job export)
+EXPORT_XLSX_DIRECTO = int(os.getenv("EXPORT_XLSX_DIRECTO", "2000"))
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(BASE_DIR, "cache", "export"))
+
+@job_handler("export", intentos=3, visibilidad=1800)
+def _job_export(formato, filtros, user_id=None, ids=None):
+    """Genera el archivo en EXPORT_DIR; /admin/export/<job_id> lo entrega cuando está listo.
+
+    formato=pdf es un lote de PDFs en un solo documento (`ids` separados por coma, ver admin_pedidos_pdf_lote).
+    """
+    where, params, _ = pedidos_filtros(filtros)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    name = f"pedidos_{datetime.utcnow():%Y%m%d_%H%M}_{generate_token(8)}.{formato}"
+    path = os.path.join(EXPORT_DIR, name)
+    tmp = os.path.join(EXPORT_DIR, f"tmp_{name}")   # xlsxwriter exige la extensión
+    try:
+        if formato == "xlsx":
+            write_export_xlsx(tmp, where, params)
+        elif formato == "pdf":
+            from werkzeug.datastructures import MultiDict
+            rows = pedidos_lote(MultiDict({"ids": ids or ""}))
+            items = pedidos_items_map(rows)
+            render_pedidos_pdf([pdf_data(r, items[r["id"]]) for r in rows], tmp)
+        else:
+            with open(tmp, "w", encoding="utf-8", newline="") as f:
+                for chunk in export_csv_chunks(where, params):
+                    f.write(chunk)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return {"archivo": name}
+
+@app.get("/admin/export/pedidos.csv")
+@login_required
+@role_required("admin")
+def admin_export_csv():
+    where, params, _ = pedidos_filtros(request.args)
+    stamp = datetime.utcnow().strftime("%Y%m%d_%H%M")
+    return Response(export_csv_chunks(where, params), mimetype="text/csv", headers={
+        "Content-Disposition": f"attachment; filename=pedidos_{stamp}.csv"})
+
+@app.get("/admin/export/pedidos.xlsx")
+@login_required
+@role_required("admin")
+def admin_export_xlsx():
+    import tempfile
+    where, params, filtros = pedidos_filtros(request.args)
+    if export_total(where, params) > EXPORT_XLSX_DIRECTO:
+        job_id = encolar("export", {"formato": "xlsx", "filtros": filtros, "user_id": session.get("user_id")})
+        if pide_json():
+            return jsonify(job_id=job_id, url=url_for("admin_export_job", job_id=job_id)), 202
+        return redirect(url_for("admin_export_job", job_id=job_id))
+    # el archivo terminado se transmite y se borra
+    fd, tmp = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        write_export_xlsx(tmp, where, params)
+    except Exception:
+        os.remove(tmp)
+        raise
+    def gen():
+        try:
+            with open(tmp, "rb") as f:
+                while chunk := f.read(64 * 1024):
+                    yield chunk
+        finally:
+            os.remove(tmp)
+    stamp = datetime.utcnow().strftime("%Y%m%d_%H%M")
+    return Response(gen(), mimetype=XLSX_MIME, headers={
+        "Content-Disposition": f"attachment; filename=pedidos_{stamp}.xlsx"})
+
+@app.post("/admin/export")
+@login_required
+@role_required("admin")
+def admin_export_encolar():
+    """formato=csv|xlsx + los filtros de /admin/pedidos: la exportación se genera en el worker."""
+    formato = request.values.get("formato", "xlsx")
+    if formato not in ("csv", "xlsx"):
+        abort(400)
+    _, _, filtros = pedidos_filtros(request.values)   # valida las fechas antes de encolar
+    job_id = encolar("export", {"formato": formato, "filtros": filtros, "user_id": session.get("user_id")})
+    if pide_json():
+        return jsonify(job_id=job_id, url=url_for("admin_export_job", job_id=job_id)), 202
+    return redirect(url_for("admin_export_job", job_id=job_id))
+
+@app.get("/admin/export/<int:job_id>")
+@login_required
+@role_required("admin")
+def admin_export_job(job_id):
+    job = query_one("SELECT estado, resultado, error FROM jobs WHERE id = ? AND tipo = 'export'", (job_id,))
+    if not job:
+        abort(404)
+    if job["estado"] == "muerto":
+        flash("No se pudo generar la exportación.", "error")
+        return redirect(url_for("admin_pedidos"))
+    if job["estado"] != "hecho":
+        return ("Generando exportación…", 202, {"Retry-After": "3", "Refresh": "3"})
+    name = json.loads(job["resultado"])["archivo"]
+    if not os.path.exists(os.path.join(EXPORT_DIR, name)):
+        abort(410)   # ya se purgó
+    mimetype = {"xlsx": XLSX_MIME, "pdf": "application/pdf"}.get(name.rsplit(".", 1)[-1], "text/csv")
+    return send_from_directory(EXPORT_DIR, name, as_attachment=True, max_age=0, mimetype=mimetype)
 
 # ---------- Vendedora ----------
 @app.get("/vendedora")
 @login_required
 @role_required("vendedora")
 def vendedora_dashboard():
-    escuelas = query_all("""
-        SELECT e.*, (SELECT COUNT(1) FROM pedidos p WHERE p.escuela_id=e.id) AS pedidos_count
-        FROM escuelas e WHERE e.vendedora_id = ?
+    # una sola consulta indexada: escuelas de la vendedora + sus contadores por estado
+    rows = query_all("""
+        SELECT e.*, c.estado AS c_estado, c.n AS c_n
+        FROM escuelas e
+        LEFT JOIN escuela_pedidos c ON c.escuela_id = e.id
+        WHERE e.vendedora_id = ?
         ORDER BY e.nombre
     """, (session["user_id"],))
+    escuelas, by_id = [], {}
+    for r in rows:
+        esc = by_id.get(r["id"])
+        if esc is None:
+            esc = {k: r[k] for k in r.keys() if k not in ("c_estado", "c_n")}
+            esc.update(pedidos_count=0, pedidos_por_estado={})
+            by_id[r["id"]] = esc
+            escuelas.append(esc)
+        if r["c_estado"] is not None:
+            esc["pedidos_count"] += r["c_n"]
+            esc["pedidos_por_estado"][r["c_estado"]] = r["c_n"]
     return render_template("vendedora_dashboard.html", escuelas=escuelas)
 
+# ---------- Importación de pedidos (CSV / XLSX) ----------
+# Una fila por alumno, como la exportación. Las filas con el mismo escuela_id y `pedido` forman un
+# pedido; sus datos generales salen de la primera fila. Un pedido con alguna fila inválida no se crea.
+NOMBRE_MAX = 30   # igual que el formulario (parse_grupo)
+IMPORT_MAX_FILAS = int(os.getenv("IMPORT_MAX_FILAS", "20000"))
+IMPORT_LOTE = int(os.getenv("IMPORT_LOTE", "200"))   # pedidos por transacción
+IMPORT_MAX_MB = float(os.getenv("IMPORT_MAX_MB", "16"))   # tope del archivo subido
+IMPORT_MAX_BYTES = int(IMPORT_MAX_MB * (1 << 20))
+IMPORT_EN_MEMORIA = 1 << 20   # el cuerpo crudo se queda en RAM hasta 1 MB; lo demás va a un temporal en disco
+# ningún otro POST se acerca a este tamaño; los 64 KB extra son para el multipart
+app.config["MAX_CONTENT_LENGTH"] = IMPORT_MAX_BYTES + (1 << 16)
+IMPORT_REQUERIDAS = ("escuela_id", "grupo", "nombre")
+IMPORT_COLS_PEDIDO = ("ciudad", "grado", "comentario", "color_calceta_ninas", "color_zapato_ninas",
+                      "color_zapato_ninos", "color_monos", "color_pantalon", "escudos_bordar", "fechas_entrega", "entrega")
+IMPORT_COLS = ("escuela_id", "pedido", "grupo", "nombre", "color_pelo", "calceta") + IMPORT_COLS_PEDIDO
+IMPORT_ALIAS = {"alumno": "nombre", "escuela": "escuela_id", "referencia": "pedido"}
+IMPORT_GRUPOS = {"ninas": "ninas", "nina": "ninas", "f": "ninas", "ninos": "ninos", "nino": "ninos", "m": "ninos"}
+IMPORT_ENTREGA = {"ocurre": "Ocurre", "domicilio": "Domicilio", "": ""}
+IMPORT_PEDIDO_INSERT = """
+    INSERT INTO pedidos(
+        escuela_id,ciudad,grado,ninas_json,ninos_json,comentario,estado,created_at,
+        color_calceta_ninas,color_zapato_ninas,color_zapato_ninos,color_monos,color_pantalon,escudos_bordar,fechas_entrega,entrega
+    )
+    SELECT e.id,COALESCE(NULLIF(?,''),e.ciudad),COALESCE(NULLIF(?,''),e.grado),?,?,?,'Nuevo',?,?,?,?,?,?,?,?,?
+    FROM escuelas e WHERE e.id = ?
+"""
+
+class ImportacionInvalida(ValueError):
+    """El archivo completo se rechaza (formato, encabezado, tamaño, llave usada con otro archivo)."""
+    def __init__(self, msg, status=400):
+        super().__init__(msg)
+        self.status = status
+
+def _import_clave(texto):
+    import unicodedata
+    t = unicodedata.normalize("NFKD", str(texto or "")).encode("ascii", "ignore").decode().strip().lower()
+    return re.sub(r"[^a-z0-9]+", "_", t).strip("_")
+
+def _import_celda(v):
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    elif isinstance(v, datetime):
+        return v.strftime("%d/%m/%Y")
+    return str(v).strip()
+
+def import_filas(f, nombre, encoding="utf-8-sig"):
+    """(número de fila, {columna: texto}) del CSV o XLSX, leído por partes; la primera fila es el encabezado."""
+    if nombre.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+        try:
+            filas = load_workbook(f, read_only=True, data_only=True).worksheets[0].iter_rows(values_only=True)
+        except Exception:
+            raise ImportacionInvalida("El XLSX no se pudo abrir.")
+    elif nombre.lower().endswith((".csv", ".txt")):
+        import csv, itertools
+        texto = io.TextIOWrapper(f, encoding=encoding, newline="")
+        primera = texto.readline()
+        delim = ";" if primera.count(";") > primera.count(",") else ","   # Excel en español guarda con ';'
+        filas = csv.reader(itertools.chain([primera], texto), delimiter=delim)
+    else:
+        raise ImportacionInvalida("Sube un archivo .csv o .xlsx.")
+    cols = [IMPORT_ALIAS.get(c, c) for c in map(_import_clave, next(filas, None) or ())]
+    faltan = [c for c in IMPORT_REQUERIDAS if c not in cols]
+    if faltan:
+        raise ImportacionInvalida(f"Faltan columnas: {', '.join(faltan)}.")
+    for n, row in enumerate(filas, start=2):
+        if n - 1 > IMPORT_MAX_FILAS:
+            raise ImportacionInvalida(f"Máximo {IMPORT_MAX_FILAS} filas por archivo.", 413)
+        vals = {c: _import_celda(v) for c, v in zip(cols, row) if c in IMPORT_COLS}
+        if any(vals.values()):
+            yield n, vals
+
+def _import_fechas(texto):
+    fechas = [x.strip() for x in re.split(r"[,;|]", texto) if x.strip()]
+    for x in fechas:
+        datetime.strptime(x, "%d/%m/%Y")
+    return fechas
+
+def import_validar(filas, permitida):
+    """Agrupa las filas en pedidos y regresa ({ref: pedido} sin errores, errores, avisos, filas leídas).
+    `permitida(escuela_id)` dice si el usuario puede pedir para esa escuela. Errores y avisos son
+    {"fila", "pedido", "mensaje"}."""
+    pedidos, malos, errores, avisos, total = {}, set(), [], [], 0
+    for n, r in filas:
+        total += 1
+        ref = f"{r.get('escuela_id', '')}:{r.get('pedido', '')}"
+        def error(msg):
+            errores.append({"fila": n, "pedido": ref, "mensaje": msg})
+            malos.add(ref)
+        try:
+            esc = int(r.get("escuela_id") or "")
+        except ValueError:
+            esc = None
+        if esc is None or not permitida(esc):
+            error(f"La escuela {r.get('escuela_id') or '(vacía)'} no existe o no es tuya.")
+            continue
+        o = pedidos.get(ref)
+        if o is None:
+            o = pedidos[ref] = {"escuela_id": esc, "fila": n, "ninas": [], "ninos": [],
+                                **{c: r.get(c, "") for c in IMPORT_COLS_PEDIDO}}
+            try:
+                o["escudos_bordar"] = int(o["escudos_bordar"] or 0)
+                if o["escudos_bordar"] < 0:
+                    raise ValueError
+            except ValueError:
+                error("escudos_bordar debe ser un entero ≥ 0.")
+            try:
+                o["fechas_entrega"] = _import_fechas(o["fechas_entrega"])
+            except ValueError:
+                error("fechas_entrega: usa DD/MM/AAAA separadas por coma.")
+            o["entrega"] = IMPORT_ENTREGA.get(_import_clave(o["entrega"]))
+            if o["entrega"] is None:
+                error("entrega debe ser Ocurre o Domicilio.")
+        grupo = IMPORT_GRUPOS.get(_import_clave(r.get("grupo")))
+        if grupo is None:
+            error("grupo debe ser niña o niño.")
+            continue
+        nombre = r.get("nombre", "")
+        if not nombre:
+            avisos.append({"fila": n, "pedido": ref, "mensaje": "Sin nombre: la fila se omitió."})
+            continue
+        if len(nombre) > NOMBRE_MAX:
+            avisos.append({"fila": n, "pedido": ref, "mensaje": f"Nombre recortado a {NOMBRE_MAX} caracteres."})
+        alumno = {"nombre": nombre[:NOMBRE_MAX], "color_pelo": r.get("color_pelo", "")}
+        if r.get("calceta"):
+            alumno["calceta"] = r["calceta"]
+        o[grupo].append(alumno)
+    for ref, o in pedidos.items():
+        if ref not in malos and not (o["ninas"] or o["ninos"]):
+            errores.append({"fila": o["fila"], "pedido": ref, "mensaje": "El pedido no tiene alumnos."})
+            malos.add(ref)
+    return {ref: o for ref, o in pedidos.items() if ref not in malos}, errores, avisos, total
+
+def import_lote(imp_id, lote):
+    """Inserta un lote de pedidos validados en una transacción. Los que otro intento con la misma llave
+    ya dejó (importacion_pedidos) se saltan. Regresa {ref: pedido_id} de todo el lote."""
+    ahora = datetime.utcnow().isoformat()
+    with transaction() as db:
+        hechos = dict(db.execute(
+            "SELECT ref, pedido_id FROM importacion_pedidos WHERE importacion_id = ? AND ref IN (SELECT value FROM json_each(?))",
+            (imp_id, json.dumps([ref for ref, _ in lote]))).fetchall())
+        nuevos, items = {}, []
+        for ref, o in lote:
+            if ref in hechos:
+                continue
+            cur = db.execute(IMPORT_PEDIDO_INSERT, (
+                o["ciudad"], o["grado"], json.dumps(o["ninas"], ensure_ascii=False),
+                json.dumps(o["ninos"], ensure_ascii=False), o["comentario"], ahora,
+                o["color_calceta_ninas"], o["color_zapato_ninas"], o["color_zapato_ninos"], o["color_monos"],
+                o["color_pantalon"], o["escudos_bordar"], json.dumps(o["fechas_entrega"], ensure_ascii=False),
+                o["entrega"], o["escuela_id"]))
+            if cur.rowcount:   # la escuela pudo borrarse después de validar
+                nuevos[ref] = cur.lastrowid
+                items += item_rows(cur.lastrowid, "ninas", o["ninas"]) + item_rows(cur.lastrowid, "ninos", o["ninos"])
+        if nuevos:
+            _tx_written(IMPORT_PEDIDO_INSERT)
+            execute_many(ITEM_INSERT, items)
+            db.executemany("INSERT INTO importacion_pedidos(importacion_id, ref, pedido_id) VALUES (?,?,?)",
+                           [(imp_id, ref, pid) for ref, pid in nuevos.items()])
+            rollup_pedidos(db, list(nuevos.values()), +1)
+            pdf_prerender(*nuevos.values())
+    return {**hechos, **nuevos}
+
+def importar_pedidos(f, nombre, llave=None):
+    """Importa el archivo para el usuario de la sesión y regresa el reporte.
+
+    Un reintento con la misma llave (o con el mismo archivo, si no hay llave) no duplica nada: si la
+    importación terminó entrega el reporte guardado; si se cortó, crea sólo los pedidos que faltaron.
+    """
+    import codecs
+    h, dec, enc = hashlib.sha256(), codecs.getincrementaldecoder("utf-8")(), "utf-8-sig"
+    while chunk := f.read(1 << 16):
+        h.update(chunk)
+        if enc != "cp1252":
+            try:
+                dec.decode(chunk)
+            except UnicodeDecodeError:
+                enc = "cp1252"   # "CSV" de Excel en Windows
+    f.seek(0)
+    sha, uid = h.hexdigest(), session["user_id"]
+    llave = (llave or "").strip()[:200] or f"sha256:{sha}"
+    buscar = "SELECT id, sha256, estado, reporte FROM importaciones WHERE user_id = ? AND llave = ?"
+    imp = query_one(buscar, (uid, llave))
+    if imp and imp["sha256"] != sha:
+        raise ImportacionInvalida("Esa llave ya se usó con otro archivo.", 409)
+    if imp and imp["estado"] == "hecho":
+        return dict(json.loads(imp["reporte"]), repetida=True)
+    cond, params = alcance()
+    vistas = {}
+    def permitida(esc):
+        if esc not in vistas:
+            vistas[esc] = query_one(f"SELECT 1 FROM escuelas e WHERE e.id = ? {cond}", (esc, *params)) is not None
+        return vistas[esc]
+    pedidos, errores, avisos, filas = import_validar(import_filas(f, nombre, enc), permitida)
+    # la llave se registra ya validado el archivo: uno rechazado completo no la gasta
+    execute("""INSERT OR IGNORE INTO importaciones(user_id, llave, sha256, archivo, creado)
+               VALUES (?,?,?,?,?)""", (uid, llave, sha, nombre, datetime.utcnow().isoformat()))
+    imp = query_one(buscar, (uid, llave))
+    if imp["sha256"] != sha:   # otro request ganó la llave con otro archivo mientras validábamos
+        raise ImportacionInvalida("Esa llave ya se usó con otro archivo.", 409)
+    lista, creados = list(pedidos.items()), {}
+    for i in range(0, len(lista), IMPORT_LOTE):
+        creados.update(import_lote(imp["id"], lista[i:i + IMPORT_LOTE]))
+    hechos = [{"pedido": ref, "pedido_id": creados[ref], "ninas": len(o["ninas"]), "ninos": len(o["ninos"])}
+              for ref, o in lista if ref in creados]
+    reporte = {"importacion_id": imp["id"], "llave": llave, "archivo": nombre, "filas": filas,
+               "alumnos": sum(p["ninas"] + p["ninos"] for p in hechos),
+               "pedidos": hechos, "errores": errores, "avisos": avisos}
+    execute("""UPDATE importaciones SET estado = 'hecho', filas = ?, pedidos = ?, reporte = ?, terminado = ?
+               WHERE id = ?""", (filas, len(hechos), json.dumps(reporte, ensure_ascii=False),
+                                 datetime.utcnow().isoformat(), imp["id"]))
+    return dict(reporte, repetida=False)
+
+@app.get("/vendedora/importar")
+@login_required
+@role_required("vendedora", "admin")
+def importar_form():
+    cond, params = alcance()
+    escuelas = query_all(f"""
+        SELECT e.id, e.nombre, e.ciudad FROM escuelas e WHERE 1 {cond} ORDER BY e.nombre
+    """, params)
+    # la llave va en el formulario: si el navegador reenvía el POST no se duplican pedidos
+    form = dict(columnas=IMPORT_COLS, requeridas=IMPORT_REQUERIDAS, llave=generate_token(24), max_filas=IMPORT_MAX_FILAS)
+    if pide_json():
+        return jsonify(escuelas=[dict(r) for r in escuelas], plantilla=url_for("importar_plantilla"), **form)
+    return render_template("vendedora_importar.html", escuelas=escuelas, **form)
+
+@app.get("/vendedora/importar/plantilla.csv")
+@login_required
+@role_required("vendedora", "admin")
+def importar_plantilla():
+    return Response("\ufeff" + ",".join(IMPORT_COLS) + "\r\n", mimetype="text/csv", headers={
+        "Content-Disposition": "attachment; filename=plantilla_pedidos.csv"})
+
+@app.post("/vendedora/importar")
+@login_required
+@role_required("vendedora", "admin")
+def importar_subir():
+    """multipart con `archivo` (el formulario), o el archivo como cuerpo con Content-Type text/csv o el de
+    XLSX (p. ej. `curl --data-binary @lista.xlsx`). Más de IMPORT_MAX_MB responde 413."""
+    f = None
+    try:
+        try:
+            archivo = request.files.get("archivo")
+            if archivo and archivo.filename:
+                f, nombre = archivo.stream, archivo.filename
+                if f.seek(0, io.SEEK_END) > IMPORT_MAX_BYTES:
+                    raise RequestEntityTooLarge()
+                f.seek(0)
+            elif request.mimetype in ("text/csv", XLSX_MIME):
+                f, nombre = cuerpo_a_temporal(), "archivo.xlsx" if request.mimetype == XLSX_MIME else "archivo.csv"
+        except RequestEntityTooLarge:
+            raise ImportacionInvalida(f"El archivo pasa de {IMPORT_MAX_MB:g} MB.", 413)
+        if f is None:
+            raise ImportacionInvalida("Falta el archivo.")
+        reporte = importar_pedidos(f, nombre, request.headers.get("Idempotency-Key") or request.form.get("llave"))
+    except ImportacionInvalida as e:
+        if pide_json():
+            return jsonify(error=str(e)), e.status
+        flash(str(e), "error")
+        return redirect(url_for("importar_form"))
+    finally:
+        if f is not None:
+            f.close()
+    if pide_json():
+        return jsonify(reporte)
+    return render_template("vendedora_importar_resultado.html", reporte=reporte)
+
+def cuerpo_a_temporal():
+    """Copia el cuerpo del request por bloques a un SpooledTemporaryFile (None si viene vacío); nunca
+    arma el archivo completo en memoria."""
+    f = tempfile.SpooledTemporaryFile(max_size=IMPORT_EN_MEMORIA)
+    while chunk := request.stream.read(1 << 16):
+        f.write(chunk)
+        if f.tell() > IMPORT_MAX_BYTES:
+            f.close()
+            raise RequestEntityTooLarge()
+    if not f.tell():
+        f.close()
+        return None
+    f.seek(0)
+    return f
+
 # ---------- Escuela ----------
 @app.get("/escuela")
 @login_required
 @role_required("escuela")
 def escuela_dashboard():
-    esc = query_one("SELECT * FROM escuelas WHERE user_id=?", (session["user_id"],))
+    # la escuela y las versiones del ETag en una consulta; el listado sólo si el navegador no lo tiene
+    esc = query_one("""
+        SELECT e.*, (SELECT COUNT(*) FROM pedidos WHERE escuela_id = e.id) AS n_pedidos,
+               (SELECT MAX(version) FROM pedidos WHERE escuela_id = e.id) AS v_pedidos,
+               (SELECT MAX(version) FROM paqueterias) AS paq_v
+        FROM escuelas e WHERE e.id = ?
+    """, (escuela_id_sesion(),))
+    if not esc:
+        return render_template("escuela_dashboard.html", pedidos=[], esc=None)
+    etag = page_etag("escuela", esc["version"], esc["n_pedidos"], esc["v_pedidos"], esc["paq_v"])
+    resp = not_modified(etag)
+    if resp:
+        return resp
     pedidos = query_all("""
         SELECT p.*, pa.nombre AS paqueteria
         FROM pedidos p
         LEFT JOIN paqueterias pa ON pa.id=p.paqueteria_id
-        WHERE p.escuela_id = (SELECT id FROM escuelas WHERE user_id=?)
+        WHERE p.escuela_id = ?
         ORDER BY p.created_at DESC
-    """, (session["user_id"],))
-    return render_template("escuela_dashboard.html", pedidos=pedidos, esc=esc)
+    """, (esc["id"],))
+    return with_etag(render_template("escuela_dashboard.html", pedidos=pedidos, esc=esc), etag)
 
 @app.get("/escuela/perfil")
 @login_required
 @role_required("escuela")
 def escuela_perfil():
-    esc = query_one("SELECT * FROM escuelas WHERE user_id=?", (session["user_id"],))
+    esc = mi_escuela()
     return render_template("escuela_perfil.html", esc=esc)
 
 @app.post("/escuela/perfil")
@@ -446,8 +3483,8 @@ def escuela_perfil_guardar():
             nombre=?, ciudad=?, grado=?, contacto=?, telefono=?,
             direccion=?, colonia=?, codigo_postal=?, estado=?, referencias=?,
             dest_nombre=?, dest_tel=?, dest_cp=?, dest_colonia=?, dest_direccion=?, dest_correo=?
-        WHERE user_id=?
-    """, (*[data[f] for f in fields], session["user_id"]))
+        WHERE id=?
+    """, (*[data[f] for f in fields], escuela_id_sesion()))
     flash("Perfil de escuela actualizado.", "ok")
     return redirect(url_for("escuela_perfil"))
 
@@ -455,7 +3492,7 @@ def escuela_perfil_guardar():
 @login_required
 @role_required("escuela")
 def pedido_nuevo():
-    esc = query_one("SELECT * FROM escuelas WHERE user_id=?", (session["user_id"],))
+    esc = mi_escuela()
     fechas = ["25/05/2026","15/06/2026","29/06/2026","06/07/2026","13/07/2026"]
     return render_template("pedido_form.html", esc=esc, fechas=fechas)
 
@@ -485,29 +3522,38 @@ def pedido_guardar():
             n = (n or "").strip()
             if n:
                 items.append({
-                    "nombre": n[:30],
+                    "nombre": n[:NOMBRE_MAX],
                     "color_pelo": (pelo or "")
                 })
-        return json.dumps(items, ensure_ascii=False)
+        return items
 
-    ninas_json = parse_grupo("ninas")
-    ninos_json = parse_grupo("ninos")
+    ninas = parse_grupo("ninas")
+    ninos = parse_grupo("ninos")
 
-    esc = query_one("SELECT id FROM escuelas WHERE user_id=?", (session["user_id"],))
-    if not esc:
-        flash("Tu usuario no está vinculado a una escuela.", "error")
-        return redirect(url_for("escuela_dashboard"))
-
-    execute("""
+    # pedido + alumnos en una sola transacción; el JSON se sigue escribiendo por compatibilidad. El INSERT …
+    # SELECT valida la escuela de la sesión: si ya no existe, no se inserta nada.
+    q = """
         INSERT INTO pedidos(
             escuela_id,ciudad,grado,ninas_json,ninos_json,comentario,estado,created_at,
             color_calceta_ninas,color_zapato_ninas,color_zapato_ninos,color_monos,color_pantalon,escudos_bordar,fechas_entrega,entrega
         )
-        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
-        esc["id"], ciudad, grado, ninas_json, ninos_json, comentario, "Nuevo", datetime.utcnow().isoformat(),
-        color_calceta_ninas, color_zapato_ninas, color_zapato_ninos, color_monos, color_pantalon, escudos_bordar, json.dumps(fechas_entrega, ensure_ascii=False), entrega
-    ))
+        SELECT e.id,?,?,?,?,?,?,?,?,?,?,?,?,?,?,? FROM escuelas e WHERE e.id = ?
+    """
+    with transaction() as db:
+        cur = db.execute(q, (
+            ciudad, grado, json.dumps(ninas, ensure_ascii=False), json.dumps(ninos, ensure_ascii=False), comentario, "Nuevo", datetime.utcnow().isoformat(),
+            color_calceta_ninas, color_zapato_ninas, color_zapato_ninos, color_monos, color_pantalon, escudos_bordar, json.dumps(fechas_entrega, ensure_ascii=False), entrega,
+            escuela_id_sesion()
+        ))
+        pedido_id = cur.lastrowid if cur.rowcount else None
+        if pedido_id:
+            _tx_written(q)
+            execute_many(ITEM_INSERT, item_rows(pedido_id, "ninas", ninas) + item_rows(pedido_id, "ninos", ninos))
+            rollup_pedido(db, pedido_id, +1)
+            pdf_prerender(pedido_id)
+    if not pedido_id:
+        flash("Tu usuario no está vinculado a una escuela.", "error")
+        return redirect(url_for("escuela_dashboard"))
     flash("Pedido registrado correctamente.", "ok")
     return redirect(url_for("escuela_dashboard"))
 
@@ -516,8 +3562,13 @@ def pedido_guardar():
 @login_required
 @role_required("admin")
 def admin_paqueterias():
+    v = query_one("SELECT COUNT(*) AS n, MAX(version) AS v FROM paqueterias")
+    etag = page_etag("paqueterias", v["n"], v["v"])
+    resp = not_modified(etag)
+    if resp:
+        return resp
     paqs = query_all("SELECT * FROM paqueterias ORDER BY activa DESC, nombre")
-    return render_template("admin_paqueterias.html", paqs=paqs)
+    return with_etag(render_template("admin_paqueterias.html", paqs=paqs), etag)
 
 @app.post("/admin/paqueteria/nueva")
 @login_required
@@ -589,11 +3640,17 @@ def admin_validar_accion(user_id, action):
     if not u or u["role"] != "escuela":
         abort(404)
     if action == "aprobar":
-        execute("UPDATE users SET is_active=1 WHERE id=?", (user_id,))
+        with transaction():
+            execute("UPDATE users SET is_active=1 WHERE id=?", (user_id,))
+            if not u["is_active"]:
+                encolar("correo", {"user_id": user_id, "asunto": "Tu cuenta de Pedidos GS fue aprobada",
+                                   "texto": f"Hola {u['name']}:\n\nTu cuenta ya está activa. Entra en "
+                                            f"{url_for('login', _external=True)}\n"})
         flash("Cuenta aprobada.", "ok")
     elif action == "rechazar":
-        execute("DELETE FROM escuelas WHERE user_id=?", (user_id,))
-        execute("DELETE FROM users WHERE id=?", (user_id,))
+        with transaction():
+            execute("DELETE FROM escuelas WHERE user_id=?", (user_id,))
+            execute("DELETE FROM users WHERE id=?", (user_id,))
         flash("Cuenta eliminada.", "ok")
     else:
         flash("Acción inválida.", "error")
@@ -624,18 +3681,18 @@ def admin_edit_school_submit(escuela_id):
     ciudad = request.form.get("ciudad","").strip()
     contacto = request.form.get("contacto","").strip()
     telefono = request.form.get("telefono","").strip()
-    esc = query_one("SELECT * FROM escuelas WHERE id = ?", (escuela_id,))
+    esc = query_one("SELECT e.*, u.email FROM escuelas e LEFT JOIN users u ON u.id = e.user_id WHERE e.id = ?", (escuela_id,))
     if not esc:
         abort(404)
-    # update escuela row
-    execute("UPDATE escuelas SET nombre=?, ciudad=?, contacto=?, telefono=? WHERE id=?",
-            (name or esc["nombre"], ciudad or esc.get("ciudad",""), contacto or esc.get("contacto",""), telefono or esc.get("telefono",""), escuela_id))
-    # update user email/name if changed (ensure unique email)
-    other = query_one("SELECT * FROM users WHERE email = ? AND id != ?", (email, esc["user_id"]))
+    # correo único antes de tocar nada: escuela y usuario se actualizan juntos o no se actualizan
+    other = query_one("SELECT 1 FROM users WHERE email = ? AND id != ?", (email, esc["user_id"]))
     if other:
         flash("El correo ya está en uso por otra cuenta.", "error")
         return redirect(url_for("admin_edit_school_form", escuela_id=escuela_id))
-    execute("UPDATE users SET name=?, email=? WHERE id=?", (name or esc["nombre"], email or esc.get("email",""), esc["user_id"]))
+    with transaction():
+        execute("UPDATE escuelas SET nombre=?, ciudad=?, contacto=?, telefono=? WHERE id=?",
+                (name or esc["nombre"], ciudad or esc["ciudad"] or "", contacto or esc["contacto"] or "", telefono or esc["telefono"] or "", escuela_id))
+        execute("UPDATE users SET name=?, email=? WHERE id=?", (name or esc["nombre"], email or esc["email"] or "", esc["user_id"]))
     flash("Datos de la escuela actualizados.", "ok")
     return redirect(url_for("admin_manage_schools"))
 
@@ -658,10 +3715,13 @@ def admin_delete_school(escuela_id):
     esc = query_one("SELECT * FROM escuelas WHERE id = ?", (escuela_id,))
     if not esc:
         abort(404)
-    execute("DELETE FROM users WHERE id = ?", (esc["user_id"],))
-    execute("DELETE FROM escuelas WHERE id = ?", (escuela_id,))
+    with transaction():
+        execute("DELETE FROM users WHERE id = ?", (esc["user_id"],))
+        execute("DELETE FROM escuelas WHERE id = ?", (escuela_id,))
     flash("Escuela eliminada.", "ok")
     return redirect(url_for("admin_manage_schools"))
 
+ARRANQUE["import_ms"] = round((time.perf_counter() - _T_IMPORT) * 1000, 1)
+
 if __name__ == "__main__":
     app.run(debug=True)
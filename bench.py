@@ -0,0 +1,629 @@
+"""Herramientas de rendimiento para Pedidos GS.
+
+    python bench.py seed   --db /tmp/carga.db --pedidos 100000
+    python bench.py plans  [--pedidos 100000]
+    python bench.py login  [--workers 1,2,4] [--concurrency 16] [--logins 200]
+    python bench.py run    --db /tmp/carga.db [--requests 200] [--concurrency 4] [--out run.json]
+    python bench.py startup [--db /tmp/carga.db] [--runs 5] [--objetivo-ms 50] [--modulos]
+
+`plans` siembra una BD temporal, corre EXPLAIN QUERY PLAN sobre cada sentencia SQL
+literal de app.py y termina con código 1 si alguna hace un SCAN completo de tabla
+o un ORDER BY con "USE TEMP B-TREE". Las consultas que se arman con filtros opcionales
+(listado, cambios por lote, PDFs por lote, alcance por rol) se revisan además con cada
+combinación de filtros, corriendo la función real y tomando el SQL que ejecutó. Sólo las
+migraciones y reparaciones que recorren todo a propósito llevan `-- plan: full`.
+
+`login` mide inicios de sesión por segundo contra el pool de hash (HASH_POOL) con
+distintos números de workers, usando el test client de Flask desde varios hilos.
+
+`run` recorre los escenarios principales (listado admin, tableros de vendedora y
+escuela, detalle, PDF y alta de pedido) con el test client y escribe un JSON con
+throughput y p50/p95/p99 por escenario, más el commit, para comparar corridas.
+
+`startup` lanza procesos nuevos de Python con y sin warmup() y reporta (mediana) el import de
+Flask y de app, cada etapa del warm-up y el primer/segundo request; termina con código 1 si el
+primer request tras el warm-up pasa de --objetivo-ms.
+"""
+import os, re, sys, ast, json, time, random, sqlite3, argparse, tempfile, threading, itertools
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+ESTADOS = ["Nuevo","En revisión","Aprobado","En producción","Listo para envío","Enviado","Entregado","Cancelado"]
+CIUDADES = ["Guadalajara","Zapopan","Tlaquepaque","Tonalá","Monterrey","León","Querétaro","Morelia","Aguascalientes","Colima"]
+COLORES = ["Blanca","Negro","Azul marino","Gris","Café","Vino"]
+PELO = ["Castaño","Negro","Rubio","Pelirrojo"]
+NOMBRES_NINA = ["Ana","Sofía","Valentina","Regina","Camila","Ximena","María José","Renata","Victoria","Fernanda"]
+NOMBRES_NINO = ["Leo","Santiago","Mateo","Sebastián","Diego","Emiliano","Iker","Daniel","Tadeo","Gael"]
+APELLIDOS = ["García","Hernández","López","Martínez","González","Pérez","Rodríguez","Sánchez","Ramírez","Torres"]
+PAQUETERIAS = ["Estafeta","DHL","FedEx","Paquetexpress","Redpack"]
+FECHAS = ["25/05/2026","15/06/2026","29/06/2026","06/07/2026","13/07/2026"]
+FLUJO = ESTADOS[:-1]   # camino normal; "Cancelado" puede llegar desde los primeros pasos
+HORAS_ESTADO = {"Nuevo": 20, "En revisión": 30, "Aprobado": 24, "En producción": 120,
+                "Listo para envío": 30, "Enviado": 72}   # media (exponencial) del tiempo en cada estado
+
+
+def open_app_db(path):
+    """BD migrada al esquema actual de app.py (sin datos demo de escuelas/pedidos extra)."""
+    os.environ["DB_PATH"] = path
+    import app
+    app.DB_PATH = path
+    app.migrate_db(path)
+    return app, app.connect_db(path)
+
+
+def seed(db, escuelas=500, vendedoras=20, pedidos=100000, ninos=(10, 20), rnd_seed=1, batch=2000):
+    """Llena la BD con volumen sintético.
+
+    `ninos` es el rango de alumnos por grupo (10-20 niñas + 10-20 niños = 20-40 por pedido). Los alumnos se
+    escriben en pedido_items y en las columnas JSON, como lo hace pedido_guardar; al final se recalcula el
+    rollup de producción. Los contadores por escuela los mantienen los triggers. El historial de estados
+    (pedido_estado_log) se reescribe con un recorrido plausible hasta el estado final de cada pedido.
+    """
+    import app
+    rnd = random.Random(rnd_seed)
+    pw = "x"  # hash inválido a propósito: estos usuarios no inician sesión
+    cur = db.cursor()
+    paq_ids = []
+    for nombre in PAQUETERIAS:
+        row = cur.execute("SELECT id FROM paqueterias WHERE nombre=?", (nombre,)).fetchone()
+        paq_ids.append(row[0] if row else cur.execute(
+            "INSERT INTO paqueterias(nombre,activa) VALUES(?,1)", (nombre,)).lastrowid)
+
+    base = cur.execute("SELECT COALESCE(MAX(id),0) FROM users").fetchone()[0]
+    cur.executemany(
+        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
+        ((f"Vendedora {i}", f"vend{base+i}@carga.local", pw, "vendedora") for i in range(vendedoras)))
+    vend_ids = [r[0] for r in cur.execute("SELECT id FROM users WHERE id>? AND role='vendedora'", (base,))]
+
+    base = cur.execute("SELECT COALESCE(MAX(id),0) FROM users").fetchone()[0]
+    cur.executemany(
+        "INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,?)",
+        ((f"Escuela {i}", f"esc{base+i}@carga.local", pw, "escuela", 0 if rnd.random() < 0.05 else 1)
+         for i in range(escuelas)))
+    esc_users = [r[0] for r in cur.execute("SELECT id FROM users WHERE id>? AND role='escuela'", (base,))]
+    cur.executemany("""
+        INSERT INTO escuelas(nombre,ciudad,grado,contacto,telefono,user_id,vendedora_id,estado)
+        VALUES(?,?,?,?,?,?,?,?)
+    """, ((f"Colegio {rnd.choice(APELLIDOS)} {uid}", rnd.choice(CIUDADES), rnd.choice(["Preescolar","Primaria","Secundaria"]),
+           f"Mtra. {rnd.choice(APELLIDOS)}", f"33{rnd.randrange(10**8):08d}", uid, rnd.choice(vend_ids), "Jalisco")
+          for uid in esc_users))
+    esc_ids = [r[0] for r in cur.execute(
+        "SELECT id FROM escuelas WHERE user_id IN (SELECT id FROM users WHERE id>?)", (base,))]
+
+    def historial(pid, estado, created):
+        camino = FLUJO[:FLUJO.index(estado) + 1] if estado in FLUJO else FLUJO[:rnd.randint(1, 3)] + [estado]
+        t, out, prev = created, [], None
+        for e in camino:
+            if prev:
+                horas = rnd.expovariate(1 / HORAS_ESTADO.get(prev, 24))
+                t += timedelta(hours=horas)
+                out.append((pid, e, t.isoformat(), prev, round(horas)))
+            else:
+                out.append((pid, e, t.isoformat(), None, None))
+            prev = e
+        return out
+
+    def grupo(nombres):
+        return [{"nombre": f"{rnd.choice(nombres)} {rnd.choice(APELLIDOS)}"[:30], "color_pelo": rnd.choice(PELO)}
+                for _ in range(rnd.randint(*ninos))]
+
+    start = datetime(2025, 8, 1)
+    next_id = cur.execute("SELECT COALESCE(MAX(id),0) FROM pedidos").fetchone()[0] + 1
+    for off in range(0, pedidos, batch):
+        filas, items, hist, ultimos = [], [], [], []
+        for pid in range(next_id + off, next_id + min(off + batch, pedidos)):
+            ninas, ninos_ = grupo(NOMBRES_NINA), grupo(NOMBRES_NINO)
+            created = start + timedelta(seconds=rnd.randrange(300 * 86400))
+            estado = rnd.choice(ESTADOS)
+            h = historial(pid, estado, created)
+            hist += h
+            ultimos.append((h[-1][2], pid))
+            filas.append((pid, rnd.choice(esc_ids), rnd.choice(CIUDADES), "Primaria",
+                          json.dumps(ninas, ensure_ascii=False), json.dumps(ninos_, ensure_ascii=False),
+                          "", estado, rnd.choice(paq_ids + [None]), created.isoformat(),
+                          rnd.choice(COLORES), rnd.choice(COLORES), rnd.choice(COLORES), rnd.choice(COLORES), rnd.choice(COLORES),
+                          rnd.randint(0, 40), json.dumps(rnd.sample(FECHAS, rnd.randint(1, 2))), rnd.choice(["Ocurre","Domicilio"])))
+            items += app.item_rows(pid, "ninas", ninas) + app.item_rows(pid, "ninos", ninos_)
+        cur.executemany("""
+            INSERT INTO pedidos(id,escuela_id,ciudad,grado,ninas_json,ninos_json,comentario,estado,paqueteria_id,created_at,
+                                color_calceta_ninas,color_zapato_ninas,color_zapato_ninos,color_monos,color_pantalon,
+                                escudos_bordar,fechas_entrega,entrega)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, filas)
+        cur.executemany(app.ITEM_INSERT, items)
+        cur.execute("DELETE FROM pedido_estado_log WHERE pedido_id BETWEEN ? AND ?", (filas[0][0], filas[-1][0]))
+        cur.executemany("INSERT INTO pedido_estado_log(pedido_id, estado, ts, anterior, horas_anterior) VALUES (?,?,?,?,?)", hist)
+        cur.executemany("UPDATE pedidos SET estado_desde = ? WHERE id = ?", ultimos)
+        db.commit()
+    app.rebuild_produccion(db)
+    db.commit()
+
+
+# ------------ EXPLAIN QUERY PLAN ------------
+SQL_VERBS = ("SELECT", "UPDATE", "DELETE", "WITH", "INSERT")
+# tablas de sistema y rollups (O(grupos)) que se leen completas a propósito
+PLAN_ALLOW = ("sqlite_master", "produccion_rollup")
+# tablas que viven en otra BD (caché compartida, archivo por temporada con ATTACH): no se revisan aquí
+PLAN_OTHER_DB = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(?:cache\b|arch\.|main\.)", re.I)
+
+
+def app_sql_strings(path=os.path.join(BASE_DIR, "app.py")):
+    """Sentencias SQL literales de app.py como (línea, sql).
+
+    En los f-strings se sustituyen las constantes de módulo (p. ej. PEDIDO_LIST_COLS) y
+    cualquier otra expresión queda vacía: se revisa la variante base, sin filtros opcionales.
+    """
+    import app
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    out, parts = [], set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.JoinedStr):
+            sql = ""
+            for v in node.values:
+                parts.add(id(v))
+                if isinstance(v, ast.Constant):
+                    sql += v.value
+                elif isinstance(v.value, ast.Name) and isinstance(getattr(app, v.value.id, None), str):
+                    sql += getattr(app, v.value.id)
+                elif isinstance(v.value, ast.Call):
+                    sql = "{"   # SQL armado con .format(): no hay variante base que revisar
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in parts:
+            sql = node.value
+        else:
+            continue
+        sql = sql.strip()
+        if PLAN_OTHER_DB.search(sql):
+            continue
+        if "{" in sql or "-- plan: full" in sql:   # plantillas con .format() / recorridos completos a propósito
+            continue
+        if sql.upper().startswith(SQL_VERBS) and len(sql.split()) > 1 and sqlite3.complete_statement(sql + ";"):
+            out.append((node.lineno, sql))
+    return sorted(out)
+
+
+CTE_NAME = re.compile(r"(?:\bWITH|,)\s+(\w+)\s+AS\s+(?:(?:NOT\s+)?MATERIALIZED\s+)?\(", re.I)
+
+
+def plan_problems(db, sql, args=None):
+    """Líneas del plan que indican SCAN completo de una tabla o sort temporal (sin `args` se prueba con NULL).
+
+    Un SCAN de un CTE, de una subconsulta o de json_each(?) recorre filas que ya acotó su propia consulta
+    (revisada en su nodo del plan). Un sort es aceptable sólo si en su nivel no hay más que eso y búsquedas
+    por llave primaria: ordena lo que ya se acotó (p. ej. los ids pedidos), no una tabla ni un rango.
+    """
+    if args is None:
+        args = (None,) * sql.count("?")
+    rows = db.execute("EXPLAIN QUERY PLAN " + sql, args).fetchall()
+    ctes = set(CTE_NAME.findall(sql))
+    def derivado(detail):
+        name = detail.split()[1] if detail.startswith("SCAN ") else ""
+        return name in ctes or name.startswith("(") or "VIRTUAL TABLE" in detail
+    bad = []
+    for r in rows:
+        detail = r[-1]
+        if any(t in detail for t in PLAN_ALLOW):
+            continue
+        if detail.startswith("SCAN") and "INDEX" not in detail and not derivado(detail):
+            bad.append(detail)
+        elif "USE TEMP B-TREE" in detail:
+            nivel = [x[-1] for x in rows if x[1] == r[1] and x[-1].startswith(("SCAN", "SEARCH"))]
+            if not all(derivado(d) or "PRIMARY KEY (rowid=?)" in d for d in nivel):
+                bad.append(detail)
+    return [d for d in bad if "CONSTANT ROW" not in d], rows
+
+
+# Las consultas del camino de request que se arman con filtros opcionales (o según el rol) no son un literal
+# completo: el chequeo estático sólo ve su variante base. Aquí se corre la función real con cada combinación
+# y se revisa el SQL que de verdad ejecutó, ya con sus valores.
+def _combos(opciones):
+    """Cada combinación de valores como dict; None = sin ese filtro."""
+    for vals in itertools.product(*opciones.values()):
+        yield {k: v for k, v in zip(opciones, vals) if v is not None}
+
+
+def sql_ejecutado(app, fn, rol):
+    """Sentencias que corre fn() dentro de un request con la sesión (role, user_id), con los valores expandidos."""
+    from flask import session
+    from werkzeug.exceptions import HTTPException
+    out = []
+    with app.app.test_request_context(headers={"Accept": "application/json"}):
+        session["role"], session["user_id"] = rol
+        db = app.get_db()
+        db.set_trace_callback(out.append)
+        try:
+            fn()
+        except HTTPException:
+            pass   # p. ej. más de BULK_MAX pedidos o un rol sin permiso: lo que alcanzó a correr se revisa
+        finally:
+            db.set_trace_callback(None)
+    return [q for q in dict.fromkeys(out) if q.lstrip().upper().startswith(SQL_VERBS)]
+
+
+def plan_casos(app, db):
+    """(nombre, rol, fn) para las variantes de pedidos_pagina, export_total, cambiar_pedidos, pedidos_lote y las
+    consultas por rol."""
+    from werkzeug.datastructures import MultiDict
+    one = lambda q: (db.execute(q).fetchone() or [None])[0]
+    admin = ("admin", one("SELECT id FROM users WHERE role = 'admin'"))
+    roles = [admin, ("vendedora", one("SELECT vendedora_id FROM escuelas WHERE vendedora_id IS NOT NULL")),
+             ("escuela", one("SELECT user_id FROM escuelas WHERE user_id IS NOT NULL"))]
+    pid = one("SELECT MAX(id) FROM pedidos")
+    r = db.execute("SELECT created_at, id, ciudad, paqueteria_id FROM pedidos WHERE id = ?", (pid,)).fetchone()
+    filtros = {"estado": (None, "Nuevo"), "paqueteria_id": (None, str(r["paqueteria_id"] or 1), "0"),
+               "ciudad": (None, r["ciudad"]), "desde": (None, "2025-01-01"), "hasta": (None, "2026-12-31")}
+    casos = []
+    for f in _combos({**filtros, "cursor": (None, app.encode_cursor(r))}):
+        casos.append((f"pedidos_pagina {f}", admin, lambda f=f: app.pedidos_pagina(MultiDict(f), "admin_pedidos")))
+    for f in _combos(filtros):
+        casos.append((f"export_total {f}", admin, lambda f=f: app.export_total(*app.pedidos_filtros(MultiDict(f))[:2])))
+    for f in _combos({**filtros, "ids": (None, f"{pid},{pid - 1}")}):
+        def cambio(f=f):
+            where, params, _ = app.pedidos_filtros(MultiDict(f))
+            if "ids" in f:
+                where.append("p.id IN (SELECT value FROM json_each(?))"); params.append(json.dumps([pid, pid - 1]))
+            app.cambiar_pedidos(where, params, "estado", "Aprobado")
+        if f:
+            casos.append((f"cambiar_pedidos {f}", admin, cambio))
+    lote = {"ids": (None, f"{pid},{pid - 1}"), "estado": (None, "Nuevo"), "paqueteria_id": (None, "1"),
+            "fecha": (None, "2026-06-15")}
+    for f in _combos(lote):
+        if f:
+            casos.append((f"pedidos_lote {f}", admin, lambda f=f: app.pedidos_lote(MultiDict(f))))
+    for rol in roles:
+        casos.append((f"pedido_visible {rol[0]}", rol, lambda: app.pedido_visible(pid)))
+        casos.append((f"importar_form {rol[0]}", rol, app.importar_form))
+    return casos
+
+
+def check_plans(pedidos=100000, db_path=None, verbose=False):
+    tmp = None
+    if db_path is None:
+        tmp = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp.name, "plans.db")
+    app, db = open_app_db(db_path)
+    if db.execute("SELECT COUNT(*) FROM pedidos").fetchone()[0] < pedidos:
+        seed(db, pedidos=pedidos, ninos=(0, 2))
+    failures = 0
+    for lineno, sql in app_sql_strings():
+        try:
+            bad, rows = plan_problems(db, sql)
+        except sqlite3.Error as e:
+            print(f"app.py:{lineno}: ERROR {e}")
+            failures += 1
+            continue
+        if bad:
+            failures += 1
+            print(f"app.py:{lineno}: " + " | ".join(bad))
+            print("    " + " ".join(sql.split())[:160])
+        elif verbose:
+            print(f"app.py:{lineno}: ok  " + " | ".join(r[-1] for r in rows))
+    for nombre, rol, fn in plan_casos(app, db):
+        for sql in sql_ejecutado(app, fn, rol):
+            bad, rows = plan_problems(db, sql, ())
+            if bad:
+                failures += 1
+                print(f"{nombre}: " + " | ".join(bad))
+                print("    " + " ".join(sql.split())[:160])
+            elif verbose:
+                print(f"{nombre}: ok  " + " | ".join(r[-1] for r in rows))
+    db.close()
+    if tmp:
+        tmp.cleanup()
+    print(f"{failures} sentencia(s) con plan problemático." if failures else "Todos los planes usan índices.")
+    return failures
+
+
+# ------------ Login / pool de hash ------------
+def stub_templates(app):
+    """Las plantillas no viven en el repo; para medir basta con un cuerpo vacío."""
+    import jinja2
+    app.app.jinja_loader = jinja2.FunctionLoader(lambda name: "")
+
+def pct(values, q):
+    """Percentil q (0-100) por rango más cercano; None si no hay datos."""
+    if not values:
+        return None
+    v = sorted(values)
+    return v[min(len(v) - 1, max(0, int(round(q / 100 * len(v) + 0.5)) - 1))]
+
+
+def bench_login(workers=(1, 2, 4), concurrency=16, logins=200, queue=None, users=50):
+    """Logins/s, rechazos (503) y latencia por tamaño de pool; regresa una lista de dicts."""
+    tmp = tempfile.TemporaryDirectory()
+    app, db = open_app_db(os.path.join(tmp.name, "login.db"))
+    pwhash = app.generate_password_hash("bench123", app.HASH_METHOD)
+    db.executemany("INSERT INTO users(name,email,password_hash,role,is_active) VALUES (?,?,?,?,1)",
+                   ((f"Login {i}", f"login{i}@carga.local", pwhash, "vendedora") for i in range(users)))
+    db.commit()
+    db.close()
+    stub_templates(app)
+    results = []
+    for w in workers:
+        app.HASH_POOL.shutdown()
+        app.HASH_POOL = app.HashPool(workers=w, queue=concurrency if queue is None else queue)
+        lat, codes, lock = [], {}, threading.Lock()
+        todo = iter(range(logins))
+
+        def client():
+            c = app.app.test_client()
+            while True:
+                with lock:
+                    i = next(todo, None)
+                if i is None:
+                    return
+                t0 = time.perf_counter()
+                r = c.post("/login", data={"email": f"login{i % users}@carga.local", "password": "bench123"})
+                dt = time.perf_counter() - t0
+                with lock:
+                    codes[r.status_code] = codes.get(r.status_code, 0) + 1
+                    lat.append(dt)
+
+        t0 = time.perf_counter()
+        hilos = [threading.Thread(target=client) for _ in range(concurrency)]
+        for h in hilos: h.start()
+        for h in hilos: h.join()
+        elapsed = time.perf_counter() - t0
+        ok = codes.get(302, 0)
+        results.append({"workers": w, "queue": app.HASH_POOL.queue, "concurrency": concurrency,
+                        "ok": ok, "rejected": codes.get(503, 0), "otros": sum(codes.values()) - ok - codes.get(503, 0),
+                        "logins_s": round(ok / elapsed, 1),
+                        "p50_ms": round(pct(lat, 50) * 1000, 1), "p95_ms": round(pct(lat, 95) * 1000, 1)})
+    app.HASH_POOL.shutdown()
+    tmp.cleanup()
+    return results
+
+
+# ------------ Suite de escenarios ------------
+STARTUP_OBJETIVO_MS = 50   # primer request tras el warm-up (Passenger ya importó la app)
+SCENARIOS = ("admin_pedidos", "vendedora", "escuela", "pedido_detalle", "pedido_pdf", "pedido_guardar")
+
+
+def _form_pedido(rnd, ninos=(10, 20)):
+    form = {"ciudad": rnd.choice(CIUDADES), "grado": "Primaria", "comentario": "carga",
+            "color_calceta_ninas": rnd.choice(COLORES), "color_zapato_ninas": rnd.choice(COLORES),
+            "color_zapato_ninos": rnd.choice(COLORES), "color_monos": rnd.choice(COLORES),
+            "color_pantalon": rnd.choice(COLORES), "escudos_bordar": "10", "entrega": "Ocurre",
+            "fechas_entrega[]": rnd.sample(FECHAS, 2)}
+    for g, nombres in (("ninas", NOMBRES_NINA), ("ninos", NOMBRES_NINO)):
+        n = rnd.randint(*ninos)
+        form[f"{g}[nombre][]"] = [f"{rnd.choice(nombres)} {rnd.choice(APELLIDOS)}" for _ in range(n)]
+        form[f"{g}[color_pelo][]"] = [rnd.choice(PELO) for _ in range(n)]
+    return form
+
+
+def _git_commit():
+    try:
+        import subprocess
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_suite(db_path, requests=200, concurrency=4, scenarios=SCENARIOS, rnd_seed=1):
+    """Corre cada escenario `requests` veces con `concurrency` hilos; regresa el reporte como dict.
+
+    pedido_guardar inserta pedidos de verdad: usar una copia de la BD.
+    """
+    os.environ.setdefault("PDF_CACHE_DIR", tempfile.mkdtemp(prefix="bench-pdf-"))
+    app, db = open_app_db(db_path)
+    stub_templates(app)
+    rnd = random.Random(rnd_seed)
+    admin = db.execute("SELECT id FROM users WHERE role='admin' ORDER BY id LIMIT 1").fetchone()[0]
+    # la vendedora y la escuela con más pedidos: el peor caso de sus tableros
+    vend = db.execute("""SELECT e.vendedora_id FROM escuela_pedidos c JOIN escuelas e ON e.id = c.escuela_id
+                         WHERE e.vendedora_id IS NOT NULL GROUP BY e.vendedora_id ORDER BY SUM(c.n) DESC LIMIT 1""").fetchone()
+    esc = db.execute("""SELECT e.user_id FROM escuela_pedidos c JOIN escuelas e ON e.id = c.escuela_id
+                        JOIN users u ON u.id = e.user_id AND u.is_active = 1
+                        GROUP BY e.id ORDER BY SUM(c.n) DESC LIMIT 1""").fetchone()
+    ids = [r[0] for r in db.execute("SELECT id FROM pedidos ORDER BY random() LIMIT 1000")]
+    info = {"pedidos": db.execute("SELECT COUNT(*) FROM pedidos").fetchone()[0],
+            "alumnos": db.execute("SELECT COUNT(*) FROM pedido_items").fetchone()[0],
+            "escuelas": db.execute("SELECT COUNT(*) FROM escuelas").fetchone()[0]}
+    db.close()
+    forms = [_form_pedido(rnd) for _ in range(min(requests, 50))]
+    plan = {
+        "admin_pedidos":  ("admin", admin, lambda i: ("GET", "/admin/pedidos", None)),
+        "vendedora":      ("vendedora", vend and vend[0], lambda i: ("GET", "/vendedora", None)),
+        "escuela":        ("escuela", esc and esc[0], lambda i: ("GET", "/escuela", None)),
+        "pedido_detalle": ("admin", admin, lambda i: ("GET", f"/admin/pedido/{ids[i % len(ids)]}", None)),
+        "pedido_pdf":     ("admin", admin, lambda i: ("GET", f"/admin/pedido/{ids[i % len(ids)]}/pdf", None)),
+        "pedido_guardar": ("escuela", esc and esc[0], lambda i: ("POST", "/escuela/pedido/nuevo", forms[i % len(forms)])),
+    }
+    results = {}
+    for name in scenarios:
+        role, uid, req = plan[name]
+        if not uid or (name.startswith("pedido_") and name != "pedido_guardar" and not ids):
+            results[name] = {"skipped": "sin datos para el escenario"}
+            continue
+        lat, errors, lock = [], {}, threading.Lock()
+        todo = iter(range(requests))
+
+        def worker():
+            c = app.app.test_client()
+            with c.session_transaction() as ses:
+                ses["user_id"], ses["role"], ses["name"] = uid, role, "bench"
+            while True:
+                with lock:
+                    i = next(todo, None)
+                if i is None:
+                    return
+                method, url, data = req(i)
+                t0 = time.perf_counter()
+                r = c.open(url, method=method, data=data)
+                r.get_data()
+                dt = time.perf_counter() - t0
+                with lock:
+                    lat.append(dt)
+                    if r.status_code >= 400:
+                        errors[r.status_code] = errors.get(r.status_code, 0) + 1
+
+        t0 = time.perf_counter()
+        hilos = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for h in hilos: h.start()
+        for h in hilos: h.join()
+        elapsed = time.perf_counter() - t0
+        results[name] = {"requests": len(lat), "errors": errors, "rps": round(len(lat) / elapsed, 1),
+                         "mean_ms": round(sum(lat) / len(lat) * 1000, 2),
+                         **{f"p{q}_ms": round(pct(lat, q) * 1000, 2) for q in (50, 95, 99)}}
+    app.pdf_executor().shutdown(wait=True)
+    return {"commit": _git_commit(), "fecha": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version,
+            "requests": requests, "concurrency": concurrency, "datos": info, "escenarios": results}
+
+
+# ------------ Arranque en frío ------------
+# Corre en un proceso nuevo: lo que ya esté importado aquí no cuenta (por eso no importa bench).
+_ARRANQUE_HIJO = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+import flask
+t1 = time.perf_counter()
+import app
+t2 = time.perf_counter()
+r = {"proceso_ms": (time.time() - float(os.environ["BENCH_T0"])) * 1000,
+     "flask_ms": (t1 - t0) * 1000, "app_ms": (t2 - t1) * 1000}
+if not os.path.isdir(os.path.join(app.BASE_DIR, "templates")):
+    import jinja2
+    app.app.jinja_loader = jinja2.FunctionLoader(lambda name: "")
+if os.environ.get("BENCH_WARMUP") == "1":
+    t = time.perf_counter()
+    for k, v in app.warmup().items():
+        if k.endswith("_ms") and k != "import_ms":
+            r["warmup_" + k] = v
+    r["warmup_ms"] = (time.perf_counter() - t) * 1000
+c = app.app.test_client()
+for nombre, url, uid, role in json.loads(os.environ["BENCH_URLS"]):
+    with c.session_transaction() as ses:
+        ses.clear()
+        if uid:
+            ses["user_id"], ses["role"], ses["name"] = uid, role, "bench"
+    for vez in ("1", "2"):
+        t = time.perf_counter()
+        resp = c.get(url)
+        r[f"{nombre}_{vez}_ms"] = (time.perf_counter() - t) * 1000
+        assert resp.status_code < 400, (url, resp.status_code)
+r["ttfb_ms"] = r[f"{json.loads(os.environ['BENCH_URLS'])[0][0]}_1_ms"]
+r["listo_ms"] = (time.time() - float(os.environ["BENCH_T0"])) * 1000
+print(json.dumps(r))
+"""
+
+
+def _arranque_hijo(env, warm, modulos=False):
+    import subprocess
+    env = dict(env, BENCH_WARMUP="1" if warm else "0", BENCH_T0=repr(time.time()))
+    cmd = [sys.executable] + (["-X", "importtime"] if modulos else []) + ["-c", _ARRANQUE_HIJO]
+    p = subprocess.run(cmd, env=env, cwd=BASE_DIR, capture_output=True, text=True)
+    if p.returncode:
+        raise RuntimeError(p.stderr.strip().splitlines()[-1] if p.stderr.strip() else f"código {p.returncode}")
+    r = json.loads(p.stdout.strip().splitlines()[-1])
+    if modulos:   # "import time: self | cumulative | paquete"
+        filas = [l.split("|") for l in p.stderr.splitlines() if l.startswith("import time:") and "self" not in l]
+        # el proceso y lo que app importa directo (sangría <= 2), por tiempo acumulado
+        top = sorted(((int(c), n.strip()) for _, c, n in filas if not n.startswith(" " * 4)), reverse=True)
+        r["modulos_ms"] = {n: round(c / 1000, 1) for c, n in top[:12]}
+    return r
+
+
+def bench_startup(db_path=None, runs=5, objetivo_ms=None, modulos=False):
+    """Arranques en frío con y sin warm-up (mediana de `runs` procesos nuevos cada uno).
+
+    Mide import de Flask y de app, cada etapa de warmup() y el primer y segundo request de login,
+    listado admin y detalle de pedido. Corre una vez antes sin medir, para que existan los .pyc y la
+    caché de plantillas (como en un reinicio de Passenger). Con objetivo_ms, "cumple" dice si el
+    primer request con warm-up quedó debajo.
+    """
+    tmp = tempfile.TemporaryDirectory()
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    env.setdefault("SECRET_KEY", "bench")
+    env["DB_PATH"] = db_path or os.path.join(tmp.name, "arranque.db")
+    env.setdefault("PDF_CACHE_DIR", os.path.join(tmp.name, "pdf"))
+    urls = [("login", "/login", None, None)]
+    env["BENCH_URLS"] = json.dumps(urls)
+    _arranque_hijo(env, True)   # prepara: migra una BD nueva, escribe .pyc y caché de plantillas
+    db = sqlite3.connect(env["DB_PATH"])
+    admin = db.execute("SELECT id FROM users WHERE role='admin' ORDER BY id LIMIT 1").fetchone()
+    pedido = db.execute("SELECT id FROM pedidos ORDER BY id DESC LIMIT 1").fetchone()
+    db.close()
+    if admin:
+        urls.append(("admin_pedidos", "/admin/pedidos", admin[0], "admin"))
+        if pedido:
+            urls.append(("pedido_detalle", f"/admin/pedido/{pedido[0]}", admin[0], "admin"))
+    env["BENCH_URLS"] = json.dumps(urls)
+    rep = {"commit": _git_commit(), "fecha": datetime.now().isoformat(timespec="seconds"),
+           "python": sys.version.split()[0], "runs": runs}
+    for warm in (False, True):
+        corridas = [_arranque_hijo(env, warm) for _ in range(runs)]
+        rep["con_warmup" if warm else "sin_warmup"] = {
+            k: round(pct([c[k] for c in corridas], 50), 1) for k in corridas[0]}
+    if modulos:
+        rep["modulos_ms"] = _arranque_hijo(env, True, modulos=True)["modulos_ms"]
+    if objetivo_ms is not None:
+        rep["objetivo_ms"] = objetivo_ms
+        rep["cumple"] = rep["con_warmup"]["ttfb_ms"] <= objetivo_ms
+    tmp.cleanup()
+    return rep
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("seed", help="genera datos sintéticos")
+    p.add_argument("--db", required=True)
+    p.add_argument("--pedidos", type=int, default=100000)
+    p.add_argument("--escuelas", type=int, default=500)
+    p.add_argument("--vendedoras", type=int, default=20)
+    p.add_argument("--ninos", default="10,20", help="rango de alumnos por grupo (niñas y niños), p. ej. 10,20")
+    p = sub.add_parser("plans", help="revisa EXPLAIN QUERY PLAN de las consultas de app.py")
+    p.add_argument("--db", help="reusar una BD ya sembrada")
+    p.add_argument("--pedidos", type=int, default=100000)
+    p.add_argument("-v", "--verbose", action="store_true")
+    p = sub.add_parser("run", help="suite de escenarios HTTP; reporte JSON")
+    p.add_argument("--db", required=True, help="BD sembrada (se escriben pedidos: usar una copia)")
+    p.add_argument("--requests", type=int, default=200, help="requests por escenario")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--only", help="escenarios separados por coma (%s)" % ",".join(SCENARIOS))
+    p.add_argument("--out", help="archivo JSON de salida (por omisión stdout)")
+    p = sub.add_parser("login", help="logins/s según el tamaño del pool de hash")
+    p.add_argument("--workers", default="1,2,4", help="tamaños de pool a probar, separados por coma")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--logins", type=int, default=200)
+    p.add_argument("--queue", type=int, help="HASH_QUEUE (por omisión = concurrency, sin rechazos)")
+    p = sub.add_parser("startup", help="arranque en frío: import, warm-up y primer request")
+    p.add_argument("--db", help="BD a usar (por omisión una nueva con los datos demo)")
+    p.add_argument("--runs", type=int, default=5, help="procesos por modo (se reporta la mediana)")
+    p.add_argument("--objetivo-ms", type=float, default=STARTUP_OBJETIVO_MS,
+                   help="TTFB máximo del primer request con warm-up; código 1 si no se cumple")
+    p.add_argument("--modulos", action="store_true", help="agregar los paquetes más lentos (-X importtime)")
+    a = ap.parse_args(argv)
+    if a.cmd == "seed":
+        _, db = open_app_db(a.db)
+        seed(db, escuelas=a.escuelas, vendedoras=a.vendedoras, pedidos=a.pedidos,
+             ninos=tuple(int(n) for n in a.ninos.split(",")))
+        print(f"{a.db}: {db.execute('SELECT COUNT(*) FROM pedidos').fetchone()[0]} pedidos")
+        return 0
+    if a.cmd == "plans":
+        return 1 if check_plans(a.pedidos, a.db, a.verbose) else 0
+    if a.cmd == "run":
+        rep = run_suite(a.db, a.requests, a.concurrency, a.only.split(",") if a.only else SCENARIOS)
+        out = json.dumps(rep, indent=2, ensure_ascii=False)
+        if a.out:
+            with open(a.out, "w", encoding="utf-8") as f:
+                f.write(out + "\n")
+        else:
+            print(out)
+        return 0
+    if a.cmd == "startup":
+        rep = bench_startup(a.db, a.runs, a.objetivo_ms, a.modulos)
+        print(json.dumps(rep, indent=2, ensure_ascii=False))
+        return 0 if rep["cumple"] else 1
+    if a.cmd == "login":
+        for r in bench_login([int(w) for w in a.workers.split(",")], a.concurrency, a.logins, a.queue):
+            print(json.dumps(r))
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
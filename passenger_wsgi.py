@@ -1,4 +1,4 @@
-import sys, os
+import sys, os, logging
 
 # Ruta del proyecto en el servidor (se ajusta sola al directorio actual)
 project_home = os.path.dirname(os.path.abspath(__file__))
@@ -10,4 +10,13 @@ if project_home not in sys.path:
 os.environ.setdefault("SECRET_KEY", "cambia_esto_por_un_valor_seguro")
 
 # Importa la app de Flask como 'application' para Passenger
-from app import app as application
+from app import app as application, warmup
+
+# Antes de aceptar tráfico: migraciones, conexión a la BD, plantillas compiladas y cachés.
+# Los tiempos (import y cada etapa) quedan en el log de Passenger y en /admin/db.
+# Si algo falla se registra y el worker arranca igual: el primer request paga lo que faltó.
+application.logger.setLevel(logging.INFO)
+try:
+    application.logger.info("warm-up: %s", warmup())
+except Exception:
+    application.logger.exception("warm-up falló; el worker arranca sin calentar")
@@ -0,0 +1,39 @@
+"""Los planes de consulta de app.py: el mismo chequeo que `python bench.py plans`.
+
+    python -m pytest -q
+
+Siembra 100k pedidos (~1 min); PLANS_PEDIDOS lo baja para correrlo rápido en local.
+"""
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import bench
+
+PEDIDOS = int(os.getenv("PLANS_PEDIDOS", "100000"))
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    # check_plans importa app con DB_PATH apuntando a la BD temporal (nunca a pedidos.db)
+    return str(tmp_path_factory.mktemp("plans") / "plans.db")
+
+
+def test_planes_usan_indices(db_path, capsys):
+    fallas = bench.check_plans(pedidos=PEDIDOS, db_path=db_path)
+    assert fallas == 0, capsys.readouterr().out
+    assert len(bench.app_sql_strings()) > 50   # el extractor sigue encontrando el SQL de app.py
+
+
+def test_variantes_con_filtros_se_revisan(db_path):
+    app, db = bench.open_app_db(db_path)
+    casos = bench.plan_casos(app, db)
+    for funcion in ("pedidos_pagina", "cambiar_pedidos", "pedidos_lote", "pedido_visible"):
+        assert any(nombre.startswith(funcion + " ") for nombre, _, _ in casos), funcion
+    # cada variante corrió de verdad su SQL: si el trazado dejara de capturar, el chequeo pasaría en vacío
+    for nombre, rol, fn in casos:
+        if rol[0] == "admin":
+            assert bench.sql_ejecutado(app, fn, rol), nombre
+    db.close()